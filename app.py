@@ -1,19 +1,35 @@
 import streamlit as st
-import pandas as pd
 import datetime
 import pytz
 import os
-import smtplib
 import random
+import re
+import secrets
+import sys
 import threading
 import time
 import hashlib
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from streamlit.components.v1 import html
+import hmac
+import ipaddress
+import json
+import logging
+import urllib.parse
+import streamlit.components.v1 as components
 import sqlite3
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, Future
+import queue
+import csv
+import gzip
+import io
+import importlib.util
 import uuid
+import tempfile
+import bisect
+from html import escape
+import functools
+import statistics
+from collections import namedtuple, deque
+from contextlib import contextmanager
 
 # Page configuration
 st.set_page_config(
@@ -23,138 +39,1244 @@ st.set_page_config(
    initial_sidebar_state="expanded"
 )
 
-# Hide Streamlit footer
-st.markdown(
-   """
-   <style>
-   #MainMenu {visibility: hidden;}
-   footer {visibility: hidden;}
-   </style>
-   """, 
-   unsafe_allow_html=True
-)
+# All custom CSS in a single element: hides the Streamlit menu and footer, styles the roster
+APP_CSS = """
+<style>
+    .main {
+        background-color: #ffffff;
+        color: #333333;
+    }
+    .block-container {
+        padding-top: 1rem;
+        padding-bottom: 0rem;
+    }
+    /* Esconde o menu principal e footer, MAS mantém o botão do sidebar */
+    #MainMenu {visibility: hidden !important;}
+    footer {visibility: hidden !important;}
+    
+    /* Mantém o botão de toggle do sidebar visível */
+    button[kind="header"] {
+        display: block !important;
+        visibility: visible !important;
+    }
+    
+    /* Remove qualquer espaço em branco adicional */
+    div[data-testid="stAppViewBlockContainer"] {
+        padding-top: 0 !important;
+        padding-bottom: 0 !important;
+    }
+    div[data-testid="stVerticalBlock"] {
+        gap: 0 !important;
+        padding-top: 0 !important;
+        padding-bottom: 0 !important;
+    }
+    /* Remove quaisquer margens extras */
+    .element-container {
+        margin-top: 0 !important;
+        margin-bottom: 0 !important;
+    }
+    
+    /* Lista de alunos presentes na barra lateral */
+    ul.roster {
+        list-style: none;
+        padding-left: 0;
+    }
+    ul.roster li {
+        padding: 0.5rem 0;
+        border-bottom: 1px solid rgba(49, 51, 63, 0.2);
+    }
+    
+    /* Garante que o header com o botão do sidebar fique visível */
+    header[data-testid="stHeader"] {
+        display: block !important;
+        visibility: visible !important;
+        background-color: transparent !important;
+    }
+</style>
+"""
+st.markdown(APP_CSS, unsafe_allow_html=True)
+
+DB_PATH = os.environ.get('ATTENDANCE_DB', 'attendance.db')
+
+# Background threads (scheduler, outbox) report their failures here
+logger = logging.getLogger("listapp")
 
 # Database connection with thread safety
-def get_db_connection():
-   """Get database connection with proper configuration for concurrent access."""
-   conn = sqlite3.connect('attendance.db', check_same_thread=False, timeout=30.0)
-   conn.execute('PRAGMA journal_mode=WAL')
-   conn.execute('PRAGMA synchronous=NORMAL')
-   conn.execute('PRAGMA cache_size=10000')
-   conn.execute('PRAGMA temp_store=memory')
-   return conn
+class ConnectionPool:
+   """Shared SQLite connections: reusable readers and a single serialized writer."""
 
-def init_database():
-   """Initialize database with proper indexes for performance."""
-   conn = get_db_connection()
+   def __init__(self, path):
+       self.path = path
+       # Streamlit runs every rerun on a new thread, so readers are pooled rather than thread-bound
+       self._readers = []
+       self._idle_readers = []
+       self._readers_lock = threading.Lock()
+       self._writer = None
+       self._writer_lock = threading.Lock()
+       self._stats_lock = threading.Lock()
+       self._stats = {'checkouts': 0, 'waits': 0, 'opened': 0}
+       self._trace_callback = None
+
+   def _count(self, key):
+       with self._stats_lock:
+           self._stats[key] += 1
+
+   def _connect(self):
+       """Open a connection configured for concurrent access (PRAGMAs run once per connection)."""
+       conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30.0)
+       conn.execute('PRAGMA journal_mode=WAL')
+       conn.execute('PRAGMA synchronous=NORMAL')
+       conn.execute('PRAGMA cache_size=10000')
+       conn.execute('PRAGMA temp_store=memory')
+       conn.set_trace_callback(self._trace_callback)
+       self._count('opened')
+       return conn
+
+   def connections(self):
+       """Every connection currently held by the pool."""
+       with self._readers_lock:
+           conns = list(self._readers)
+       if self._writer is not None:
+           conns.append(self._writer)
+       return conns
+
+   def set_trace_callback(self, callback):
+       """Install an sqlite3 trace callback (called with each SQL statement) on all connections."""
+       self._trace_callback = callback
+       for conn in self.connections():
+           conn.set_trace_callback(callback)
+
+   @contextmanager
+   def read(self):
+       """Check out a read connection for the duration of the block."""
+       with self._readers_lock:
+           conn = self._idle_readers.pop() if self._idle_readers else None
+       if conn is None:
+           conn = self._connect()
+           with self._readers_lock:
+               self._readers.append(conn)
+       self._count('checkouts')
+       try:
+           yield conn
+       finally:
+           with self._readers_lock:
+               self._idle_readers.append(conn)
+
+   @contextmanager
+   def write(self):
+       """Check out the writer; commits on success and rolls back on error."""
+       if not self._writer_lock.acquire(blocking=False):
+           self._count('waits')
+           self._writer_lock.acquire()
+       try:
+           if self._writer is None:
+               self._writer = self._connect()
+           self._count('checkouts')
+           try:
+               yield self._writer
+               self._writer.commit()
+           except BaseException:
+               self._writer.rollback()
+               raise
+       finally:
+           self._writer_lock.release()
+
+   def stats(self):
+       """Return pool statistics: checkouts, writer waits and open connections."""
+       with self._stats_lock:
+           stats = dict(self._stats)
+       with self._readers_lock:
+           stats['open_connections'] = len(self._readers) + (self._writer is not None)
+       return stats
+
+def get_setting(name, default=None):
+   """Read an optional setting from st.secrets, falling back to default without a secrets file."""
    try:
+       return st.secrets.get(name, default)
+   except FileNotFoundError:
+       return default
+
+def get_flag(name, default=False):
+   """Read a yes/no setting; strings such as "false" or "0" (e.g. from the environment) mean no."""
+   value = get_setting(name, default)
+   if isinstance(value, str):
+       return value.strip().lower() in ('1', 'true', 'yes', 'on', 'sim')
+   return bool(value)
+
+# Hot-path instrumentation
+class Tracer:
+   """Per-rerun timings, query counts and rows fetched, kept in a process-wide ring buffer."""
+
+   def __init__(self, enabled, capacity=500, metrics_file=None, dump_interval=15.0):
+       self.enabled = enabled
+       self.reruns = deque(maxlen=capacity)
+       self.metrics_file = metrics_file
+       self.dump_interval = dump_interval
+       self._local = threading.local()
+       self._lock = threading.Lock()
+       self._totals = {'reruns': 0, 'queries': 0, 'rows': 0, 'spans': {}}
+       self._dumped_at = 0.0
+
+   def current(self):
+       """The trace of the rerun running on this thread, or None."""
+       return getattr(self._local, 'trace', None)
+
+   @contextmanager
+   def rerun(self):
+       """Collect everything traced on this thread into one ring-buffer entry."""
+       trace = {'started': time.time(), 'spans': {}, 'queries': 0, 'rows': 0}
+       self._local.trace = trace
+       start = time.perf_counter()
+       try:
+           yield trace
+       finally:
+           trace['total_ms'] = (time.perf_counter() - start) * 1000
+           self._local.trace = None
+           with self._lock:
+               self.reruns.append(trace)
+               self._totals['reruns'] += 1
+               self._totals['queries'] += trace['queries']
+               self._totals['rows'] += trace['rows']
+               for name, (calls, total_ms) in trace['spans'].items():
+                   span = self._totals['spans'].setdefault(name, [0, 0.0])
+                   span[0] += calls
+                   span[1] += total_ms
+           self.maybe_dump()
+
+   @contextmanager
+   def span(self, name):
+       """Time a block of the current rerun; a no-op outside traced reruns."""
+       trace = self.current()
+       if trace is None:
+           yield
+           return
+       start = time.perf_counter()
+       try:
+           yield
+       finally:
+           span = trace['spans'].setdefault(name, [0, 0.0])
+           span[0] += 1
+           span[1] += (time.perf_counter() - start) * 1000
+
+   def add_rows(self, count):
+       trace = self.current()
+       if trace is not None:
+           trace['rows'] += count
+
+   def on_statement(self, sql):
+       """sqlite3 trace callback: count statements issued by the traced rerun's thread."""
+       trace = self.current()
+       if trace is not None:
+           trace['queries'] += 1
+
+   def snapshot(self):
+       """Copy of the buffered reruns and running totals."""
+       with self._lock:
+           totals = dict(self._totals, spans={name: list(span) for name, span in self._totals['spans'].items()})
+           return list(self.reruns), totals
+
+   def prometheus(self, pool_stats=None, rejections=None):
+       """Running totals in the Prometheus text exposition format."""
+       _, totals = self.snapshot()
+       lines = [
+           "# HELP listapp_reruns_total Traced script reruns.",
+           "# TYPE listapp_reruns_total counter",
+           f"listapp_reruns_total {totals['reruns']}",
+           "# HELP listapp_queries_total SQL statements issued by traced reruns.",
+           "# TYPE listapp_queries_total counter",
+           f"listapp_queries_total {totals['queries']}",
+           "# HELP listapp_rows_fetched_total Rows fetched by traced reruns.",
+           "# TYPE listapp_rows_fetched_total counter",
+           f"listapp_rows_fetched_total {totals['rows']}",
+           "# HELP listapp_span_calls_total Calls per traced helper or render section.",
+           "# TYPE listapp_span_calls_total counter",
+       ]
+       lines += [f'listapp_span_calls_total{{span="{name}"}} {calls}' for name, (calls, _) in sorted(totals['spans'].items())]
+       lines += [
+           "# HELP listapp_span_seconds_total Time spent per traced helper or render section.",
+           "# TYPE listapp_span_seconds_total counter",
+       ]
+       lines += [f'listapp_span_seconds_total{{span="{name}"}} {total_ms / 1000:.6f}' for name, (_, total_ms) in sorted(totals['spans'].items())]
+       if pool_stats:
+           lines += [
+               "# TYPE listapp_pool_checkouts_total counter",
+               f"listapp_pool_checkouts_total {pool_stats['checkouts']}",
+               "# TYPE listapp_pool_waits_total counter",
+               f"listapp_pool_waits_total {pool_stats['waits']}",
+               "# TYPE listapp_pool_open_connections gauge",
+               f"listapp_pool_open_connections {pool_stats['open_connections']}",
+           ]
+       if rejections:
+           lines += [
+               "# HELP listapp_rejections_total Requests refused by rate limiting or admission control.",
+               "# TYPE listapp_rejections_total counter",
+           ]
+           lines += [f'listapp_rejections_total{{scope="{scope}",reason="{reason}"}} {count}'
+                     for (scope, reason), count in sorted(rejections.items())]
+       return "\n".join(lines) + "\n"
+
+   def maybe_dump(self):
+       """Write the Prometheus text to metrics_file, at most once per dump_interval."""
+       if not self.metrics_file or time.monotonic() - self._dumped_at < self.dump_interval:
+           return
+       self._dumped_at = time.monotonic()
+       try:
+           temp_file = f"{self.metrics_file}.tmp"
+           with open(temp_file, 'w') as f:
+               f.write(self.prometheus(get_storage().stats(), rejection_counts()))
+           os.replace(temp_file, self.metrics_file)
+       except OSError:
+           pass
+
+@st.cache_resource
+def get_tracer():
+   """Process-wide tracer; enabled with the metrics_enabled setting."""
+   return Tracer(get_flag("metrics_enabled"), metrics_file=get_setting("metrics_file"))
+
+tracer = get_tracer()
+
+def traced(name):
+   """Decorator timing a helper as a span of the current rerun."""
+   def decorate(func):
+       @functools.wraps(func)
+       def wrapper(*args, **kwargs):
+           if tracer.current() is None:
+               return func(*args, **kwargs)
+           with tracer.span(name):
+               return func(*args, **kwargs)
+       return wrapper
+   return decorate
+
+def traced_rerun(func):
+   """Decorator recording a whole script run in the tracer when metrics are enabled."""
+   @functools.wraps(func)
+   def wrapper(*args, **kwargs):
+       if not tracer.enabled:
+           return func(*args, **kwargs)
+       with tracer.rerun():
+           return func(*args, **kwargs)
+   return wrapper
+
+DEFAULT_CLASS_ID = 1
+DEFAULT_CLASS_NAME = "padrao"
+
+# Schema migrations: MIGRATIONS[n - 1] upgrades a database from user_version n - 1 to n.
+# Databases from before versioning report user_version 0, so every step checks what already exists.
+def migration_base_schema(conn):
+   """Original single-class tables and indexes."""
+   conn.execute('''
+       CREATE TABLE IF NOT EXISTS attendance (
+           id INTEGER PRIMARY KEY AUTOINCREMENT,
+           nome TEXT NOT NULL,
+           email TEXT NOT NULL UNIQUE,
+           data_hora TEXT NOT NULL,
+           session_id TEXT,
+           created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+       )
+   ''')
+   conn.execute('''
+       CREATE TABLE IF NOT EXISTS class_state (
+           id INTEGER PRIMARY KEY,
+           aula_iniciada INTEGER DEFAULT 0,
+           timer_end_time TEXT,
+           ip_professor TEXT,
+           session_id TEXT UNIQUE
+       )
+   ''')
+   conn.execute('CREATE INDEX IF NOT EXISTS idx_session ON attendance(session_id)')
+   conn.execute('CREATE INDEX IF NOT EXISTS idx_created_at ON attendance(created_at)')
+
+def migration_fingerprint(conn):
+   """Persist browser fingerprints so duplicates are caught across sessions; migration_classes indexes them."""
+   columns = [row[1] for row in conn.execute("PRAGMA table_info(attendance)")]
+   if 'fingerprint' not in columns:
+       conn.execute('ALTER TABLE attendance ADD COLUMN fingerprint TEXT')
+
+def migration_email_outbox(conn):
+   """Persistent queue for background email delivery."""
+   conn.execute('''
+       CREATE TABLE IF NOT EXISTS email_outbox (
+           id INTEGER PRIMARY KEY AUTOINCREMENT,
+           recipient TEXT NOT NULL,
+           subject TEXT NOT NULL,
+           body TEXT NOT NULL,
+           status TEXT NOT NULL DEFAULT 'pending',
+           attempts INTEGER NOT NULL DEFAULT 0,
+           next_attempt_at REAL NOT NULL,
+           last_error TEXT,
+           created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+           sent_at TIMESTAMP
+       )
+   ''')
+   conn.execute('CREATE INDEX IF NOT EXISTS idx_outbox_due ON email_outbox(status, next_attempt_at)')
+
+def migration_classes(conn):
+   """Classes table; attendance and class_state partitioned by class id."""
+   conn.execute('''
+       CREATE TABLE IF NOT EXISTS classes (
+           id INTEGER PRIMARY KEY AUTOINCREMENT,
+           nome TEXT NOT NULL UNIQUE,
+           created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+       )
+   ''')
+   conn.execute("INSERT OR IGNORE INTO classes (id, nome) VALUES (?, ?)", (DEFAULT_CLASS_ID, DEFAULT_CLASS_NAME))
+   
+   # The table-wide UNIQUE(email) becomes UNIQUE(class_id, email), which needs a rebuild;
+   # existing rows land in the default class
+   columns = [row[1] for row in conn.execute("PRAGMA table_info(attendance)")]
+   if 'class_id' not in columns:
+       conn.execute("ALTER TABLE attendance RENAME TO attendance_single_class")
        conn.execute('''
-           CREATE TABLE IF NOT EXISTS attendance (
+           CREATE TABLE attendance (
                id INTEGER PRIMARY KEY AUTOINCREMENT,
+               class_id INTEGER NOT NULL DEFAULT 1,
                nome TEXT NOT NULL,
-               email TEXT NOT NULL UNIQUE,
+               email TEXT NOT NULL,
                data_hora TEXT NOT NULL,
                session_id TEXT,
-               created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+               created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+               fingerprint TEXT
            )
        ''')
-       
+       conn.execute(f"""
+           INSERT INTO attendance (id, class_id, nome, email, data_hora, session_id, created_at, fingerprint)
+           SELECT id, {DEFAULT_CLASS_ID}, nome, email, data_hora, session_id, created_at, fingerprint
+           FROM attendance_single_class
+       """)
+       conn.execute("DROP TABLE attendance_single_class")
+   
+   # class_state.session_id used to be UNIQUE, which made INSERT OR REPLACE for one
+   # class delete the row of another class started from the same session
+   if any(index[1].startswith('sqlite_autoindex_class_state') for index in conn.execute("PRAGMA index_list(class_state)")):
+       conn.execute("ALTER TABLE class_state RENAME TO class_state_single_class")
        conn.execute('''
-           CREATE TABLE IF NOT EXISTS class_state (
+           CREATE TABLE class_state (
                id INTEGER PRIMARY KEY,
                aula_iniciada INTEGER DEFAULT 0,
                timer_end_time TEXT,
                ip_professor TEXT,
-               session_id TEXT UNIQUE
+               session_id TEXT
            )
        ''')
-       
-       # Create indexes for better performance
-       conn.execute('CREATE INDEX IF NOT EXISTS idx_email ON attendance(email)')
-       conn.execute('CREATE INDEX IF NOT EXISTS idx_session ON attendance(session_id)')
-       conn.execute('CREATE INDEX IF NOT EXISTS idx_created_at ON attendance(created_at)')
-       
-       conn.commit()
-   except sqlite3.Error as e:
-       st.error(f"Database initialization error: {e}")
-   finally:
-       conn.close()
-
-def get_browser_fingerprint():
-   """Generate unique browser fingerprint using JavaScript."""
-   fingerprint_js = """
-   <div id="browser-fingerprint" style="display: none;"></div>
-   <script>
-       function generateFingerprint() {
-           const canvas = document.createElement('canvas');
-           const ctx = canvas.getContext('2d');
-           ctx.textBaseline = 'top';
-           ctx.font = '14px Arial';
-           ctx.fillText('Browser fingerprint', 2, 2);
-           
-           const fingerprint = [
-               navigator.userAgent,
-               navigator.language,
-               screen.width + 'x' + screen.height,
-               new Date().getTimezoneOffset(),
-               canvas.toDataURL(),
-               navigator.hardwareConcurrency || 0,
-               navigator.deviceMemory || 0
-           ].join('|');
-           
-           // Simple hash function
-           let hash = 0;
-           for (let i = 0; i < fingerprint.length; i++) {
-               const char = fingerprint.charCodeAt(i);
-               hash = ((hash << 5) - hash) + char;
-               hash = hash & hash;
-           }
-           
-           const fingerprintElement = document.getElementById('browser-fingerprint');
-           if (fingerprintElement) {
-               fingerprintElement.textContent = Math.abs(hash).toString();
-           }
-           
-           // Dispatch event
-           const event = new CustomEvent('fingerprint_ready', { 
-               detail: Math.abs(hash).toString() 
-           });
-           document.dispatchEvent(event);
-       }
-       
-       if (document.readyState === 'loading') {
-           document.addEventListener('DOMContentLoaded', generateFingerprint);
-       } else {
-           generateFingerprint();
-       }
-   </script>
+       conn.execute("INSERT INTO class_state SELECT * FROM class_state_single_class")
+       conn.execute("DROP TABLE class_state_single_class")
+   
+   # Table-wide indexes of files from before versioning
+   conn.execute('DROP INDEX IF EXISTS idx_email')
+   conn.execute('DROP INDEX IF EXISTS idx_fingerprint')
+   # One registration per email and per browser within each class, visible to every session
+   conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_class_email ON attendance(class_id, email)')
+   conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_class_fingerprint ON attendance(class_id, fingerprint) WHERE fingerprint IS NOT NULL')
+   conn.execute('CREATE INDEX IF NOT EXISTS idx_class_id ON attendance(class_id, id)')
+   conn.execute('CREATE INDEX IF NOT EXISTS idx_session ON attendance(session_id)')
+   conn.execute('CREATE INDEX IF NOT EXISTS idx_created_at ON attendance(created_at)')
+
+def migration_epoch_timestamps(conn):
+   """Registration time as indexed epoch seconds, formatted only for display; replaces data_hora."""
+   columns = [row[1] for row in conn.execute("PRAGMA table_info(attendance)")]
+   if 'registered_at' not in columns:
+       conn.execute('ALTER TABLE attendance ADD COLUMN registered_at INTEGER NOT NULL DEFAULT 0')
+   if 'data_hora' in columns:
+       # created_at (UTC) is the fallback for data_hora strings that do not parse
+       conn.execute("UPDATE attendance SET registered_at = CAST(strftime('%s', created_at) AS INTEGER) WHERE registered_at = 0")
+       backfill = [(epoch, row_id) for row_id, data_hora in conn.execute("SELECT id, data_hora FROM attendance")
+                   if (epoch := parse_brazil_datetime(data_hora)) is not None]
+       conn.executemany("UPDATE attendance SET registered_at = ? WHERE id = ?", backfill)
+       conn.execute('ALTER TABLE attendance DROP COLUMN data_hora')
+   conn.execute('CREATE INDEX IF NOT EXISTS idx_class_registered_at ON attendance(class_id, registered_at)')
+
+def migration_generations(conn):
+   """Each class's list is a generation: resetting bumps class_state.generation instead of deleting rows."""
+   for table in ('attendance', 'class_state'):
+       columns = [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+       if 'generation' not in columns:
+           conn.execute(f'ALTER TABLE {table} ADD COLUMN generation INTEGER NOT NULL DEFAULT 1')
+   # Uniqueness and roster scans are per generation, so the fresh list starts empty
+   conn.execute('DROP INDEX IF EXISTS idx_class_email')
+   conn.execute('DROP INDEX IF EXISTS idx_class_fingerprint')
+   conn.execute('DROP INDEX IF EXISTS idx_class_id')
+   conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_generation_email ON attendance(class_id, generation, email)')
+   conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_generation_fingerprint ON attendance(class_id, generation, fingerprint) WHERE fingerprint IS NOT NULL')
+   conn.execute('CREATE INDEX IF NOT EXISTS idx_generation_id ON attendance(class_id, generation, id)')
+   # One list email per closed generation, however many processes finalize it
+   columns = [row[1] for row in conn.execute("PRAGMA table_info(email_outbox)")]
+   if 'dedupe_key' not in columns:
+       conn.execute('ALTER TABLE email_outbox ADD COLUMN dedupe_key TEXT')
+   conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_outbox_dedupe ON email_outbox(dedupe_key) WHERE dedupe_key IS NOT NULL')
+
+def migration_archive(conn):
+   """Closed lists move to an indexed archive instead of being deleted, for per-student history."""
+   conn.execute('''
+       CREATE TABLE IF NOT EXISTS archived_lists (
+           id INTEGER PRIMARY KEY AUTOINCREMENT,
+           class_id INTEGER NOT NULL,
+           generation INTEGER,
+           closed_at INTEGER NOT NULL,
+           source TEXT
+       )
+   ''')
+   # Keyed by the list and the (normalized) email, which every secondary index then
+   # carries too, so the per-student queries are answered from the indexes alone
+   conn.execute('''
+       CREATE TABLE IF NOT EXISTS archived_attendance (
+           list_id INTEGER NOT NULL,
+           email TEXT NOT NULL,
+           class_id INTEGER NOT NULL,
+           nome TEXT NOT NULL,
+           registered_at INTEGER NOT NULL,
+           PRIMARY KEY (list_id, email)
+       ) WITHOUT ROWID
+   ''')
+   # A closed generation and a CSV backup are each archived once
+   conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_archived_generation ON archived_lists(class_id, generation) WHERE generation IS NOT NULL')
+   conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_archived_source ON archived_lists(source) WHERE source IS NOT NULL')
+   conn.execute('CREATE INDEX IF NOT EXISTS idx_archived_lists_class_date ON archived_lists(class_id, closed_at)')
+   conn.execute('CREATE INDEX IF NOT EXISTS idx_archive_email_date ON archived_attendance(email, registered_at)')
+   conn.execute('CREATE INDEX IF NOT EXISTS idx_archive_class_date ON archived_attendance(class_id, registered_at, nome)')
+
+def migration_checkin_key(conn):
+   """Per-start secret of each class, the HMAC key of its rotating check-in codes."""
+   columns = [row[1] for row in conn.execute("PRAGMA table_info(class_state)")]
+   if 'checkin_key' not in columns:
+       conn.execute('ALTER TABLE class_state ADD COLUMN checkin_key TEXT')
+   # Lists already open keep working, with a fresh key
+   keys = [(secrets.token_hex(32), class_id) for class_id, in conn.execute("SELECT id FROM class_state WHERE checkin_key IS NULL")]
+   conn.executemany("UPDATE class_state SET checkin_key = ? WHERE id = ?", keys)
+
+def migration_class_version(conn):
+   """Change counter of each class in class_state, so replicas sharing a database see each other's changes."""
+   columns = [row[1] for row in conn.execute("PRAGMA table_info(class_state)")]
+   if 'version' not in columns:
+       conn.execute('ALTER TABLE class_state ADD COLUMN version INTEGER NOT NULL DEFAULT 0')
+
+def migration_outbox_class(conn):
+   """Class of each list email, so every class shows the status of its own."""
+   columns = [row[1] for row in conn.execute("PRAGMA table_info(email_outbox)")]
+   if 'class_id' not in columns:
+       conn.execute('ALTER TABLE email_outbox ADD COLUMN class_id INTEGER')
+   # List emails carry their class in the dedupe key, list:<class_id>:<generation>
+   conn.execute("""
+       UPDATE email_outbox SET class_id = CAST(substr(dedupe_key, 6, instr(substr(dedupe_key, 6), ':') - 1) AS INTEGER)
+       WHERE class_id IS NULL AND dedupe_key LIKE 'list:%:%'
+   """)
+   conn.execute('CREATE INDEX IF NOT EXISTS idx_outbox_class ON email_outbox(class_id, id)')
+
+def migration_roster_version(conn):
+   """Registration counter of each class, apart from version, so new rows refresh only the roster."""
+   columns = [row[1] for row in conn.execute("PRAGMA table_info(class_state)")]
+   if 'roster_version' not in columns:
+       conn.execute('ALTER TABLE class_state ADD COLUMN roster_version INTEGER NOT NULL DEFAULT 0')
+
+MIGRATIONS = [
+   migration_base_schema,
+   migration_fingerprint,
+   migration_email_outbox,
+   migration_classes,
+   migration_epoch_timestamps,
+   migration_generations,
+   migration_archive,
+   migration_checkin_key,
+   migration_class_version,
+   migration_outbox_class,
+   migration_roster_version,
+]
+
+def postgres_migration_schema(conn):
+   """Current schema in PostgreSQL dialect; Postgres deployments start at the multi-class layout."""
+   conn.execute('''
+       CREATE TABLE IF NOT EXISTS classes (
+           id SERIAL PRIMARY KEY,
+           nome TEXT NOT NULL UNIQUE,
+           created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+       )
+   ''')
+   conn.execute("INSERT INTO classes (id, nome) VALUES (%s, %s) ON CONFLICT DO NOTHING", (DEFAULT_CLASS_ID, DEFAULT_CLASS_NAME))
+   # The default class was inserted with an explicit id, so move the sequence past it
+   conn.execute("SELECT setval(pg_get_serial_sequence('classes', 'id'), (SELECT MAX(id) FROM classes))")
+   conn.execute('''
+       CREATE TABLE IF NOT EXISTS attendance (
+           id BIGSERIAL PRIMARY KEY,
+           class_id INTEGER NOT NULL DEFAULT 1,
+           nome TEXT NOT NULL,
+           email TEXT NOT NULL,
+           data_hora TEXT NOT NULL,
+           session_id TEXT,
+           created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+           fingerprint TEXT
+       )
+   ''')
+   conn.execute('''
+       CREATE TABLE IF NOT EXISTS class_state (
+           id INTEGER PRIMARY KEY,
+           aula_iniciada INTEGER DEFAULT 0,
+           timer_end_time TEXT,
+           ip_professor TEXT,
+           session_id TEXT
+       )
+   ''')
+   conn.execute('''
+       CREATE TABLE IF NOT EXISTS email_outbox (
+           id BIGSERIAL PRIMARY KEY,
+           recipient TEXT NOT NULL,
+           subject TEXT NOT NULL,
+           body TEXT NOT NULL,
+           status TEXT NOT NULL DEFAULT 'pending',
+           attempts INTEGER NOT NULL DEFAULT 0,
+           next_attempt_at DOUBLE PRECISION NOT NULL,
+           last_error TEXT,
+           created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+           sent_at TIMESTAMP
+       )
+   ''')
+   conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_class_email ON attendance(class_id, email)')
+   conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_class_fingerprint ON attendance(class_id, fingerprint) WHERE fingerprint IS NOT NULL')
+   conn.execute('CREATE INDEX IF NOT EXISTS idx_class_id ON attendance(class_id, id)')
+   conn.execute('CREATE INDEX IF NOT EXISTS idx_session ON attendance(session_id)')
+   conn.execute('CREATE INDEX IF NOT EXISTS idx_created_at ON attendance(created_at)')
+   conn.execute('CREATE INDEX IF NOT EXISTS idx_outbox_due ON email_outbox(status, next_attempt_at)')
+
+def postgres_migration_epoch_timestamps(conn):
+   """Registration time as indexed epoch seconds; replaces data_hora (see migration_epoch_timestamps)."""
+   conn.execute('ALTER TABLE attendance ADD COLUMN IF NOT EXISTS registered_at BIGINT NOT NULL DEFAULT 0')
+   conn.execute("UPDATE attendance SET registered_at = EXTRACT(EPOCH FROM created_at)::BIGINT WHERE registered_at = 0")
+   backfill = [(epoch, row_id) for row_id, data_hora in conn.execute("SELECT id, data_hora FROM attendance").fetchall()
+               if (epoch := parse_brazil_datetime(data_hora)) is not None]
+   if backfill:
+       conn.cursor().executemany("UPDATE attendance SET registered_at = %s WHERE id = %s", backfill)
+   conn.execute('ALTER TABLE attendance ALTER COLUMN registered_at DROP DEFAULT')
+   conn.execute('ALTER TABLE attendance DROP COLUMN data_hora')
+   conn.execute('CREATE INDEX IF NOT EXISTS idx_class_registered_at ON attendance(class_id, registered_at)')
+
+def postgres_migration_generations(conn):
+   """Per-class list generations (see migration_generations)."""
+   conn.execute('ALTER TABLE attendance ADD COLUMN IF NOT EXISTS generation INTEGER NOT NULL DEFAULT 1')
+   conn.execute('ALTER TABLE class_state ADD COLUMN IF NOT EXISTS generation INTEGER NOT NULL DEFAULT 1')
+   conn.execute('DROP INDEX IF EXISTS idx_class_email')
+   conn.execute('DROP INDEX IF EXISTS idx_class_fingerprint')
+   conn.execute('DROP INDEX IF EXISTS idx_class_id')
+   conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_generation_email ON attendance(class_id, generation, email)')
+   conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_generation_fingerprint ON attendance(class_id, generation, fingerprint) WHERE fingerprint IS NOT NULL')
+   conn.execute('CREATE INDEX IF NOT EXISTS idx_generation_id ON attendance(class_id, generation, id)')
+   conn.execute('ALTER TABLE email_outbox ADD COLUMN IF NOT EXISTS dedupe_key TEXT')
+   conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_outbox_dedupe ON email_outbox(dedupe_key) WHERE dedupe_key IS NOT NULL')
+
+def postgres_migration_archive(conn):
+   """Archive of closed lists (see migration_archive)."""
+   conn.execute('''
+       CREATE TABLE IF NOT EXISTS archived_lists (
+           id SERIAL PRIMARY KEY,
+           class_id INTEGER NOT NULL,
+           generation INTEGER,
+           closed_at BIGINT NOT NULL,
+           source TEXT
+       )
+   ''')
+   conn.execute('''
+       CREATE TABLE IF NOT EXISTS archived_attendance (
+           list_id INTEGER NOT NULL,
+           email TEXT NOT NULL,
+           class_id INTEGER NOT NULL,
+           nome TEXT NOT NULL,
+           registered_at BIGINT NOT NULL,
+           PRIMARY KEY (list_id, email)
+       )
+   ''')
+   conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_archived_generation ON archived_lists(class_id, generation) WHERE generation IS NOT NULL')
+   conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_archived_source ON archived_lists(source) WHERE source IS NOT NULL')
+   conn.execute('CREATE INDEX IF NOT EXISTS idx_archived_lists_class_date ON archived_lists(class_id, closed_at)')
+   # INCLUDE makes both lookups index-only, like the WITHOUT ROWID layout in SQLite
+   conn.execute('CREATE INDEX IF NOT EXISTS idx_archive_email_date ON archived_attendance(email, registered_at) INCLUDE (list_id, class_id)')
+   conn.execute('CREATE INDEX IF NOT EXISTS idx_archive_class_date ON archived_attendance(class_id, registered_at) INCLUDE (email, list_id, nome)')
+
+def postgres_migration_checkin_key(conn):
+   """Per-start check-in code key (see migration_checkin_key)."""
+   conn.execute('ALTER TABLE class_state ADD COLUMN IF NOT EXISTS checkin_key TEXT')
+   keys = [(secrets.token_hex(32), class_id)
+           for class_id, in conn.execute("SELECT id FROM class_state WHERE checkin_key IS NULL").fetchall()]
+   if keys:
+       conn.cursor().executemany("UPDATE class_state SET checkin_key = %s WHERE id = %s", keys)
+
+def postgres_migration_class_version(conn):
+   """Per-class change counter (see migration_class_version)."""
+   conn.execute('ALTER TABLE class_state ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL DEFAULT 0')
+
+def postgres_migration_outbox_class(conn):
+   """Class of each list email (see migration_outbox_class)."""
+   conn.execute('ALTER TABLE email_outbox ADD COLUMN IF NOT EXISTS class_id INTEGER')
+   conn.execute("""
+       UPDATE email_outbox SET class_id = split_part(dedupe_key, ':', 2)::INTEGER
+       WHERE class_id IS NULL AND dedupe_key LIKE 'list:%:%'
+   """)
+   conn.execute('CREATE INDEX IF NOT EXISTS idx_outbox_class ON email_outbox(class_id, id)')
+
+def postgres_migration_roster_version(conn):
+   """Per-class registration counter (see migration_roster_version)."""
+   conn.execute('ALTER TABLE class_state ADD COLUMN IF NOT EXISTS roster_version BIGINT NOT NULL DEFAULT 0')
+
+POSTGRES_MIGRATIONS = [
+   postgres_migration_schema,
+   postgres_migration_epoch_timestamps,
+   postgres_migration_generations,
+   postgres_migration_archive,
+   postgres_migration_checkin_key,
+   postgres_migration_class_version,
+   postgres_migration_outbox_class,
+   postgres_migration_roster_version,
+]
+
+# Storage backends: every helper reads and writes through get_storage(), never a driver directly
+class Storage:
+   """Queries shared by all backends, written with ? placeholders.
+
+   Subclasses provide read()/write() connection context managers, migrate(), stats()
+   and execute(), which adapts the SQL to the driver. shared is True when other
+   processes may write to the same database.
    """
-   html(fingerprint_js, height=0)
-   return "generating..."
+
+   shared = False
+
+   def execute(self, conn, sql, params=()):
+       return conn.execute(sql, params)
+
+   def executemany(self, conn, sql, rows):
+       return conn.executemany(sql, rows)
+
+   def find_class(self, class_name):
+       """Id of the named class, or None."""
+       with self.read() as conn:
+           result = self.execute(conn, "SELECT id FROM classes WHERE nome = ?", (class_name,)).fetchone()
+       return result[0] if result else None
+
+   def class_name(self, class_id):
+       """Name of the class, or None."""
+       with self.read() as conn:
+           result = self.execute(conn, "SELECT nome FROM classes WHERE id = ?", (class_id,)).fetchone()
+       return result[0] if result else None
+
+   def create_class(self, class_name):
+       """Id of the named class, creating it if needed."""
+       with self.write() as conn:
+           self.execute(conn, "INSERT INTO classes (nome) VALUES (?) ON CONFLICT DO NOTHING", (class_name,))
+           return self.execute(conn, "SELECT id FROM classes WHERE nome = ?", (class_name,)).fetchone()[0]
+
+   def get_class_state(self, class_id):
+       """The class_state row (aula_iniciada, timer_end_time, ip_professor, session_id, checkin_key,
+       version, roster_version), or None."""
+       with self.read() as conn:
+           return self.execute(
+               conn,
+               "SELECT aula_iniciada, timer_end_time, ip_professor, session_id, checkin_key, version, roster_version "
+               "FROM class_state WHERE id = ?",
+               (class_id,)
+           ).fetchone()
+
+   def start_class(self, class_id, session_id):
+       """Mark the class as started, replacing any previous state row.
+
+       Every start draws a new checkin_key, so codes shown for an earlier list stop working.
+       This and every other class_state write bump version, which replicas poll; registrations
+       bump roster_version instead, so they refresh rosters without rerunning whole pages.
+       """
+       with self.write() as conn:
+           self.execute(conn, """
+               INSERT INTO class_state (id, aula_iniciada, timer_end_time, ip_professor, session_id, checkin_key, version) 
+               VALUES (?, 1, NULL, NULL, ?, ?, 1)
+               ON CONFLICT (id) DO UPDATE SET aula_iniciada = excluded.aula_iniciada, 
+                   timer_end_time = excluded.timer_end_time, ip_professor = excluded.ip_professor, 
+                   session_id = excluded.session_id, checkin_key = excluded.checkin_key,
+                   version = class_state.version + 1
+           """, (class_id, session_id, secrets.token_hex(32)))
+
+   def set_timer(self, class_id, timer_end_time):
+       with self.write() as conn:
+           self.execute(conn, "UPDATE class_state SET timer_end_time = ?, version = version + 1 WHERE id = ?", (timer_end_time, class_id))
+
+   def rotate_class(self, class_id, timer_end_time=None):
+       """Close the class's open list and start its next generation in one constant-time UPDATE.
+
+       Applies only while the class is open (and its timer is still timer_end_time, if
+       given), so it is safe to race: exactly one caller, in any process, gets the closed
+       generation back; the others get None. The closed generation's rows are never
+       written again and stay readable until archive_generation moves them to the archive.
+       """
+       sql = """
+           UPDATE class_state SET aula_iniciada = 0, timer_end_time = NULL, ip_professor = NULL, 
+               session_id = NULL, generation = generation + 1, version = version + 1
+           WHERE id = ? AND aula_iniciada = 1
+       """
+       params = (class_id,)
+       if timer_end_time is not None:
+           sql += " AND timer_end_time = ?"
+           params += (timer_end_time,)
+       with self.write() as conn:
+           result = self.execute(conn, sql + " RETURNING generation - 1", params).fetchone()
+       return result[0] if result else None
+
+   def open_timers(self):
+       """(class_id, timer_end_time) of every open class with a timer."""
+       with self.read() as conn:
+           return self.execute(
+               conn, "SELECT id, timer_end_time FROM class_state WHERE aula_iniciada = 1 AND timer_end_time IS NOT NULL"
+           ).fetchall()
+
+   def closed_generations(self):
+       """(class_id, generation) of the oldest closed generation of each class that still has rows."""
+       with self.read() as conn:
+           return self.execute(conn, """
+               SELECT id, oldest FROM (
+                   SELECT id, generation, (SELECT MIN(generation) FROM attendance WHERE class_id = class_state.id) AS oldest
+                   FROM class_state
+               ) AS states WHERE oldest < generation
+           """).fetchall()
+
+   def archive_list(self, class_id, generation, closed_at, source=None):
+       """Id of the archived list of a closed generation, creating it if needed.
+
+       source is the CSV backup written for it, so importing that file later is a no-op.
+       The list is identified by (class_id, generation) alone: a clash on source is an
+       error, never a reason to reuse another list.
+       """
+       with self.write() as conn:
+           self.execute(conn, """
+               INSERT INTO archived_lists (class_id, generation, closed_at, source) VALUES (?, ?, ?, ?)
+               ON CONFLICT (class_id, generation) WHERE generation IS NOT NULL DO NOTHING
+           """, (class_id, generation, closed_at, source))
+           return self.execute(
+               conn, "SELECT id FROM archived_lists WHERE class_id = ? AND generation = ?", (class_id, generation)
+           ).fetchone()[0]
+
+   def archive_generation(self, class_id, generation, list_id, batch_size):
+       """Move up to batch_size rows of a closed generation into archived list list_id; returns how many moved.
+
+       Small batches keep each write transaction short, so registrations for the
+       new generation never wait behind a large move.
+       """
+       with self.write() as conn:
+           rows = self.execute(conn, """
+               DELETE FROM attendance WHERE id IN (
+                   SELECT id FROM attendance WHERE class_id = ? AND generation = ? LIMIT ?
+               )
+               RETURNING nome, email, registered_at
+           """, (class_id, generation, batch_size)).fetchall()
+           self._insert_archived(conn, list_id, class_id, rows)
+       return len(rows)
+
+   def import_list(self, class_id, closed_at, source, rows):
+       """Archive a list restored from a backup file, all or nothing; False if source was already archived."""
+       with self.write() as conn:
+           result = self.execute(conn, """
+               INSERT INTO archived_lists (class_id, closed_at, source) VALUES (?, ?, ?)
+               ON CONFLICT DO NOTHING
+               RETURNING id
+           """, (class_id, closed_at, source)).fetchone()
+           if result is None:
+               return False
+           self._insert_archived(conn, result[0], class_id, rows)
+       return True
+
+   def _insert_archived(self, conn, list_id, class_id, rows):
+       # Emails are matched across lists, so case and stray spaces must not split a student
+       self.executemany(conn, """
+           INSERT INTO archived_attendance (list_id, email, class_id, nome, registered_at) VALUES (?, ?, ?, ?, ?)
+           ON CONFLICT DO NOTHING
+       """, [(list_id, email.strip().lower(), class_id, nome, registered_at) for nome, email, registered_at in rows])
+
+   def attendance_rates(self, class_id, since=0, until=2 ** 62):
+       """(email, nome, attended, held) of every student in the class's lists closed between since and until.
+
+       held counts the lists of the class in the period and attended the student's
+       lists among those same lists, so attended never exceeds held. The lists come
+       from the (class_id, closed_at) index, their rows from the (list_id, email) key.
+       """
+       with self.read() as conn:
+           held = self.execute(
+               conn, "SELECT COUNT(*) FROM archived_lists WHERE class_id = ? AND closed_at >= ? AND closed_at < ?",
+               (class_id, since, until)
+           ).fetchone()[0]
+           rows = self.execute(conn, """
+               SELECT a.email, MAX(a.nome), COUNT(*) FROM archived_lists l 
+               JOIN archived_attendance a ON a.list_id = l.id
+               WHERE l.class_id = ? AND l.closed_at >= ? AND l.closed_at < ?
+               GROUP BY a.email ORDER BY COUNT(*) DESC, a.email
+           """, (class_id, since, until)).fetchall()
+       return [(email, nome, attended, held) for email, nome, attended in rows]
+
+   def student_attendance(self, email, since=0, until=2 ** 62):
+       """(class_id, attended, held) per class the student attended in lists closed between since and until.
+
+       The student's rows come from the email index, which carries list_id; held and
+       attended filter the same lists on closed_at, as in attendance_rates.
+       """
+       with self.read() as conn:
+           return self.execute(conn, """
+               SELECT l.class_id, COUNT(*), (
+                   SELECT COUNT(*) FROM archived_lists h 
+                   WHERE h.class_id = l.class_id AND h.closed_at >= ? AND h.closed_at < ?
+               )
+               FROM archived_attendance a JOIN archived_lists l ON l.id = a.list_id
+               WHERE a.email = ? AND l.closed_at >= ? AND l.closed_at < ?
+               GROUP BY l.class_id ORDER BY l.class_id
+           """, (since, until, email.strip().lower(), since, until)).fetchall()
+
+   def register_batch(self, rows):
+       """Insert (class_id, nome, email, registered_at, session_id, fingerprint) rows in one transaction.
+
+       Rows join the class's current generation. Returns (id, generation) of the new row
+       per row, or None when the email or fingerprint is already in that generation or the
+       class is not open (so nothing lands after rotate_class).
+       """
+       results = []
+       with self.write() as conn:
+           for row in rows:
+               # Single round trip: RETURNING yields nothing when the row already existed
+               cursor = self.execute(conn, """
+                   INSERT INTO attendance (class_id, nome, email, registered_at, session_id, fingerprint, generation) 
+                   SELECT ?, ?, ?, ?, ?, ?, generation FROM class_state WHERE id = ? AND aula_iniciada = 1
+                   ON CONFLICT DO NOTHING
+                   RETURNING id, generation
+               """, tuple(row) + (row[0],))
+               result = cursor.fetchone()
+               results.append(tuple(result) if result else None)
+           # Same transaction, so other replicas never see the rows without the new roster_version
+           changed = sorted({row[0] for row, row_id in zip(rows, results) if row_id is not None})
+           self.executemany(
+               conn, "UPDATE class_state SET roster_version = roster_version + 1 WHERE id = ?", [(class_id,) for class_id in changed]
+           )
+       return results
+
+   @staticmethod
+   def _generation(class_id, generation):
+       """SQL and params selecting the given generation, or the class's current one."""
+       if generation is not None:
+           return "?", (generation,)
+       # Classes that were never started have no state row yet: their list is generation 1
+       return "COALESCE((SELECT generation FROM class_state WHERE id = ?), 1)", (class_id,)
+
+   def attendance_rows(self, class_id, generation=None):
+       """All (nome, email, registered_at) rows of a class's list in registration order."""
+       generation_sql, generation_params = self._generation(class_id, generation)
+       with self.read() as conn:
+           return self.execute(
+               conn,
+               f"SELECT nome, email, registered_at FROM attendance WHERE class_id = ? AND generation = {generation_sql} "
+               "ORDER BY registered_at, id",
+               (class_id,) + generation_params
+           ).fetchall()
+
+   def current_generation(self, class_id):
+       """Generation of the class's current list."""
+       generation_sql, generation_params = self._generation(class_id, None)
+       with self.read() as conn:
+           return self.execute(conn, f"SELECT {generation_sql}", generation_params).fetchone()[0]
+
+   def attendance_first_id(self, class_id, generation=None):
+       """Smallest attendance id of the class's list (the current one unless generation is given)."""
+       generation_sql, generation_params = self._generation(class_id, generation)
+       with self.read() as conn:
+           return self.execute(
+               conn, f"SELECT MIN(id) FROM attendance WHERE class_id = ? AND generation = {generation_sql}",
+               (class_id,) + generation_params
+           ).fetchone()[0]
+
+   def attendance_since(self, class_id, last_id, generation=None):
+       """(id, nome, email, registered_at, fingerprint) rows of the list (the current one unless generation is given) added after last_id, in id order."""
+       generation_sql, generation_params = self._generation(class_id, generation)
+       with self.read() as conn:
+           return self.execute(
+               conn,
+               "SELECT id, nome, email, registered_at, fingerprint FROM attendance "
+               f"WHERE class_id = ? AND generation = {generation_sql} AND id > ? ORDER BY id",
+               (class_id,) + generation_params + (last_id,)
+           ).fetchall()
+
+   def attendance_count(self, class_id, generation=None):
+       """Number of rows in the class's list (the current one unless generation is given)."""
+       generation_sql, generation_params = self._generation(class_id, generation)
+       with self.read() as conn:
+           return self.execute(
+               conn, f"SELECT COUNT(*) FROM attendance WHERE class_id = ? AND generation = {generation_sql}",
+               (class_id,) + generation_params
+           ).fetchone()[0]
+
+   def last_registration(self, class_id, generation):
+       """registered_at of the latest row of a closed generation, or None if it has no rows left."""
+       with self.read() as conn:
+           return self.execute(
+               conn, "SELECT MAX(registered_at) FROM attendance WHERE class_id = ? AND generation = ?", (class_id, generation)
+           ).fetchone()[0]
+
+   def has_attendance(self, class_id, generation=None):
+       generation_sql, generation_params = self._generation(class_id, generation)
+       with self.read() as conn:
+           return self.execute(
+               conn, f"SELECT 1 FROM attendance WHERE class_id = ? AND generation = {generation_sql} LIMIT 1",
+               (class_id,) + generation_params
+           ).fetchone() is not None
+
+   def iter_attendance_chunks(self, class_id, chunk_size, generation=None):
+       """Stream a class's (nome, email, registered_at) rows in fixed-size chunks."""
+       generation_sql, generation_params = self._generation(class_id, generation)
+       with self.read() as conn:
+           cursor = self.execute(
+               conn,
+               f"SELECT nome, email, registered_at FROM attendance WHERE class_id = ? AND generation = {generation_sql} ORDER BY id",
+               (class_id,) + generation_params
+           )
+           while True:
+               rows = cursor.fetchmany(chunk_size)
+               if not rows:
+                   break
+               yield rows
+
+   def enqueue_email(self, recipient, subject, body, next_attempt_at, dedupe_key=None, class_id=None):
+       """Persist an outgoing message; returns its outbox id, or None if dedupe_key was already queued."""
+       with self.write() as conn:
+           result = self.execute(conn, """
+               INSERT INTO email_outbox (recipient, subject, body, next_attempt_at, dedupe_key, class_id) 
+               VALUES (?, ?, ?, ?, ?, ?)
+               ON CONFLICT DO NOTHING
+               RETURNING id
+           """, (recipient, subject, body, next_attempt_at, dedupe_key, class_id)).fetchone()
+       return result[0] if result else None
+
+   def claim_email(self, now, lease):
+       """Claim the oldest due message for this worker; (id, recipient, subject, body, attempts), or None.
+
+       The message turns 'sending' until now + lease, so the outbox workers of other
+       processes skip it; a claim whose worker died before reporting expires and is
+       taken again. The outer WHERE is re-checked on rows another worker just claimed,
+       so two concurrent claims never return the same message.
+       """
+       with self.write() as conn:
+           return self.execute(conn, """
+               UPDATE email_outbox SET status = 'sending', next_attempt_at = ?
+               WHERE id = (
+                   SELECT id FROM email_outbox WHERE status IN ('pending', 'sending') AND next_attempt_at <= ?
+                   ORDER BY id LIMIT 1
+               ) AND status IN ('pending', 'sending') AND next_attempt_at <= ?
+               RETURNING id, recipient, subject, body, attempts
+           """, (now + lease, now, now)).fetchone()
+
+   def next_email_due(self):
+       """Earliest next_attempt_at of the pending (or claimed) messages, or None."""
+       with self.read() as conn:
+           return self.execute(
+               conn, "SELECT MIN(next_attempt_at) FROM email_outbox WHERE status IN ('pending', 'sending')"
+           ).fetchone()[0]
+
+   def email_retry(self, message_id, status, attempts, next_attempt_at, error):
+       with self.write() as conn:
+           self.execute(conn, """
+               UPDATE email_outbox SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ? 
+               WHERE id = ?
+           """, (status, attempts, next_attempt_at, error, message_id))
+
+   def email_delivered(self, message_id, status, attempts):
+       with self.write() as conn:
+           self.execute(conn, """
+               UPDATE email_outbox SET status = ?, attempts = ?, last_error = NULL, sent_at = CURRENT_TIMESTAMP 
+               WHERE id = ?
+           """, (status, attempts, message_id))
+
+   def last_email_status(self, class_id):
+       """(status, attempts, last_error) of the class's most recent list email, or None."""
+       with self.read() as conn:
+           return self.execute(
+               conn, "SELECT status, attempts, last_error FROM email_outbox WHERE class_id = ? ORDER BY id DESC LIMIT 1", (class_id,)
+           ).fetchone()
+
+class SQLiteStorage(Storage):
+   """Default backend: a local SQLite file in WAL mode, for a single app process."""
+
+   def __init__(self, path):
+       self.pool = ConnectionPool(path)
+       self.read = self.pool.read
+       self.write = self.pool.write
+
+   def migrate(self):
+       """Apply pending migrations, each in its own transaction; returns the schema version."""
+       with self.read() as conn:
+           if conn.execute('PRAGMA user_version').fetchone()[0] >= len(MIGRATIONS):
+               return len(MIGRATIONS)
+       for version, migration in enumerate(MIGRATIONS, start=1):
+           with self.write() as conn:
+               # BEGIN IMMEDIATE takes the database write lock, so concurrent processes
+               # re-read user_version and skip migrations another one just applied
+               conn.execute('BEGIN IMMEDIATE')
+               if conn.execute('PRAGMA user_version').fetchone()[0] >= version:
+                   continue
+               migration(conn)
+               conn.execute(f'PRAGMA user_version = {version}')
+       return len(MIGRATIONS)
+
+   def set_trace_callback(self, callback):
+       self.pool.set_trace_callback(callback)
+
+   def stats(self):
+       return self.pool.stats()
+
+class PostgresStorage(Storage):
+   """Shared PostgreSQL database through a psycopg connection pool, so several app replicas can run."""
+
+   shared = True
+   # Any constant works; it only has to be the same in every replica
+   MIGRATION_LOCK = 0x6c697374
+
+   def __init__(self, url, max_size=10):
+       from psycopg_pool import ConnectionPool as PgConnectionPool
+       self.pool = PgConnectionPool(url, min_size=1, max_size=max_size, open=True, name="listapp")
+       self._trace_callback = None
+
+   @contextmanager
+   def read(self):
+       with self.pool.connection() as conn:
+           yield conn
+
+   @contextmanager
+   def write(self):
+       """Check out a connection; the pool commits on success and rolls back on error."""
+       with self.pool.connection() as conn:
+           yield conn
+
+   def execute(self, conn, sql, params=()):
+       if self._trace_callback is not None:
+           self._trace_callback(sql)
+       return conn.execute(sql.replace('?', '%s'), params)
+
+   def executemany(self, conn, sql, rows):
+       if self._trace_callback is not None:
+           self._trace_callback(sql)
+       with conn.cursor() as cursor:
+           cursor.executemany(sql.replace('?', '%s'), rows)
+
+   def iter_attendance_chunks(self, class_id, chunk_size, generation=None):
+       """Stream rows through a server-side cursor, so exports never hold the whole class in memory."""
+       generation_sql, generation_params = self._generation(class_id, generation)
+       with self.read() as conn:
+           with conn.cursor(name=f"export_{uuid.uuid4().hex}") as cursor:
+               cursor.execute(
+                   f"SELECT nome, email, registered_at FROM attendance WHERE class_id = %s AND generation = {generation_sql} "
+                   "ORDER BY id".replace('?', '%s'),
+                   (class_id,) + generation_params
+               )
+               while True:
+                   rows = cursor.fetchmany(chunk_size)
+                   if not rows:
+                       break
+                   yield rows
+
+   def migrate(self):
+       """Apply pending migrations in one transaction, serialized across replicas by an advisory lock."""
+       with self.write() as conn:
+           conn.execute("SELECT pg_advisory_xact_lock(%s)", (self.MIGRATION_LOCK,))
+           conn.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)")
+           result = conn.execute("SELECT version FROM schema_version").fetchone()
+           version = result[0] if result else 0
+           for migration in POSTGRES_MIGRATIONS[version:]:
+               migration(conn)
+           if result is None:
+               conn.execute("INSERT INTO schema_version (version) VALUES (%s)", (len(POSTGRES_MIGRATIONS),))
+           else:
+               conn.execute("UPDATE schema_version SET version = %s", (len(POSTGRES_MIGRATIONS),))
+       return len(POSTGRES_MIGRATIONS)
+
+   def set_trace_callback(self, callback):
+       self._trace_callback = callback
+
+   def stats(self):
+       """Pool statistics in the same shape as the SQLite pool's."""
+       stats = self.pool.get_stats()
+       return {
+           'checkouts': stats.get('requests_num', 0),
+           'waits': stats.get('requests_queued', 0),
+           'opened': stats.get('connections_num', 0),
+           'open_connections': stats.get('pool_size', 0),
+       }
+
+@st.cache_resource
+def get_storage():
+   """Process-wide storage backend: PostgreSQL when database_url (or DATABASE_URL) is set, else SQLite."""
+   database_url = get_setting("database_url", os.environ.get('DATABASE_URL'))
+   if database_url:
+       storage = PostgresStorage(database_url, max_size=int(get_setting("database_pool_size", 10)))
+   else:
+       storage = SQLiteStorage(DB_PATH)
+   if tracer.enabled:
+       storage.set_trace_callback(tracer.on_statement)
+   return storage
+
+@st.cache_resource
+def ensure_schema():
+   """Run migrations once per process; failures are not cached, so the next rerun retries."""
+   return get_storage().migrate()
+
+@traced('db.init_database')
+def init_database():
+   """Initialize database schema; after the first call of the process this does no SQL at all."""
+   try:
+       ensure_schema()
+   except Exception as e:
+       st.error(f"Database initialization error: {e}")
+
+@traced('db.get_class_id')
+def get_class_id(class_name, create=False):
+   """Resolve a class name to its id (cached); creates the class when create=True."""
+   class_ids = get_class_ids()
+   class_id = class_ids.get(class_name)
+   if class_id is not None:
+       return class_id
+   class_id = get_storage().find_class(class_name)
+   if class_id is None and create:
+       class_id = get_storage().create_class(class_name)
+   if class_id is None:
+       return None
+   # Class ids never change, so the mapping can be cached for the life of the process
+   class_ids[class_name] = class_id
+   return class_id
+
+@st.cache_resource
+def get_class_ids():
+   """Process-wide class name -> id mapping."""
+   return {DEFAULT_CLASS_NAME: DEFAULT_CLASS_ID}
+
+def get_current_class_name():
+   """Class selected via the ?turma= query parameter."""
+   return (st.query_params.get("turma") or DEFAULT_CLASS_NAME).strip()[:50] or DEFAULT_CLASS_NAME
+
+def current_class_id():
+   """Class id of this session; None while the requested class has not been created yet."""
+   return st.session_state.get('class_id', DEFAULT_CLASS_ID)
+
+BRAZIL_TZ = pytz.timezone('America/Sao_Paulo')
+WEEKDAYS = ('Segunda-feira', 'Terça-feira', 'Quarta-feira', 'Quinta-feira', 'Sexta-feira', 'Sábado', 'Domingo')
+
+@functools.lru_cache(maxsize=4096)
+def format_brazil_datetime(epoch):
+   """Format epoch seconds as 'Weekday, dd/mm/YYYY HH:MM:SS' in São Paulo time (memoized per second)."""
+   moment = datetime.datetime.fromtimestamp(epoch, BRAZIL_TZ)
+   return f"{WEEKDAYS[moment.weekday()]}, {moment.strftime('%d/%m/%Y %H:%M:%S')}"
+
+def parse_brazil_datetime(text):
+   """Epoch seconds of a format_brazil_datetime string, or None if it does not parse."""
+   try:
+       moment = datetime.datetime.strptime(text.split(', ', 1)[1], '%d/%m/%Y %H:%M:%S')
+   except (AttributeError, IndexError, ValueError):
+       return None
+   return int(BRAZIL_TZ.localize(moment).timestamp())
 
 def get_brazil_datetime():
    """Get current date and time in Brazilian format."""
-   brazil_tz = pytz.timezone('America/Sao_Paulo')
-   now = datetime.datetime.now(brazil_tz)
-   weekdays = {
-       0: 'Segunda-feira',
-       1: 'Terça-feira',
-       2: 'Quarta-feira',
-       3: 'Quinta-feira',
-       4: 'Sexta-feira',
-       5: 'Sábado',
-       6: 'Domingo'
-   }
-   weekday = weekdays[now.weekday()]
-   return f"{weekday}, {now.strftime('%d/%m/%Y %H:%M:%S')}"
+   return format_brazil_datetime(int(time.time()))
 
 def initialize_session_state():
    """Initialize all session state variables with thread safety."""
    if 'session_id' not in st.session_state:
        st.session_state.session_id = str(uuid.uuid4())
    
-   if 'registros' not in st.session_state:
-       st.session_state.registros = load_attendance_data()
+   # The class can change between reruns through the ?turma= query parameter
+   st.session_state.class_name = get_current_class_name()
+   st.session_state.class_id = get_class_id(st.session_state.class_name)
+   
 
    if 'timer_started' not in st.session_state:
        st.session_state.timer_started = False
@@ -184,146 +1306,725 @@ def initialize_session_state():
    if 'botao_clicado' not in st.session_state:
        st.session_state.botao_clicado = None
 
-   if 'captcha_pergunta' not in st.session_state:
-       st.session_state.captcha_pergunta = None
+   if 'captcha_pergunta' not in st.session_state:
+       st.session_state.captcha_pergunta = None
+
+   if 'captcha_resposta' not in st.session_state:
+       st.session_state.captcha_resposta = None
+       
+   if 'browser_fingerprint' not in st.session_state:
+       st.session_state.browser_fingerprint = None
+
+class RosterEntry:
+   """One registered student; __slots__ keeps large classes compact in memory."""
+
+   __slots__ = ('id', 'nome', 'email', 'registered_at', 'fingerprint')
+
+   def __init__(self, id, nome, email, registered_at, fingerprint=None):
+       self.id = id
+       self.nome = nome
+       self.email = email
+       self.registered_at = registered_at
+       self.fingerprint = fingerprint
+
+def roster_sort_key(entry):
+   return (entry.nome, entry.email)
+
+class RosterSnapshot:
+   """Read-only, versioned view of a class's roster, shared by every session of the process.
+
+   Sessions keep no copy of the roster: each rerun takes the current snapshot, and
+   rendered pages are cached on the snapshot, so they go away with it.
+   """
+
+   __slots__ = ('class_id', 'version', 'entries', '_pages')
+
+   MAX_PAGES = 256
+
+   def __init__(self, class_id, version, entries):
+       self.class_id = class_id
+       self.version = version
+       self.entries = entries
+       self._pages = {}
+
+   def page(self, query="", page=1):
+       """(matches, HTML) of one page of the name-sorted roster, filtered by query."""
+       key = (query, page)
+       fragment = self._pages.get(key)
+       if fragment is None:
+           rows = self.entries
+           if query:
+               rows = [entry for entry in rows if query.casefold() in entry.nome.casefold()]
+           start = (page - 1) * ROSTER_PAGE_SIZE
+           fragment = (len(rows), build_roster_html(rows[start:start + ROSTER_PAGE_SIZE]))
+           if len(self._pages) >= self.MAX_PAGES:
+               # Searches are free text; keep the cache from growing without bound
+               self._pages.clear()
+           self._pages[key] = fragment
+       return fragment
+
+class RosterIndex:
+   """A class's students in memory: email and fingerprint sets plus a name-sorted list.
+
+   Registrations and resets made by this process are written through; rows written
+   elsewhere are picked up by refresh(), which only fetches ids newer than last_id.
+   last_id only moves with rows read back from the database: a write-through id says
+   nothing about lower ids other replicas may have committed meanwhile. generation is
+   the list the index holds, so a write-through that loses a race with a rotation
+   never lands in the wrong list.
+   """
+
+   def __init__(self, class_id, sync_interval=None):
+       self.class_id = class_id
+       self.sync_interval = sync_interval
+       self.entries = []
+       self.emails = set()
+       self.fingerprints = set()
+       self.last_id = 0
+       self.first_id = None
+       self.generation = None
+       self.version = 0
+       self._lock = threading.Lock()
+       self._snapshot = RosterSnapshot(class_id, None, ())
+       self._synced_at = None
+       self._synced_version = None
+
+   def _clear(self):
+       self.entries = []
+       self.emails = set()
+       self.fingerprints = set()
+       self.last_id = 0
+       self.version += 1
+
+   def _insert(self, entry):
+       if entry.email in self.emails:
+           return False
+       bisect.insort(self.entries, entry, key=roster_sort_key)
+       self.emails.add(entry.email)
+       if entry.fingerprint:
+           self.fingerprints.add(entry.fingerprint)
+       return True
+
+   def add(self, entry, generation):
+       """Write-through of a row this process just committed to the given generation.
+
+       A row of a list rotated away meanwhile is dropped; a row of a newer list means
+       the rotation has not reached this index yet, so it starts over at that list.
+       """
+       with self._lock:
+           if self.generation is not None and generation < self.generation:
+               return
+           if self.generation is not None and generation > self.generation:
+               self._clear()
+               self.first_id = None
+           self.generation = generation
+           if self.first_id is None:
+               self.first_id = entry.id
+           if self._insert(entry):
+               self.version += 1
+
+   def reset(self, generation):
+       """Write-through of a rotation to generation; a no-op if add() already moved the index there."""
+       with self._lock:
+           if self.generation is not None and self.generation >= generation:
+               return
+           self._clear()
+           self.first_id = None
+           self.generation = generation
+
+   def contains(self, email, fingerprint=None):
+       """O(1) duplicate check against the email and fingerprint sets."""
+       return email in self.emails or bool(fingerprint and fingerprint in self.fingerprints)
+
+   @traced('db.roster_refresh')
+   def refresh(self):
+       """Merge rows newer than last_id from the database; start over if the list was reset."""
+       storage = get_storage()
+       with self._lock:
+           generation = storage.current_generation(self.class_id)
+           first_id = storage.attendance_first_id(self.class_id, generation)
+           if generation != self.generation or first_id != self.first_id:
+               # The list was rotated, rows were written before the first write-through, or this is the first load
+               self._clear()
+               self.first_id = first_id
+               self.generation = generation
+           new_rows = storage.attendance_since(self.class_id, self.last_id, generation)
+           inserted = [self._insert(RosterEntry(*row)) for row in new_rows]
+           if storage.shared and storage.attendance_count(self.class_id, generation) > len(self.entries):
+               # Another replica committed an id below last_id after it was read (ids are
+               # drawn before commit), so rows are missing: read the whole list again
+               new_rows = storage.attendance_since(self.class_id, 0, generation)
+               inserted += [self._insert(RosterEntry(*row)) for row in new_rows]
+           tracer.add_rows(len(new_rows))
+           if new_rows:
+               self.last_id = max(self.last_id, new_rows[-1][0])
+           if any(inserted):
+               self.version += 1
+           self._synced_at = time.monotonic()
+
+   def sync(self):
+       """Load the class on first use; later, only catch up every sync_interval seconds (if set).
+
+       sync_interval is set for shared databases, where the index also catches up as soon
+       as the class_state version or roster_version moves, i.e. another replica wrote to the class.
+       """
+       if self.sync_interval is not None:
+           state = load_class_state_snapshot(self.class_id)
+           version = state.version, state.roster_version
+       else:
+           version = None
+       if self._synced_at is None or version != self._synced_version or (
+           self.sync_interval is not None and time.monotonic() - self._synced_at >= self.sync_interval
+       ):
+           self._synced_version = version
+           self.refresh()
+       return self
+
+   def snapshot(self):
+       """The current RosterSnapshot; entries are copied once per version rather than once per rerun."""
+       with self._lock:
+           if self._snapshot.version != self.version:
+               self._snapshot = RosterSnapshot(self.class_id, self.version, tuple(self.entries))
+           return self._snapshot
+
+class RosterIndexes:
+   """Process-wide RosterIndex per class."""
+
+   def __init__(self, sync_interval=None):
+       self.sync_interval = sync_interval
+       self._lock = threading.Lock()
+       self._indexes = {}
+
+   def get(self, class_id):
+       with self._lock:
+           index = self._indexes.get(class_id)
+           if index is None:
+               index = self._indexes[class_id] = RosterIndex(class_id, self.sync_interval)
+           return index
+
+@st.cache_resource
+def get_roster_indexes():
+   """Roster indexes shared by every session. With a shared database (other replicas
+   write too) each index also catches up with the database every few seconds."""
+   return RosterIndexes(CHANGE_POLL_SECONDS if get_storage().shared else None)
+
+def load_roster(class_id=None):
+   """This class's roster index, loaded from the database on first use."""
+   index = get_roster_indexes().get(class_id or current_class_id())
+   try:
+       return index.sync()
+   except Exception as e:
+       st.error(f"Error loading attendance data: {e}")
+       return index
+
+ROSTER_PAGE_SIZE = 50
+
+def build_roster_html(rows):
+   """Render roster rows as a single HTML block."""
+   items = "".join(
+       f"<li><strong>{escape(entry.nome)}</strong><br><small>{format_brazil_datetime(entry.registered_at)}</small></li>"
+       for entry in rows
+   )
+   return f"<ul class='roster'>{items}</ul>"
+
+@traced('render.roster')
+def display_roster(snapshot):
+   """Display the sidebar roster as one element, with search and pagination."""
+   query = st.text_input("Buscar aluno", key="roster_search", placeholder="Nome").strip()
+   matches, fragment = snapshot.page(query, 1)
+   # Pages of the search results, not of the whole list
+   total_pages = max(1, -(-matches // ROSTER_PAGE_SIZE))
+   if total_pages > 1:
+       # A narrower search (or a rotated list) can leave the selected page past the end
+       if st.session_state.get('roster_page', 1) > total_pages:
+           st.session_state.roster_page = total_pages
+       page = st.number_input("Página", min_value=1, max_value=total_pages, step=1, key="roster_page")
+       if page > 1:
+           matches, fragment = snapshot.page(query, int(page))
+   
+   if query and not matches:
+       st.write("Nenhum aluno encontrado.")
+   else:
+       st.markdown(fragment, unsafe_allow_html=True)
+
+ClassState = namedtuple(
+   'ClassState',
+   ['aula_iniciada', 'timer_end_time', 'ip_professor', 'session_id', 'checkin_key', 'version', 'roster_version'],
+   defaults=(False, None, None, None, None, 0, 0)
+)
+
+@traced('db.class_state')
+def query_class_state(class_id):
+   """Read a class's whole class_state row in a single query."""
+   result = get_storage().get_class_state(class_id)
+   if result is None:
+       # If no record exists, class is not started
+       return ClassState()
+   timer_end_time = datetime.datetime.fromisoformat(result[1]) if result[1] else None
+   return ClassState(bool(result[0]), timer_end_time, result[2], result[3], result[4], result[5], result[6])
+
+class ClassStateCache:
+   """Process-wide ClassState snapshots per class, reloaded at most once per TTL window."""
+
+   def __init__(self, ttl):
+       self.ttl = ttl
+       self._lock = threading.Lock()
+       self._snapshots = {}
+
+   def get(self, class_id):
+       with self._lock:
+           snapshot, loaded_at = self._snapshots.get(class_id, (None, 0.0))
+           if snapshot is None or time.monotonic() - loaded_at >= self.ttl:
+               snapshot = query_class_state(class_id)
+               self._snapshots[class_id] = (snapshot, time.monotonic())
+           return snapshot
+
+   def invalidate(self, class_id):
+       with self._lock:
+           self._snapshots.pop(class_id, None)
+
+@st.cache_resource
+def get_class_state_cache():
+   """Class state cache shared by every session."""
+   return ClassStateCache(float(get_setting("class_state_ttl", 0.25)))
+
+def load_class_state_snapshot(class_id=None):
+   """Load the cached class state snapshot with proper error handling."""
+   class_id = class_id or current_class_id()
+   if class_id is None:
+       return ClassState()
+   try:
+       return get_class_state_cache().get(class_id)
+   except Exception:
+       # On error, assume class is not started for safety
+       return ClassState()
+
+def invalidate_class_state(class_id=None):
+   """Drop the cached snapshot so the next read sees the latest write."""
+   get_class_state_cache().invalidate(class_id or current_class_id())
+
+def load_class_state():
+   """Load class state from the shared snapshot."""
+   return load_class_state_snapshot().aula_iniciada
+
+def load_timer_state():
+   """Load timer state from the shared snapshot."""
+   return load_class_state_snapshot().timer_end_time
+
+def load_professor_ip():
+   """Load professor IP from the shared snapshot."""
+   return load_class_state_snapshot().ip_professor
+
+CHANGE_POLL_SECONDS = 2
+
+class ChangeNotifier:
+   """Per-class version counters of this process, bumped when a class starts, closes or
+   changes its timer, i.e. whenever every page watching it must rerun.
+
+   New registrations do not count: they reach the roster panel through the roster index.
+   Replicas sharing a database do not see these; class_version adds class_state.version for them.
+   """
+
+   def __init__(self):
+       self._lock = threading.Lock()
+       self._versions = {}
+
+   def version(self, class_id):
+       with self._lock:
+           return self._versions.get(class_id, 0)
+
+   def bump(self, class_id):
+       with self._lock:
+           self._versions[class_id] = self._versions.get(class_id, 0) + 1
+           return self._versions[class_id]
+
+@st.cache_resource
+def get_change_notifier():
+   """Process-wide change notifier shared by every session."""
+   return ChangeNotifier()
+
+def class_version(class_id=None):
+   """What watch_for_changes compares: this process's change counter and, when other
+   replicas write to the same database, the class_state version too."""
+   class_id = class_id or current_class_id()
+   version = get_change_notifier().version(class_id)
+   if get_storage().shared:
+       return version, load_class_state_snapshot(class_id).version
+   return version
+
+def notify_class_changed(class_id=None):
+   """Tell every session watching the class to rerun."""
+   get_change_notifier().bump(class_id or current_class_id())
+
+EMAIL_STATUS_LABELS = {
+   'pending': "pendente",
+   'sending': "enviando",
+   'sent': "enviado",
+   'simulated': "simulado (configuração de email não encontrada)",
+   'failed': "falhou",
+}
+
+def get_smtp_settings():
+   """Read SMTP settings from secrets; a custom smtp_host (e.g. a local test server) needs no login."""
+   sender_email = get_setting("email", "seu_email@gmail.com")
+   app_password = get_setting("senha_email", "sua_senha_de_app")
+   has_credentials = sender_email != "seu_email@gmail.com" and app_password != "sua_senha_de_app"
+   smtp_host = get_setting("smtp_host")
+   return {
+       'host': smtp_host or 'smtp.gmail.com',
+       'port': int(get_setting("smtp_port", 587)),
+       'starttls': get_flag("smtp_starttls", True),
+       'login': (sender_email, app_password) if has_credentials else None,
+       'configured': has_credentials or smtp_host is not None,
+   }
+
+class EmailOutbox:
+   """Delivers queued emails from the email_outbox table on a background thread."""
+
+   def __init__(self, storage, settings, max_attempts=5, base_delay=5.0, max_delay=300.0, idle_timeout=60.0,
+                claim_lease=300.0):
+       self.storage = storage
+       self.settings = settings
+       self.max_attempts = max_attempts
+       self.base_delay = base_delay
+       self.max_delay = max_delay
+       self.idle_timeout = idle_timeout
+       # Well above the SMTP timeout, so a live worker always reports before its claim expires
+       self.claim_lease = claim_lease
+       self._smtp = None
+       self._smtp_used_at = 0.0
+       self._wake = threading.Event()
+       self._thread = threading.Thread(target=self._run, name="email-outbox", daemon=True)
+       self._thread.start()
+
+   def enqueue(self, recipient, subject, body, dedupe_key=None, class_id=None):
+       """Persist a message for delivery and wake the worker; returns the outbox id (None for a duplicate key)."""
+       message_id = self.storage.enqueue_email(recipient, subject, body, time.time(), dedupe_key, class_id)
+       self._wake.set()
+       return message_id
+
+   def _run(self):
+       while True:
+           try:
+               delay = self._deliver_due()
+           except Exception:
+               logger.exception("Email outbox pass failed")
+               delay = self.base_delay
+           self._wake.wait(timeout=delay)
+           self._wake.clear()
+
+   def _deliver_due(self):
+       """Send every message that is due; return the seconds until the next retry.
+
+       Messages are claimed one at a time, so with several processes on one database
+       each message is sent by exactly one of them.
+       """
+       while (message := self.storage.claim_email(time.time(), self.claim_lease)) is not None:
+           self._deliver(*message)
+       
+       if self._smtp is not None and time.monotonic() - self._smtp_used_at >= self.idle_timeout:
+           self._close_smtp()
+       
+       next_attempt_at = self.storage.next_email_due()
+       if next_attempt_at is None:
+           return self.idle_timeout
+       return min(self.idle_timeout, max(0.0, next_attempt_at - time.time()))
+
+   def _deliver(self, message_id, recipient, subject, body, attempts):
+       attempts += 1
+       try:
+           status = self._send(recipient, subject, body)
+       except Exception as e:
+           self._close_smtp()
+           # Exponential backoff between retries, giving up after max_attempts
+           failed = attempts >= self.max_attempts
+           delay = min(self.base_delay * 2 ** (attempts - 1), self.max_delay)
+           # The error stays out of the page for visitors, so operators find it here
+           logger.warning("Email %s failed (attempt %s of %s): %s", message_id, attempts, self.max_attempts, e)
+           self.storage.email_retry(message_id, 'failed' if failed else 'pending', attempts, time.time() + delay, str(e))
+           return
+       self.storage.email_delivered(message_id, status, attempts)
+
+   def _send(self, recipient, subject, body):
+       if not self.settings['configured']:
+           return 'simulated'
+       # Imported here so app start-up does not pay for the email package
+       from email.mime.multipart import MIMEMultipart
+       from email.mime.text import MIMEText
+       message = MIMEMultipart()
+       message['From'] = "sistema@listadechamada.com"
+       message['To'] = recipient
+       message['Subject'] = subject
+       message.attach(MIMEText(body, 'html'))
+       self._connection().send_message(message)
+       self._smtp_used_at = time.monotonic()
+       return 'sent'
+
+   def _connection(self):
+       """Reuse the open SMTP connection while the server still answers NOOP."""
+       import smtplib
+       if self._smtp is not None:
+           try:
+               if self._smtp.noop()[0] == 250:
+                   return self._smtp
+           except (smtplib.SMTPException, OSError):
+               pass
+           self._close_smtp()
+       smtp = smtplib.SMTP(self.settings['host'], self.settings['port'], timeout=30)
+       if self.settings['starttls']:
+           smtp.starttls()
+       if self.settings['login']:
+           smtp.login(*self.settings['login'])
+       self._smtp = smtp
+       return smtp
+
+   def _close_smtp(self):
+       import smtplib
+       if self._smtp is not None:
+           try:
+               self._smtp.quit()
+           except (smtplib.SMTPException, OSError):
+               pass
+           self._smtp = None
+
+@st.cache_resource
+def get_email_outbox():
+   """Process-wide email delivery worker."""
+   return EmailOutbox(get_storage(), get_smtp_settings())
+
+@traced('render.email_status')
+def display_email_status():
+   """Show the delivery state of this class's most recent list email.
+
+   The SMTP error can quote the server's replies, so only a session that entered
+   the professor password sees it.
+   """
+   try:
+       result = get_storage().last_email_status(current_class_id())
+   except Exception:
+       return
+   if result is None:
+       return
+   status, attempts, last_error = result
+   label = f"📧 Último email da lista: {EMAIL_STATUS_LABELS.get(status, status)}"
+   if status == 'pending' and attempts:
+       label += f" (tentativa {attempts + 1})"
+   if last_error and st.session_state.senha_correta:
+       label += f" — {last_error}"
+   st.caption(label)
+
+EXPORT_COLUMNS = ['Nome', 'Email', 'Data_Hora']
+EXPORT_CHUNK_SIZE = 1000
+# A prepared export larger than this waits for its download on disk rather than in memory
+EXPORT_SPOOL_BYTES = 1024 * 1024
+
+def write_csv(chunks, fileobj):
+   """Write chunks as UTF-8 CSV into a binary file object."""
+   text = io.TextIOWrapper(fileobj, encoding='utf-8', newline='')
+   writer = csv.writer(text, lineterminator='\n')
+   writer.writerow(EXPORT_COLUMNS)
+   for rows in chunks:
+       writer.writerows(rows)
+   text.flush()
+   text.detach()
+
+def write_csv_gz(chunks, fileobj):
+   """Write chunks as gzip-compressed CSV."""
+   with gzip.GzipFile(fileobj=fileobj, mode='wb') as compressed:
+       write_csv(chunks, compressed)
+
+def write_parquet(chunks, fileobj):
+   """Write each chunk as a Parquet row group."""
+   import pyarrow as pa
+   import pyarrow.parquet as pq
+   schema = pa.schema([(column, pa.string()) for column in EXPORT_COLUMNS])
+   with pq.ParquetWriter(fileobj, schema) as writer:
+       for rows in chunks:
+           writer.write_table(pa.Table.from_arrays([pa.array(column) for column in zip(*rows)], schema=schema))
+
+def write_xlsx(chunks, fileobj):
+   """Write chunks with openpyxl's streaming (write-only) workbook."""
+   from openpyxl import Workbook
+   workbook = Workbook(write_only=True)
+   sheet = workbook.create_sheet("Lista de Presença")
+   sheet.append(EXPORT_COLUMNS)
+   for rows in chunks:
+       for row in rows:
+           sheet.append(row)
+   workbook.save(fileobj)
+
+# format -> (file extension, MIME type, writer, optional module it needs)
+EXPORT_FORMATS = {
+   'CSV': ('csv', 'text/csv', write_csv, None),
+   'CSV (gzip)': ('csv.gz', 'application/gzip', write_csv_gz, None),
+   'Parquet': ('parquet', 'application/vnd.apache.parquet', write_parquet, 'pyarrow'),
+   'Excel (XLSX)': ('xlsx', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', write_xlsx, 'openpyxl'),
+}
+
+def available_export_formats():
+   """Export formats whose optional dependency is installed."""
+   return [name for name, (_, _, _, module) in EXPORT_FORMATS.items()
+           if module is None or importlib.util.find_spec(module) is not None]
+
+@traced('db.export_attendance')
+def export_attendance(export_format, fileobj, class_id=None, on_chunk=None, generation=None):
+   """Stream a class's list (the current one unless generation is given) into fileobj.
+
+   on_chunk sees every chunk on the way. Returns the row count.
+   """
+   class_id = class_id or current_class_id()
+   writer = EXPORT_FORMATS[export_format][2]
+   total = 0
+   
+   def chunks():
+       nonlocal total
+       for rows in get_storage().iter_attendance_chunks(class_id, EXPORT_CHUNK_SIZE, generation):
+           # Data_Hora keeps its original text format in every export
+           rows = [(nome, email, format_brazil_datetime(registered_at)) for nome, email, registered_at in rows]
+           total += len(rows)
+           if on_chunk:
+               on_chunk(rows)
+           yield rows
+   
+   writer(chunks(), fileobj)
+   tracer.add_rows(total)
+   return total
+
+def build_attendance_table_rows(rows):
+   """HTML table rows for the attendance email."""
+   return "".join(
+       "<tr>" + "".join(f"<td>{escape(value)}</td>" for value in row) + "</tr>"
+       for row in rows
+   )
+
+def drop_export_file():
+   """Release this session's prepared export, if any."""
+   prepared = st.session_state.pop('export_file', None)
+   if prepared is not None:
+       prepared[1].close()
+
+@traced('render.export')
+def display_export_download():
+   """Let the professor download the current list in any available format.
 
-   if 'captcha_resposta' not in st.session_state:
-       st.session_state.captcha_resposta = None
-       
-   if 'browser_fingerprint' not in st.session_state:
-       st.session_state.browser_fingerprint = None
+   The prepared file is keyed by class, list generation, roster version and format: it
+   is dropped once downloaded, or as soon as the list gains a row or is rotated, so the
+   button never serves an earlier list.
+   """
+   export_format = st.selectbox("Exportar lista", available_export_formats(), key="export_format")
+   roster = load_roster()
+   key = (current_class_id(), roster.generation, roster.version, export_format)
+   if st.button("Preparar arquivo", key="btn_export", use_container_width=True):
+       drop_export_file()
+       export = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_BYTES)
+       try:
+           export_attendance(export_format, export)
+       except Exception as e:
+           export.close()
+           st.error(f"Erro ao exportar lista: {e}")
+           return
+       st.session_state.export_file = (key, export)
+   
+   prepared = st.session_state.get('export_file')
+   if prepared is not None and prepared[0] != key:
+       drop_export_file()
+   elif prepared is not None:
+       export = prepared[1]
+       export.seek(0)
+       extension, mime = EXPORT_FORMATS[export_format][:2]
+       timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+       st.download_button(
+           "Baixar lista",
+           data=export.read(),
+           file_name=f"lista_presenca_{timestamp}.{extension}",
+           mime=mime,
+           key="btn_download",
+           on_click=drop_export_file,
+           use_container_width=True
+       )
 
-def load_attendance_data():
-   """Load attendance data from database with error handling."""
-   try:
-       conn = get_db_connection()
-       df = pd.read_sql_query("SELECT nome as Nome, email as Email, data_hora as Data_Hora FROM attendance ORDER BY created_at", conn)
-       conn.close()
-       return df
-   except Exception as e:
-       st.error(f"Error loading attendance data: {e}")
-       return pd.DataFrame(columns=['Nome', 'Email', 'Data_Hora'])
+BACKUP_PREFIX = 'lista_presenca_'
+BACKUP_TIMESTAMP = '%Y%m%d_%H%M%S'
 
-def load_class_state():
-   """Load class state from database with proper error handling."""
-   try:
-       conn = get_db_connection()
-       cursor = conn.execute("SELECT aula_iniciada FROM class_state WHERE id = 1")
-       result = cursor.fetchone()
-       conn.close()
-       # FIX: Ensure we return the actual database state
-       if result is not None:
-           return bool(result[0])
-       else:
-           # If no record exists, class is not started
-           return False
-   except Exception as e:
-       # On error, assume class is not started for safety
-       return False
+def backup_class_slug(class_name):
+   """class_name reduced to a safe file name part: no path separators, no leading dots."""
+   return re.sub(r'[^\w.-]+', '-', class_name).strip('.-') or 'turma'
 
-def load_timer_state():
-   """Load timer state from database."""
-   try:
-       conn = get_db_connection()
-       cursor = conn.execute("SELECT timer_end_time FROM class_state WHERE id = 1")
-       result = cursor.fetchone()
-       conn.close()
-       if result and result[0]:
-           return datetime.datetime.fromisoformat(result[0])
+def get_backup_filename(class_name, moment, generation=None):
+   """lista_presenca_[<turma>_]<timestamp>[_lista<generation>].csv, the name of a closed list's CSV backup.
+
+   ?turma= is user input, so the class name goes through backup_class_slug first. The
+   generation keeps two lists of a class closed within the same second apart.
+   """
+   stem = moment.strftime(BACKUP_TIMESTAMP)
+   if class_name != DEFAULT_CLASS_NAME:
+       stem = f'{backup_class_slug(class_name)}_{stem}'
+   if generation is not None:
+       stem = f'{stem}_lista{generation}'
+   return f'{BACKUP_PREFIX}{stem}.csv'
+
+def parse_backup_filename(path):
+   """(class_name, closed_at epoch) encoded in a backup's file name, or None if it is not one."""
+   name = os.path.basename(path)
+   if not (name.startswith(BACKUP_PREFIX) and name.endswith('.csv')):
        return None
-   except Exception:
+   stem = re.sub(r'_lista\d+$', '', name[len(BACKUP_PREFIX):-len('.csv')])
+   parts = stem.rsplit('_', 2)
+   try:
+       moment = datetime.datetime.strptime('_'.join(parts[-2:]), BACKUP_TIMESTAMP)
+   except ValueError:
        return None
+   # Backups are named in the server's local time, like datetime.now() in build_attendance_email
+   return (parts[0] if len(parts) == 3 else DEFAULT_CLASS_NAME), int(moment.timestamp())
 
-def load_professor_ip():
-   """Load professor IP from database."""
-   try:
-       conn = get_db_connection()
-       cursor = conn.execute("SELECT ip_professor FROM class_state WHERE id = 1")
-       result = cursor.fetchone()
-       conn.close()
-       return result[0] if result else None
-   except Exception:
+@traced('archive.import_backup')
+def import_attendance_backup(path):
+   """Archive one CSV backup; returns its row count, or None if it was already imported.
+
+   Rows whose Data_Hora does not parse are dated at the backup's own timestamp.
+   """
+   parsed = parse_backup_filename(path)
+   if parsed is None:
+       raise ValueError(f"{path} is not a {BACKUP_PREFIX}*.csv backup")
+   class_name, closed_at = parsed
+   with open(path, newline='', encoding='utf-8-sig') as f:
+       rows = [(row['Nome'], row['Email'], parse_brazil_datetime(row['Data_Hora']) or closed_at)
+               for row in csv.DictReader(f) if row.get('Email')]
+   storage = get_storage()
+   class_id = storage.find_class(class_name) or storage.create_class(class_name)
+   if not storage.import_list(class_id, closed_at, os.path.basename(path), rows):
        return None
+   return len(rows)
 
-def is_student_registered(email, fingerprint=None):
-   """Check if a student is already registered with improved duplicate detection."""
-   try:
-       conn = get_db_connection()
-       
-       # Check by email first (primary duplicate prevention)
-       cursor = conn.execute("SELECT COUNT(*) FROM attendance WHERE email = ?", (email,))
-       email_count = cursor.fetchone()[0]
-       
-       conn.close()
-       
-       if email_count > 0:
-           return True
-           
-       # Additional check with browser fingerprint if available
-       if fingerprint and hasattr(st.session_state, 'used_fingerprints'):
-           if fingerprint in st.session_state.used_fingerprints:
-               return True
-               
-       return False
-   except Exception as e:
-       st.error(f"Error checking registration: {e}")
-       return True  # Fail safe - prevent registration on error
+@traced('email.build_attendance_email')
+def build_attendance_email(class_id, class_name=DEFAULT_CLASS_NAME, generation=None):
+   """Save the CSV backup and build the list email; returns (backup_filename, subject, body), or None without students.
 
-def send_attendance_email():
-   """Send attendance list via email with improved error handling."""
-   try:
-       df = load_attendance_data()
-       if df.empty:
-           st.warning("Não há alunos registrados para enviar por email.")
-           return False
-           
-       recipient = st.secrets.get("email_destinatario", "default@example.com")
-       subject = "Lista de Presença - " + get_brazil_datetime()
-       
-       email_body = "<h2>Lista de Presença</h2>"
-       email_body += f"<p>Data e hora: {get_brazil_datetime()}</p>"
-       email_body += f"<p>Total de alunos: {len(df)}</p>"
-       email_body += "<p>Segue a lista de alunos presentes:</p>"
-       email_body += df.to_html(index=False)
-       
-       message = MIMEMultipart()
-       message['From'] = "sistema@listadechamada.com"
-       message['To'] = recipient
-       message['Subject'] = subject
-       message.attach(MIMEText(email_body, 'html'))
-       
-       server = smtplib.SMTP('smtp.gmail.com', 587)
-       server.starttls()
-       sender_email = st.secrets.get("email", "seu_email@gmail.com")
-       app_password = st.secrets.get("senha_email", "sua_senha_de_app")
-       
-       if sender_email != "seu_email@gmail.com" and app_password != "sua_senha_de_app":
-           server.login(sender_email, app_password)
-           server.send_message(message)
-           server.quit()
-           st.success("Email enviado com sucesso!")
-       else:
-           st.warning("Configuração de email não encontrada. Simulação: Email enviado.")
-       
-       # Create backup
-       timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-       backup_filename = f'lista_presenca_{timestamp}.csv'
-       df.to_csv(backup_filename, index=False)
-       st.info(f"Backup da lista salvo em: {backup_filename}")
-       return True
-       
-   except Exception as e:
-       st.error(f"Erro ao enviar email: {str(e)}")
-       # Still create backup on email failure
-       try:
-           df = load_attendance_data()
-           timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-           backup_filename = f'lista_presenca_{timestamp}.csv'
-           df.to_csv(backup_filename, index=False)
-           st.info(f"Backup da lista salvo em: {backup_filename}")
-       except Exception:
-           pass
-       return False
+   Makes no st.* calls, so the class scheduler can use it off the script thread.
+   """
+   if not get_storage().has_attendance(class_id, generation):
+       return None
+   backup_filename = get_backup_filename(class_name, datetime.datetime.now(), generation)
+   table_rows = []
+   # One streamed pass feeds both the backup file and the email table
+   with open(backup_filename, 'wb') as backup:
+       total = export_attendance(
+           'CSV', backup, class_id, on_chunk=lambda rows: table_rows.append(build_attendance_table_rows(rows)),
+           generation=generation
+       )
+   
+   subject = "Lista de Presença - " + get_brazil_datetime()
+   if class_name != DEFAULT_CLASS_NAME:
+       subject = f"Lista de Presença ({class_name}) - " + get_brazil_datetime()
+   
+   email_body = "<h2>Lista de Presença</h2>"
+   email_body += f"<p>Data e hora: {get_brazil_datetime()}</p>"
+   email_body += f"<p>Total de alunos: {total}</p>"
+   email_body += "<p>Segue a lista de alunos presentes:</p>"
+   email_body += '<table border="1" class="dataframe"><thead><tr style="text-align: right;">'
+   email_body += "".join(f"<th>{column}</th>" for column in EXPORT_COLUMNS)
+   email_body += "</tr></thead><tbody>" + "".join(table_rows) + "</tbody></table>"
+   return backup_filename, subject, email_body
 
 def start_timer():
    """Start the 1-hour timer with database persistence."""
@@ -332,12 +2033,9 @@ def start_timer():
        st.session_state.timer_end_time = datetime.datetime.now() + datetime.timedelta(hours=1)
        
        try:
-           conn = get_db_connection()
-           conn.execute("""
-               UPDATE class_state SET timer_end_time = ? WHERE id = 1
-           """, (st.session_state.timer_end_time.isoformat(),))
-           conn.commit()
-           conn.close()
+           get_storage().set_timer(current_class_id(), st.session_state.timer_end_time.isoformat())
+           invalidate_class_state()
+           get_class_scheduler().wake()
        except Exception as e:
            st.error(f"Error saving timer state: {e}")
 
@@ -359,19 +2057,22 @@ def verify_password_and_captcha(password, captcha_response):
    except ValueError:
        return False
 
+@traced('db.reset_attendance_list')
 def reset_attendance_list():
-   """Reset the attendance list and related state with database cleanup."""
-   send_attendance_email()
+   """Reset this class's attendance list and related state with database cleanup."""
+   class_id = current_class_id()
    
    try:
-       conn = get_db_connection()
-       conn.execute("DELETE FROM attendance")
-       conn.execute("DELETE FROM class_state")
-       conn.commit()
-       conn.close()
+       # One UPDATE closes the list and opens the next generation; the class scheduler
+       # emails the closed generation and archives it off this request. If the scheduler
+       # already rotated the list (timer over), there is nothing left to do here.
+       if (closed := get_storage().rotate_class(class_id)) is not None:
+           get_roster_indexes().get(class_id).reset(closed + 1)
+           get_class_scheduler().wake()
+       invalidate_class_state()
+       notify_class_changed(class_id)
        
        # Reset session state
-       st.session_state.registros = pd.DataFrame(columns=['Nome', 'Email', 'Data_Hora'])
        st.session_state.timer_started = False
        st.session_state.timer_end_time = None
        st.session_state.aula_iniciada = False
@@ -382,80 +2083,400 @@ def reset_attendance_list():
        st.session_state.form_submitted = False
        st.session_state.captcha_pergunta = None
        st.session_state.captcha_resposta = None
+       drop_export_file()
        
-       if hasattr(st.session_state, 'used_fingerprints'):
-           st.session_state.used_fingerprints.clear()
-       
-       st.success("Lista de presença finalizada e enviada por email com sucesso!")
+       st.success("Lista de presença finalizada! O email será enviado em segundo plano.")
        st.rerun()
        
    except Exception as e:
        st.error(f"Error resetting attendance list: {e}")
 
+@traced('db.start_class')
 def start_class():
    """Start the class with database persistence."""
    try:
-       conn = get_db_connection()
-       # FIX: Use INSERT OR REPLACE to ensure the record is properly created/updated
-       conn.execute("""
-           INSERT OR REPLACE INTO class_state (id, aula_iniciada, session_id) 
-           VALUES (1, 1, ?)
-       """, (st.session_state.session_id,))
-       conn.commit()
-       conn.close()
+       # The first start of a new ?turma= creates the class
+       st.session_state.class_id = get_class_id(st.session_state.class_name, create=True)
+       # FIX: Upsert to ensure the record is properly created/updated
+       get_storage().start_class(st.session_state.class_id, st.session_state.session_id)
+       invalidate_class_state()
        
        # FIX: Update session state immediately after database update
        st.session_state.aula_iniciada = True
        st.session_state.senha_correta = True
        
-       if not hasattr(st.session_state, 'used_fingerprints'):
-           st.session_state.used_fingerprints = set()
-       
        start_timer()
+       notify_class_changed()
        
    except Exception as e:
        st.error(f"Error starting class: {e}")
 
-def add_attendance_record(name, email, fingerprint=None):
-   """Add a new attendance record with improved duplicate prevention and concurrency handling."""
-   timestamp = get_brazil_datetime()
-   
-   # Check for duplicates with thread safety
-   if is_student_registered(email, fingerprint):
+class RegistrationWriter:
+   """Background thread that commits queued registrations in group transactions."""
+
+   def __init__(self, storage, rosters, max_batch=200):
+       self.storage = storage
+       self.rosters = rosters
+       self.max_batch = max_batch
+       self._queue = queue.Queue()
+       self._thread = threading.Thread(target=self._run, name="registration-writer", daemon=True)
+       self._thread.start()
+
+   def submit(self, class_id, name, email, timestamp, session_id, fingerprint=None):
+       """Queue a registration; the Future resolves to False if the email or fingerprint already exists in the class."""
+       future = Future()
+       self._queue.put(((class_id, name, email, timestamp, session_id, fingerprint), future))
+       return future
+
+   def backlog(self):
+       """Registrations queued and not yet committed."""
+       return self._queue.qsize()
+
+   def _run(self):
+       while True:
+           batch = [self._queue.get()]
+           while len(batch) < self.max_batch:
+               try:
+                   batch.append(self._queue.get_nowait())
+               except queue.Empty:
+                   break
+           self._commit(batch)
+
+   def _commit(self, batch):
+       """Insert a whole batch in one transaction and resolve each waiting Future."""
+       try:
+           results = self.storage.register_batch([row for row, _ in batch])
+       except Exception as e:
+           for _, future in batch:
+               future.set_exception(e)
+           return
+       # Write through to the roster indexes before the registering session reruns; the other
+       # sessions' roster panels pick the rows up on their next poll, without a full rerun. A
+       # rotation may land between the commit and here: the generation sorts that out.
+       for (row, _), result in zip(batch, results):
+           if result is not None:
+               class_id, name, email, timestamp, _, fingerprint = row
+               row_id, generation = result
+               self.rosters.get(class_id).add(RosterEntry(row_id, name, email, timestamp, fingerprint), generation)
+       for (_, future), result in zip(batch, results):
+           future.set_result(result is not None)
+
+@st.cache_resource
+def get_registration_writer():
+   """Process-wide registration writer shared by every session."""
+   return RegistrationWriter(get_storage(), get_roster_indexes())
+
+class ClassScheduler:
+   """Background list work, from one thread per process: closes each class's list when its
+   timer runs out, then emails every closed generation and moves it to the archive.
+
+   Every process runs one; rotate_class lets exactly one of them (or a professor
+   finalizing at the same moment) close a given timer, and the outbox dedupe key
+   keeps each closed generation to a single email.
+   """
+
+   def __init__(self, storage, notifier, max_sleep=5.0, archive_batch=500):
+       self.storage = storage
+       self.notifier = notifier
+       # Timers set by other processes are only seen on the next poll
+       self.max_sleep = max_sleep
+       self.archive_batch = archive_batch
+       self._wake = threading.Event()
+       self._thread = threading.Thread(target=self._run, name="class-scheduler", daemon=True)
+       self._thread.start()
+
+   def wake(self):
+       """Re-read the timers and closed lists now, e.g. after a timer was started or a list rotated."""
+       self._wake.set()
+
+   def _run(self):
+       while True:
+           try:
+               delay = self._close_expired()
+           except Exception:
+               logger.exception("Could not read the class timers")
+               delay = self.max_sleep
+           try:
+               if self._finalize_closed():
+                   delay = self.max_sleep
+           except Exception:
+               logger.exception("Could not list the closed generations")
+               delay = self.max_sleep
+           self._wake.wait(timeout=delay)
+           self._wake.clear()
+
+   def _close_expired(self):
+       """Close every class whose timer is over; return the seconds until the next deadline."""
+       now = datetime.datetime.now()
+       delay = self.max_sleep
+       for class_id, timer_end_time in self.storage.open_timers():
+           remaining = (datetime.datetime.fromisoformat(timer_end_time) - now).total_seconds()
+           if remaining > 0:
+               delay = min(delay, remaining)
+           elif (closed := self.storage.rotate_class(class_id, timer_end_time)) is not None:
+               get_roster_indexes().get(class_id).reset(closed + 1)
+               # Registration is closed: let every session rerun once
+               get_class_state_cache().invalidate(class_id)
+               self.notifier.bump(class_id)
+       return delay
+
+   def _finalize_closed(self):
+       """Finalize every closed generation; returns the set of those that failed.
+
+       A generation stays in the table until its email is queued, so a crash in between
+       only means it is finalized again by the next pass of any process. A failing
+       generation is logged and left for the next pass, without holding up the others.
+       """
+       failed = set()
+       while closed := [item for item in self.storage.closed_generations() if item not in failed]:
+           for class_id, generation in closed:
+               try:
+                   self._finalize(class_id, generation)
+               except Exception:
+                   logger.exception("Could not finalize list %s of class %s", generation, class_id)
+                   failed.add((class_id, generation))
+       return failed
+
+   def _finalize(self, class_id, generation):
+       """Email one closed generation, then move its rows to the archive in small batches.
+
+       The list is dated by its last registration, not by when this pass runs: a retry
+       or a late pass must not move it into another period of the history.
+       """
+       class_name = self.storage.class_name(class_id) or DEFAULT_CLASS_NAME
+       email = build_attendance_email(class_id, class_name, generation)
+       closed_at = self.storage.last_registration(class_id, generation)
+       if email is None or closed_at is None:
+           # Another process moved it to the archive meanwhile
+           return
+       backup_filename, subject, body = email
+       get_email_outbox().enqueue(
+           get_setting("email_destinatario", "default@example.com"), subject, body,
+           dedupe_key=f"list:{class_id}:{generation}", class_id=class_id
+       )
+       list_id = self.storage.archive_list(class_id, generation, closed_at, os.path.basename(backup_filename))
+       while self.storage.archive_generation(class_id, generation, list_id, self.archive_batch):
+           pass
+
+@st.cache_resource
+def get_class_scheduler():
+   """Process-wide timer scheduler."""
+   return ClassScheduler(get_storage(), get_change_notifier())
+
+# (tokens per second, burst) per key kind. Students behind one NAT share an IP, so the
+# per-IP buckets are much larger than the per-session ones. Session ids and fingerprints
+# come from the client, so only the IP and global buckets hold against a script; the
+# registrations need no fingerprint bucket, as the UNIQUE index allows one per list anyway.
+RATE_LIMITS = {
+   'registration': {'session': (0.1, 3), 'ip': (5.0, 100)},
+   # global caps guesses from every address together, at the cost of letting a flood
+   # delay the professor's own login by a few seconds
+   'password': {'session': (1 / 30, 5), 'fingerprint': (1 / 30, 5), 'ip': (0.2, 20), 'global': (0.5, 30)},
+   # A kiosk or scanner sends a whole room's check-ins from one address
+   'checkin_api': {'ip': (50.0, 500)},
+}
+# Scopes that feed the registration writer, shed first when it is saturated
+WRITE_SCOPES = ('registration', 'checkin_api')
+RATE_LIMIT_TTL = 600
+REGISTRATION_QUEUE_LIMIT = 500
+
+class RateLimiter:
+   """Token buckets keyed by session, fingerprint and IP; buckets idle longer than ttl are evicted."""
+
+   def __init__(self, limits, ttl=RATE_LIMIT_TTL):
+       self.limits = limits
+       self.ttl = ttl
+       self.rejections = {}
+       self._buckets = {}
+       self._lock = threading.Lock()
+       self._swept_at = time.monotonic()
+
+   def _sweep(self, now):
+       """Drop idle buckets; an idle bucket would be full again anyway."""
+       if now - self._swept_at < self.ttl / 10:
+           return
+       self._swept_at = now
+       self._buckets = {key: bucket for key, bucket in self._buckets.items() if now - bucket[1] < self.ttl}
+
+   def count(self, reason):
+       with self._lock:
+           self.rejections[reason] = self.rejections.get(reason, 0) + 1
+
+   def allow(self, keys):
+       """Take one token from every bucket of keys ({kind: key}); returns the kind that refused, or None.
+
+       Kinds without a limit in this limiter are ignored.
+       """
+       now = time.monotonic()
+       with self._lock:
+           self._sweep(now)
+           buckets = []
+           for kind, key in keys.items():
+               if not key or kind not in self.limits:
+                   continue
+               rate, burst = self.limits[kind]
+               bucket = self._buckets.get((kind, key))
+               if bucket is None:
+                   bucket = self._buckets[(kind, key)] = [float(burst), now]
+               else:
+                   bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+                   bucket[1] = now
+               buckets.append((kind, bucket))
+           for kind, bucket in buckets:
+               if bucket[0] < 1:
+                   self.rejections[kind] = self.rejections.get(kind, 0) + 1
+                   return kind
+           for _, bucket in buckets:
+               bucket[0] -= 1
+           return None
+
+@st.cache_resource
+def get_rate_limiters():
+   """Process-wide rate limiters, one per protected form."""
+   return {scope: RateLimiter(limits) for scope, limits in RATE_LIMITS.items()}
+
+def rejection_counts():
+   """{(scope, reason): count} of every refused request so far."""
+   counts = {}
+   for scope, limiter in get_rate_limiters().items():
+       with limiter._lock:
+           counts.update({(scope, reason): count for reason, count in limiter.rejections.items()})
+   return counts
+
+@functools.lru_cache(maxsize=None)
+def trusted_proxies():
+   """Networks of the reverse proxies allowed to set X-Forwarded-For (trusted_proxies setting)."""
+   proxies = get_setting("trusted_proxies", [])
+   if isinstance(proxies, str):
+       proxies = proxies.split(',')
+   return tuple(ipaddress.ip_network(proxy.strip(), strict=False) for proxy in proxies if proxy.strip())
+
+def is_trusted_proxy(address):
+   try:
+       ip = ipaddress.ip_address(address)
+   except ValueError:
        return False
-   
+   return any(ip in network for network in trusted_proxies())
+
+def client_address(peer, forwarded):
+   """Address to rate limit: the socket peer, or behind trusted proxies the hop they received the request from.
+
+   X-Forwarded-For is only read when the peer is a trusted proxy, and then from the
+   right, skipping the trusted hops: every entry to their left was written by the
+   client and proves nothing.
+   """
+   if not forwarded or not is_trusted_proxy(peer):
+       return peer
+   for hop in reversed(forwarded.split(',')):
+       hop = hop.strip()
+       if hop and not is_trusted_proxy(hop):
+           return hop
+   return peer
+
+def get_client_ip():
+   """Client address of this session (see client_address)."""
    try:
-       conn = get_db_connection()
-       
-       # Double-check within transaction to prevent race conditions
-       cursor = conn.execute("SELECT COUNT(*) FROM attendance WHERE email = ?", (email,))
-       if cursor.fetchone()[0] > 0:
-           conn.close()
-           return False
-       
-       # Insert new record
-       conn.execute("""
-           INSERT INTO attendance (nome, email, data_hora, session_id) 
-           VALUES (?, ?, ?, ?)
-       """, (name, email, timestamp, st.session_state.session_id))
-       
-       conn.commit()
-       conn.close()
-       
-       # Update session state
-       new_record = pd.DataFrame({
-           'Nome': [name],
-           'Email': [email],
-           'Data_Hora': [timestamp]
-       })
-       
-       st.session_state.registros = pd.concat([st.session_state.registros, new_record], ignore_index=True)
-       
-       # Track fingerprint if available
-       if fingerprint and hasattr(st.session_state, 'used_fingerprints'):
-           st.session_state.used_fingerprints.add(fingerprint)
-       
+       # Streamlit reports loopback connections (a proxy on the same host) as None
+       peer = st.context.ip_address or '127.0.0.1'
+       return client_address(peer, st.context.headers.get("X-Forwarded-For"))
+   except Exception:
+       return None
+
+def admit_request(scope, keys):
+   """Rate limit and admission check of the forms and the check-in API.
+
+   Returns (reason, message) when refused: reason is 'overload' or the key kind
+   whose bucket ran out.
+   """
+   limiter = get_rate_limiters()[scope]
+   # Shed new registrations while the writer is saturated instead of letting them time out
+   if scope in WRITE_SCOPES and get_registration_writer().backlog() >= REGISTRATION_QUEUE_LIMIT:
+       limiter.count('overload')
+       return 'overload', "Muitos registros ao mesmo tempo. Tente novamente em alguns segundos."
+   kind = limiter.allow({**keys, 'global': scope})
+   if kind:
+       return kind, "Muitas tentativas. Aguarde alguns segundos e tente novamente."
+   return None
+
+def admit(scope):
+   """admit_request for a form of this session; returns a message when refused."""
+   rejection = admit_request(scope, {
+       'session': st.session_state.session_id,
+       'fingerprint': st.session_state.get('browser_fingerprint'),
+       'ip': get_client_ip(),
+   })
+   return rejection[1] if rejection else None
+
+# Rotating check-in codes: the professor's screen shows a short code (and a QR) that
+# changes every checkin_code_seconds; only students in the room can see it.
+CHECKIN_CODE_DIGITS = 6
+# The professor's screen redraws the code this often; the previous code stays valid for a window
+CHECKIN_CODE_REFRESH_SECONDS = 5
+
+@functools.lru_cache(maxsize=None)
+def checkin_code_seconds():
+   """Lifetime of one check-in code; 0 disables codes. Memoized: a st.secrets lookup costs more than a whole check."""
+   return int(get_setting("checkin_code_seconds", 30))
+
+@functools.lru_cache(maxsize=1024)
+def checkin_code(key_hex, class_id, window):
+   """Code of a class for one time window: HMAC-SHA256 with the HOTP dynamic truncation (RFC 4226)."""
+   digest = hmac.new(bytes.fromhex(key_hex), f"{class_id}:{window}".encode(), hashlib.sha256).digest()
+   offset = digest[-1] & 0x0F
+   value = int.from_bytes(digest[offset:offset + 4], 'big') & 0x7FFFFFFF
+   return f"{value % 10 ** CHECKIN_CODE_DIGITS:0{CHECKIN_CODE_DIGITS}d}"
+
+def current_checkin_code(class_id):
+   """The code to show for an open class right now, or None (closed class, or codes disabled)."""
+   seconds = checkin_code_seconds()
+   state = load_class_state_snapshot(class_id)
+   if not seconds or not state.aula_iniciada or not state.checkin_key:
+       return None
+   return checkin_code(state.checkin_key, class_id, int(time.time()) // seconds)
+
+def verify_checkin_code(class_id, code):
+   """Whether code is the class's current (or previous) check-in code.
+
+   The key comes from the shared class state snapshot and the code is recomputed
+   from the clock, so no database is touched; malformed input is refused before
+   any HMAC. Always True when codes are disabled.
+   """
+   seconds = checkin_code_seconds()
+   if not seconds:
        return True
+   code = (code or '').strip()
+   if len(code) != CHECKIN_CODE_DIGITS or not (code.isascii() and code.isdigit()):
+       return False
+   key = load_class_state_snapshot(class_id).checkin_key
+   if not key:
+       return False
+   window = int(time.time()) // seconds
+   # The previous window too, so a code read just before it rotated still works.
+   # Both are compared every time, in constant time.
+   current = hmac.compare_digest(code, checkin_code(key, class_id, window))
+   previous = hmac.compare_digest(code, checkin_code(key, class_id, window - 1))
+   return current or previous
+
+def register_attendance(class_id, name, email, session_id, fingerprint=None):
+   """Register one student and wait for the commit; False for a duplicate or a closed class.
+
+   Shared by the form and the check-in API; makes no st.* calls and lets errors propagate.
+   Callers check the check-in code (verify_checkin_code) first.
+   """
+   timestamp = int(time.time())
+   # Known duplicates are rejected from memory, without a database round trip
+   if get_roster_indexes().get(class_id).sync().contains(email, fingerprint):
+       return False
+   # Queued for the next group commit; the UNIQUE email/fingerprint indexes still reject
+   # duplicates the index has not seen yet. The writer adds the row to the roster index.
+   future = get_registration_writer().submit(class_id, name, email, timestamp, session_id, fingerprint)
+   return future.result(timeout=30)
+
+@traced('db.add_attendance_record')
+def add_attendance_record(name, email, fingerprint=None):
+   """Add a new attendance record with improved duplicate prevention and concurrency handling."""
+   try:
+       return register_attendance(current_class_id(), name, email, st.session_state.session_id, fingerprint)
        
    except sqlite3.IntegrityError:
        # Handle duplicate email constraint
@@ -464,96 +2485,350 @@ def add_attendance_record(name, email, fingerprint=None):
        st.error(f"Error adding attendance record: {e}")
        return False
 
+class CheckinAPI:
+   """JSON check-in endpoints for kiosks, scanners and LMS integrations, served next to the UI.
+
+   POST /api/checkin  {"nome", "email", "codigo", "fingerprint"?}  -> 201, or {"error", "message"} with 4xx/5xx
+   GET  /api/state                                       -> {"turma", "aula_iniciada", "timer_end_time"}
+   GET  /api/roster                                      -> {"turma", "total", "alunos"}, with an ETag
+
+   Every path takes ?turma=<nome>, like the UI. A check-in costs one admission check
+   and one queued INSERT, instead of a whole script rerun. With api_token set,
+   requests need "Authorization: Bearer <api_token>"; those trusted clients may leave
+   out "codigo", the check-in code shown on the professor's screen.
+   """
+
+   MAX_BODY = 4096
+   MAX_FIELD = 200
+
+   def __init__(self, token=None):
+       self.token = token
+       # Part of every ETag, so tags from another process or an earlier run never match
+       self.instance = uuid.uuid4().hex[:8]
+       self._roster_bodies = {}
+       self._routes = {
+           ('POST', '/api/checkin'): self.checkin,
+           ('GET', '/api/state'): self.state,
+           ('GET', '/api/roster'): self.roster,
+       }
+
+   @staticmethod
+   def _json(status, payload, headers=None):
+       headers = dict(headers or {})
+       headers['Content-Type'] = 'application/json; charset=utf-8'
+       return status, headers, json.dumps(payload, ensure_ascii=False).encode('utf-8')
+
+   def _error(self, status, error, message):
+       return self._json(status, {'error': error, 'message': message})
+
+   def handle(self, method, target, headers, body, peer):
+       """Answer one request; returns (status, headers, body bytes)."""
+       url = urllib.parse.urlsplit(target)
+       route = self._routes.get((method, url.path.rstrip('/')))
+       if route is None:
+           return self._error(404, 'not_found', "Rota desconhecida.")
+       if self.token and not hmac.compare_digest(
+           headers.get('Authorization', '').encode(), f"Bearer {self.token}".encode()
+       ):
+           return self._error(401, 'unauthorized', "Token de acesso inválido.")
+       class_name = (urllib.parse.parse_qs(url.query).get('turma', [''])[0].strip()[:50]) or DEFAULT_CLASS_NAME
+       try:
+           class_id = get_class_id(class_name)
+           if class_id is None:
+               return self._error(404, 'class_not_found', f"Turma {class_name} não encontrada.")
+           client_ip = client_address(peer, headers.get('X-Forwarded-For'))
+           return route(class_id, class_name, headers, body, client_ip)
+       except Exception:
+           # The details (SQL, paths, driver messages) go to the log, never to the client
+           logger.exception("Check-in API failed on %s %s", method, url.path)
+           return self._error(500, 'internal_error', "Erro interno. Tente novamente em instantes.")
+
+   def checkin(self, class_id, class_name, headers, body, client_ip):
+       try:
+           data = json.loads(body)
+           nome, email = (str(data.get(field) or '').strip() for field in ('nome', 'email'))
+           fingerprint = str(data.get('fingerprint') or '').strip() or None
+           codigo = str(data.get('codigo') or '')
+       except (ValueError, AttributeError):
+           return self._error(400, 'invalid_json', "Corpo da requisição não é um objeto JSON.")
+       if not nome or not email:
+           return self._error(400, 'missing_fields', "Preencha todos os campos.")
+       if max(len(nome), len(email), len(fingerprint or '')) > self.MAX_FIELD:
+           return self._error(400, 'field_too_long', "Campo longo demais.")
+       rejection = admit_request('checkin_api', {'ip': client_ip})
+       if rejection:
+           reason, message = rejection
+           if reason == 'overload':
+               return self._error(503, 'overload', message)
+           return self._error(429, 'rate_limited', message)
+       if not load_class_state_snapshot(class_id).aula_iniciada:
+           return self._error(409, 'class_closed', "A lista desta turma não está aberta.")
+       # Wrong codes are turned away here, before anything reaches the registration writer
+       if not self.token and not verify_checkin_code(class_id, codigo):
+           get_rate_limiters()['checkin_api'].count('invalid_code')
+           return self._error(403, 'invalid_code', "Código da aula inválido ou expirado.")
+       if not register_attendance(class_id, nome, email, 'api', fingerprint):
+           return self._error(409, 'duplicate', "Este email já está registrado ou este dispositivo já registrou presença.")
+       return self._json(201, {'turma': class_name, 'nome': nome, 'email': email})
+
+   def state(self, class_id, class_name, headers, body, client_ip):
+       state = load_class_state_snapshot(class_id)
+       return self._json(200, {
+           'turma': class_name,
+           'aula_iniciada': bool(state.aula_iniciada),
+           'timer_end_time': state.timer_end_time.isoformat() if state.timer_end_time else None,
+       }, {'Cache-Control': 'no-store'})
+
+   def roster(self, class_id, class_name, headers, body, client_ip):
+       """Names and registration times (no emails), as in the sidebar; serialized once per roster version."""
+       snapshot = get_roster_indexes().get(class_id).sync().snapshot()
+       etag = f'"{self.instance}-{class_id}-{snapshot.version}"'
+       cache_headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+       if_none_match = headers.get('If-None-Match', '')
+       if if_none_match.strip() == '*' or etag in (tag.strip() for tag in if_none_match.split(',')):
+           return 304, cache_headers, b''
+       cached = self._roster_bodies.get(class_id)
+       if cached is None or cached[0] is not snapshot:
+           payload = {
+               'turma': class_name,
+               'total': len(snapshot.entries),
+               'alunos': [
+                   {'nome': entry.nome, 'registered_at': entry.registered_at,
+                    'data_hora': format_brazil_datetime(entry.registered_at)}
+                   for entry in snapshot.entries
+               ],
+           }
+           cached = self._roster_bodies[class_id] = (snapshot, self._json(200, payload)[2])
+       cache_headers['Content-Type'] = 'application/json; charset=utf-8'
+       return 200, cache_headers, cached[1]
+
+   def serve(self, host, port):
+       """Serve the API from a daemon thread; http.server is only imported when the API is enabled."""
+       from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+       api = self
+
+       class Handler(BaseHTTPRequestHandler):
+           # Keep-alive, so a kiosk reuses one connection for a whole class; headers and body
+           # go out as separate writes, which Nagle would hold back for a delayed ACK
+           protocol_version = 'HTTP/1.1'
+           disable_nagle_algorithm = True
+
+           def dispatch(self):
+               try:
+                   length = int(self.headers.get('Content-Length') or 0)
+               except ValueError:
+                   length = -1
+               if length < 0:
+                   # Without a length the body cannot be skipped, so the connection cannot be reused
+                   self.close_connection = True
+                   status, headers, payload = api._error(400, 'invalid_length', "Cabeçalho Content-Length inválido.")
+               elif length > api.MAX_BODY:
+                   # The body is not read, so the connection cannot be reused
+                   self.close_connection = True
+                   status, headers, payload = api._error(413, 'body_too_large', "Corpo da requisição grande demais.")
+               else:
+                   body = self.rfile.read(length) if length else b''
+                   status, headers, payload = api.handle(self.command, self.path, self.headers, body, self.client_address[0])
+               self.send_response(status)
+               for name, value in headers.items():
+                   self.send_header(name, value)
+               self.send_header('Content-Length', str(len(payload)))
+               self.end_headers()
+               self.wfile.write(payload)
+
+           do_GET = do_POST = dispatch
+
+           def log_message(self, format, *args):
+               pass
+
+       class Server(ThreadingHTTPServer):
+           daemon_threads = True
+
+           def handle_error(self, request, client_address):
+               # Kiosks on flaky Wi-Fi drop connections all the time; that is not an error
+               if not isinstance(sys.exc_info()[1], ConnectionError):
+                   super().handle_error(request, client_address)
+
+       server = Server((host, port), Handler)
+       threading.Thread(target=server.serve_forever, name="checkin-api", daemon=True).start()
+       return server
+
+@st.cache_resource
+def get_checkin_api():
+   """Start the check-in API when api_port (or LISTAPP_API_PORT) is set; None otherwise.
+
+   Only one process can own the port: in the others this returns None and they
+   serve the UI alone.
+   """
+   port = get_setting("api_port", os.environ.get("LISTAPP_API_PORT"))
+   if not port:
+       return None
+   api = CheckinAPI(get_setting("api_token", None))
+   try:
+       api.serve(get_setting("api_host", "127.0.0.1"), int(port))
+   except OSError:
+       return None
+   return api
+
+@st.fragment(run_every=CHANGE_POLL_SECONDS)
+def watch_for_changes():
+   """Cheap periodic check that reruns the whole app only when the class was started, closed
+   or retimed; new registrations refresh just display_roster_panel."""
+   version = class_version()
+   timer_expired = (st.session_state.timer_started and st.session_state.timer_end_time
+                    and st.session_state.timer_end_time <= datetime.datetime.now())
+   if version != st.session_state.get('seen_version') or timer_expired:
+       st.rerun(scope="app")
+
+@st.fragment(run_every=CHANGE_POLL_SECONDS)
+def display_roster_panel():
+   """The sidebar roster, rerun on its own so new registrations never rerun the whole page."""
+   # Shared snapshot of the process-wide index; no query, sort or copy on a normal rerun
+   roster = load_roster().snapshot()
+   if roster.entries:
+       st.subheader(f"Total: {len(roster.entries)}")
+       display_roster(roster)
+   else:
+       st.write("Nenhum aluno registrado!")
+
+# Static frontend in components/client: loaded once per session, then only its args change
+client_component = components.declare_component(
+   "client", path=os.path.join(os.path.dirname(os.path.abspath(__file__)), "components", "client")
+)
+
+@traced('render.timer')
 def display_timer():
-   """Display the countdown timer with improved JavaScript."""
+   """Display the countdown timer; the same component reports the browser fingerprint."""
+   end_time_ms = None
    if st.session_state.timer_started and st.session_state.timer_end_time:
        end_time_ms = int(st.session_state.timer_end_time.timestamp() * 1000)
-       timer_html = f"""
-       <div style='text-align: right;'>
-           <h3 id="cronometro">Carregando...</h3>
-       </div>
-       <script>
-           (function() {{
-               const endTime = {end_time_ms};
-               let timerInterval;
-               
-               function updateTimer() {{
-                   const now = new Date().getTime();
-                   const distance = endTime - now;
-                   
-                   if (distance > 0) {{
-                       const hours = Math.floor((distance % (1000 * 60 * 60 * 24)) / (1000 * 60 * 60));
-                       const minutes = Math.floor((distance % (1000 * 60 * 60)) / (1000 * 60));
-                       const seconds = Math.floor((distance % (1000 * 60)) / 1000);
-                       const timeString = 
-                           (hours < 10 ? "0" + hours : hours) + ":" + 
-                           (minutes < 10 ? "0" + minutes : minutes) + ":" + 
-                           (seconds < 10 ? "0" + seconds : seconds);
-                       
-                       const cronometroElement = document.getElementById("cronometro");
-                       if (cronometroElement) {{
-                           cronometroElement.textContent = timeString;
-                       }}
-                   }} else {{
-                       const cronometroElement = document.getElementById("cronometro");
-                       if (cronometroElement) {{
-                           cronometroElement.textContent = "00:00:00";
-                       }}
-                       if (timerInterval) {{
-                           clearInterval(timerInterval);
-                       }}
-                       setTimeout(() => {{ 
-                           if (window.location) {{
-                               window.location.reload(); 
-                           }}
-                       }}, 2000);
-                   }}
-               }}
-               
-               updateTimer();
-               timerInterval = setInterval(updateTimer, 1000);
-               
-               // Cleanup on page unload
-               window.addEventListener('beforeunload', function() {{
-                   if (timerInterval) {{
-                       clearInterval(timerInterval);
-                   }}
-               }});
-           }})();
-       </script>
-       """
-       html(timer_html, height=50)
-   else:
-       st.markdown("<div style='text-align: right;'><h3>01:00:00</h3></div>", unsafe_allow_html=True)
+   fingerprint = client_component(end_time_ms=end_time_ms, key="client", default=None)
+   if fingerprint:
+       st.session_state.browser_fingerprint = fingerprint
+
+def checkin_url(code):
+   """Registration link carried by the QR code: public_url (or the page's own URL) with turma and codigo.
+
+   None when neither is known.
+   """
+   base = get_setting("public_url", None) or st.context.url
+   if not base:
+       return None
+   params = {'codigo': code}
+   if st.session_state.class_name != DEFAULT_CLASS_NAME:
+       params = {'turma': st.session_state.class_name, **params}
+   return f"{base.split('?')[0]}?{urllib.parse.urlencode(params)}"
+
+@functools.lru_cache(maxsize=64)
+def checkin_qr_png(url):
+   """PNG of a QR code for url; the code repeats every rerun of its window, so it is drawn once."""
+   import segno
+   buffer = io.BytesIO()
+   segno.make(url, error='m').save(buffer, kind='png', scale=6, border=2)
+   return buffer.getvalue()
+
+@st.fragment(run_every=CHECKIN_CODE_REFRESH_SECONDS)
+def display_checkin_code():
+   """The professor's rotating check-in code, with a QR code when segno is installed."""
+   code = current_checkin_code(current_class_id())
+   if code is None:
+       return
+   st.markdown(f"<h2 style='text-align: center; letter-spacing: 0.3em;'>{code}</h2>", unsafe_allow_html=True)
+   st.caption(f"Código da aula: muda a cada {checkin_code_seconds()} segundos.")
+   url = checkin_url(code)
+   if url and importlib.util.find_spec('segno') is not None:
+       st.image(checkin_qr_png(url), use_container_width=True)
 
+def display_metrics_panel():
+   """Password-protected view of the per-rerun metrics kept by the tracer."""
+   with st.expander("📈 Métricas"):
+       if not st.session_state.get('metrics_unlocked'):
+           with st.form(key="metrics_form"):
+               senha = st.text_input("Senha do professor", type="password", key="metrics_senha")
+               if st.form_submit_button("Ver métricas"):
+                   rejection = admit('password')
+                   if rejection:
+                       st.warning(rejection)
+                   elif senha == st.session_state.senha_professor:
+                       st.session_state.metrics_unlocked = True
+                       st.rerun()
+                   else:
+                       st.error("Senha incorreta!")
+           return
+       
+       reruns, totals = tracer.snapshot()
+       if not reruns:
+           st.write("Nenhum rerun registrado ainda.")
+           return
+       durations = [rerun['total_ms'] for rerun in reruns]
+       cuts = statistics.quantiles(durations, n=100, method='inclusive') if len(durations) > 1 else durations * 99
+       st.write(f"Reruns: {totals['reruns']} — p50 {cuts[49]:.1f} ms, p95 {cuts[94]:.1f} ms")
+       st.write(f"Consultas/rerun: {totals['queries'] / totals['reruns']:.1f} — Linhas/rerun: {totals['rows'] / totals['reruns']:.1f}")
+       st.dataframe([
+           {'Seção': name, 'Chamadas': calls, 'Média (ms)': round(total_ms / calls, 3), 'Total (ms)': round(total_ms, 1)}
+           for name, (calls, total_ms) in sorted(totals['spans'].items(), key=lambda item: -item[1][1])
+       ], hide_index=True)
+       st.dataframe([
+           {
+               'Início': datetime.datetime.fromtimestamp(rerun['started']).strftime('%H:%M:%S'),
+               'Total (ms)': round(rerun['total_ms'], 1),
+               'Consultas': rerun['queries'],
+               'Linhas': rerun['rows'],
+           }
+           for rerun in reversed(reruns[-20:])
+       ], hide_index=True)
+       st.json(get_storage().stats())
+       rejections = rejection_counts()
+       if rejections:
+           st.dataframe([
+               {'Formulário': scope, 'Motivo': reason, 'Recusas': count}
+               for (scope, reason), count in sorted(rejections.items())
+           ], hide_index=True)
+       st.download_button(
+           "Baixar métricas (Prometheus)",
+           data=tracer.prometheus(get_storage().stats(), rejection_counts()),
+           file_name="metrics.prom",
+           mime="text/plain",
+           key="btn_metrics_download"
+       )
+
+@traced_rerun
 def main():
    """Main application function with improved error handling and performance."""
    try:
        # Initialize database first
        init_database()
+       # Closes lists whose timer ran out, even if nobody is watching
+       get_class_scheduler()
+       # JSON check-in API for kiosks and scanners, when api_port is configured
+       get_checkin_api()
        
        # Initialize session state
        initialize_session_state()
        
-       # FIX: Force refresh of class state on each page load to ensure consistency
-       current_class_state = load_class_state()
-       if current_class_state != st.session_state.aula_iniciada:
-           st.session_state.aula_iniciada = current_class_state
-           # Also reload timer state if class is active
-           if current_class_state:
-               timer_state = load_timer_state()
-               if timer_state and timer_state > datetime.datetime.now():
-                   st.session_state.timer_end_time = timer_state
-                   st.session_state.timer_started = True
+       # Read the version before the data so a change made meanwhile triggers another rerun
+       st.session_state.seen_version = class_version()
        
-       # Generate browser fingerprint for duplicate prevention
-       fingerprint = get_browser_fingerprint()
+       # FIX: Force refresh of class state on each page load to ensure consistency
+       class_state = load_class_state_snapshot()
+       st.session_state.aula_iniciada = class_state.aula_iniciada
+       # Each class has its own timer, so always follow the selected class
+       if class_state.aula_iniciada and class_state.timer_end_time and class_state.timer_end_time > datetime.datetime.now():
+           st.session_state.timer_end_time = class_state.timer_end_time
+           st.session_state.timer_started = True
+       else:
+           st.session_state.timer_end_time = None
+           st.session_state.timer_started = False
        
        st.markdown("<h1 style='text-align: center;'>📝List Web App!</h1>", unsafe_allow_html=True)
+       if st.session_state.class_name != DEFAULT_CLASS_NAME:
+           st.markdown(f"<h3 style='text-align: center;'>Turma: {escape(st.session_state.class_name)}</h3>", unsafe_allow_html=True)
 
        header_col1, header_col2 = st.columns([3, 1])
        with header_col2:
+           # Also collects the browser fingerprint used for duplicate prevention
            display_timer()
+       watch_for_changes()
 
        is_professor = True
 
@@ -562,13 +2837,24 @@ def main():
            prof_col1, prof_col2, prof_col3 = st.columns([1, 1, 1])
            with prof_col2:
                if not st.session_state.aula_iniciada:
+                   # The list was closed (here or by its timer): its export is gone with it
+                   drop_export_file()
                    if st.button("Iniciar Lista", key="btn_start", use_container_width=True):
                        st.session_state.mostrando_senha = True
                        st.session_state.botao_clicado = "start"
+                   display_email_status()
                else:
                    if st.button("Finalizar Lista", key="btn_reset", use_container_width=True):
                        st.session_state.mostrando_senha = True
                        st.session_state.botao_clicado = "reset"
+                   if st.session_state.senha_correta:
+                       display_checkin_code()
+                       display_export_download()
+                   elif st.button("Mostrar Código da Aula", key="btn_auth", use_container_width=True):
+                       # Any professor session (a reloaded page, the projector tab) can show the
+                       # code of the open list after the password, without touching the list
+                       st.session_state.mostrando_senha = True
+                       st.session_state.botao_clicado = "auth"
                
                if st.session_state.mostrando_senha:
                    if st.session_state.get('captcha_pergunta') is None:
@@ -582,7 +2868,12 @@ def main():
                        senha = st.text_input("Digite a senha do professor:", type="password", key="senha_input")
                        submit_senha = st.form_submit_button("Confirmar")
                        
-                       if submit_senha and senha and resposta_captcha:
+                       rejection = admit('password') if submit_senha and senha and resposta_captcha else None
+                       if rejection:
+                           st.warning(rejection)
+                           st.session_state.captcha_pergunta = None
+                           st.session_state.captcha_resposta = None
+                       elif submit_senha and senha and resposta_captcha:
                            if verify_password_and_captcha(senha, resposta_captcha):
                                st.session_state.senha_correta = True
                                if st.session_state.botao_clicado == "start":
@@ -630,27 +2921,24 @@ def main():
                with st.form(key="registro_form"):
                    nome = st.text_input("Nome Completo", value=nome_inicial, key="registro_form_nome_input")
                    email = st.text_input("E-mail", value=email_inicial, key="registro_form_email_input")
+                   # Filled in when the student scans the QR code on the professor's screen
+                   codigo = st.text_input(
+                       "Código da aula", value=st.query_params.get("codigo", ""), max_chars=CHECKIN_CODE_DIGITS,
+                       key="registro_form_codigo_input"
+                   ) if checkin_code_seconds() else None
                    submit_button = st.form_submit_button(label="Registrar Presença")
 
-                   # JavaScript to get browser fingerprint
-                   js_code = """
-                   <div id="fingerprint-storage" style="display:none;"></div>
-                   <script>
-                       document.addEventListener('fingerprint_ready', function(e) {
-                           const storage = document.getElementById('fingerprint-storage');
-                           if (storage) {
-                               storage.textContent = e.detail;
-                           }
-                       });
-                   </script>
-                   """
-                   html(js_code, height=0)
-
                    if submit_button:
                        st.session_state.registro_form_nome = nome
                        st.session_state.registro_form_email = email
 
-                       if nome and email:
+                       rejection = admit('registration') if nome and email else None
+                       if rejection:
+                           st.warning(rejection)
+                       elif nome and email and not verify_checkin_code(current_class_id(), codigo):
+                           get_rate_limiters()['registration'].count('invalid_code')
+                           st.error("Código da aula inválido ou expirado. Confira o código na tela do professor.")
+                       elif nome and email:
                            # Get browser fingerprint for duplicate prevention
                            browser_fp = st.session_state.get('browser_fingerprint')
                            
@@ -670,22 +2958,10 @@ def main():
        # Sidebar with attendance list
        with st.sidebar:
            st.header("👨🏻‍🎓 Alunos Presentes")
+           display_roster_panel()
            
-           # Refresh data periodically
-           current_registros = load_attendance_data()
-           
-           if not current_registros.empty:
-               st.subheader(f"Total: {len(current_registros)}")
-               alunos_ordenados = current_registros.sort_values(by='Nome')
-               
-               # Use container for better performance with large lists
-               with st.container():
-                   for _, aluno in alunos_ordenados.iterrows():
-                       st.write(f"**{aluno['Nome']}**")
-                       st.write(f"<small>{aluno['Data_Hora']}</small>", unsafe_allow_html=True)
-                       st.divider()
-           else:
-               st.write("Nenhum aluno registrado!")
+           if tracer.enabled:
+               display_metrics_panel()
 
        st.markdown("---")
        st.markdown(f"<div style='text-align: center;'>{get_brazil_datetime()}</div>", unsafe_allow_html=True)
@@ -705,48 +2981,3 @@ def main():
 
 if __name__ == "__main__":
    main()
-
-st.markdown("""
-<style>
-    .main {
-        background-color: #ffffff;
-        color: #333333;
-    }
-    .block-container {
-        padding-top: 1rem;
-        padding-bottom: 0rem;
-    }
-    /* Esconde o menu principal e footer, MAS mantém o botão do sidebar */
-    #MainMenu {visibility: hidden !important;}
-    footer {visibility: hidden !important;}
-    
-    /* Mantém o botão de toggle do sidebar visível */
-    button[kind="header"] {
-        display: block !important;
-        visibility: visible !important;
-    }
-    
-    /* Remove qualquer espaço em branco adicional */
-    div[data-testid="stAppViewBlockContainer"] {
-        padding-top: 0 !important;
-        padding-bottom: 0 !important;
-    }
-    div[data-testid="stVerticalBlock"] {
-        gap: 0 !important;
-        padding-top: 0 !important;
-        padding-bottom: 0 !important;
-    }
-    /* Remove quaisquer margens extras */
-    .element-container {
-        margin-top: 0 !important;
-        margin-bottom: 0 !important;
-    }
-    
-    /* Garante que o header com o botão do sidebar fique visível */
-    header[data-testid="stHeader"] {
-        display: block !important;
-        visibility: visible !important;
-        background-color: transparent !important;
-    }
-</style>
-""", unsafe_allow_html=True)
\ No newline at end of file
@@ -0,0 +1,84 @@
+"""Attendance history: import old CSV backups into the archive and query it.
+
+Usage:
+   python archive.py import lista_presenca_*.csv
+   python archive.py rates [--turma NOME] [--since AAAA-MM-DD] [--until AAAA-MM-DD]
+   python archive.py student EMAIL [--since AAAA-MM-DD] [--until AAAA-MM-DD]
+
+Closed lists reach the archive on their own (the class scheduler moves each one
+there after emailing it); `import` brings in the backups written before that.
+Uses the same database as the app: ATTENDANCE_DB / attendance.db, or database_url.
+"""
+import argparse
+import datetime
+import logging
+import sys
+
+# Silence the bare-mode warnings Streamlit prints when app.py is imported outside `streamlit run`
+logging.disable(logging.WARNING)
+
+import app  # noqa: E402
+
+def parse_date(text):
+   """Epoch of midnight (Brazil time) of an AAAA-MM-DD date."""
+   moment = datetime.datetime.strptime(text, '%Y-%m-%d')
+   return int(app.BRAZIL_TZ.localize(moment).timestamp())
+
+def period(args):
+   since = parse_date(args.since) if args.since else 0
+   until = parse_date(args.until) + 86400 if args.until else 2 ** 62
+   return since, until
+
+def percent(attended, held):
+   return f"{100 * attended / held:.1f}%" if held else "-"
+
+def cmd_import(args):
+   """Archive lista_presenca_*.csv backups; files already imported are skipped."""
+   for path in args.files:
+       try:
+           count = app.import_attendance_backup(path)
+       except (OSError, ValueError, KeyError) as e:
+           print(f"{path}: error: {e}", file=sys.stderr)
+           continue
+       print(f"{path}: {'already imported' if count is None else f'{count} students'}")
+
+def cmd_rates(args):
+   """Attendance % per student of one class."""
+   storage = app.get_storage()
+   class_id = storage.find_class(args.turma)
+   if class_id is None:
+       sys.exit(f"Unknown class: {args.turma}")
+   rows = storage.attendance_rates(class_id, *period(args))
+   print(f"{'email':<40} {'nome':<30} {'lists':>9} {'%':>7}")
+   for email, nome, attended, held in rows:
+       print(f"{email:<40} {nome[:30]:<30} {f'{attended}/{held}':>9} {percent(attended, held):>7}")
+
+def cmd_student(args):
+   """Attendance % of one student in every class they attended."""
+   storage = app.get_storage()
+   print(f"{'turma':<30} {'lists':>9} {'%':>7}")
+   for class_id, attended, held in storage.student_attendance(args.email, *period(args)):
+       name = storage.class_name(class_id) or class_id
+       print(f"{name:<30} {f'{attended}/{held}':>9} {percent(attended, held):>7}")
+
+def main():
+   parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+   sub = parser.add_subparsers(dest='command', required=True)
+   imports = sub.add_parser('import', help=cmd_import.__doc__)
+   imports.add_argument('files', nargs='+')
+   imports.set_defaults(func=cmd_import)
+   rates = sub.add_parser('rates', help=cmd_rates.__doc__)
+   rates.add_argument('--turma', default=app.DEFAULT_CLASS_NAME)
+   rates.set_defaults(func=cmd_rates)
+   student = sub.add_parser('student', help=cmd_student.__doc__)
+   student.add_argument('email')
+   student.set_defaults(func=cmd_student)
+   for command in (rates, student):
+       command.add_argument('--since', help="first day (AAAA-MM-DD)")
+       command.add_argument('--until', help="last day, inclusive (AAAA-MM-DD)")
+   args = parser.parse_args()
+   app.ensure_schema()
+   args.func(args)
+
+if __name__ == "__main__":
+   sys.exit(main())
@@ -0,0 +1,520 @@
+"""Benchmarks for the List Web App hot paths.
+
+Usage: python benchmark.py [--database-url URL] {feed,registrations,rotate,archive,api,startup,sessions,load}
+
+`load` drives the real app with Streamlit's AppTest (N student sessions against a
+temporary database), then hammers the helpers directly from N threads, and saves
+the results as JSON so runs can be compared across commits with --compare.
+
+Without --database-url (or DATABASE_URL) everything runs on a temporary SQLite file;
+with it, point the benchmark at an empty PostgreSQL database.
+"""
+import argparse
+import datetime
+import itertools
+import json
+import logging
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Point the app at a throwaway database before importing it
+os.environ.setdefault('ATTENDANCE_DB', os.path.join(tempfile.mkdtemp(), 'attendance.db'))
+# Silence the bare-mode warnings Streamlit prints when app.py is imported outside `streamlit run`
+logging.disable(logging.WARNING)
+
+import app  # noqa: E402
+from streamlit.testing.v1 import AppTest  # noqa: E402
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app.py')
+PROFESSOR_PASSWORD = 'benchmark'
+
+def populate(n, start=0):
+   """Insert n fake students directly through the storage backend."""
+   app.get_storage().register_batch(
+       [(app.DEFAULT_CLASS_ID, f"Aluno {i:06d}", f"aluno{i}@example.com", int(time.time()), 'bench', None)
+        for i in range(start, start + n)]
+   )
+
+def timed(func, repeat):
+   """Return the mean wall time of func() in milliseconds."""
+   start = time.perf_counter()
+   for _ in range(repeat):
+       func()
+   return (time.perf_counter() - start) * 1000 / repeat
+
+def bench_feed(args):
+   """Per-rerun roster cost: full table load vs incremental refresh vs written-through index."""
+   app.init_database()
+   app.get_storage().start_class(app.DEFAULT_CLASS_ID, 'bench')
+   feed = app.RosterIndex(app.DEFAULT_CLASS_ID)
+   total = 0
+   print(f"{'rows':>8} {'full load (ms)':>16} {'incremental (ms)':>18} {'write-through (ms)':>20}")
+   for size in args.sizes:
+       populate(size - total, start=total)
+       total = size
+       feed.refresh()
+       full = timed(lambda: app.get_storage().attendance_rows(app.DEFAULT_CLASS_ID), args.repeat)
+
+       # One new check-in between reruns, as during a live class
+       elapsed = 0.0
+       for _ in range(args.repeat):
+           populate(1, start=total)
+           total += 1
+           start = time.perf_counter()
+           feed.refresh()
+           elapsed += time.perf_counter() - start
+
+       # Registrations made by this process reach the index without any query
+       written = 0.0
+       for _ in range(args.repeat):
+           row = (app.DEFAULT_CLASS_ID, f"Aluno {total:06d}", f"aluno{total}@example.com", int(time.time()), 'bench', None)
+           (row_id, generation), = app.get_storage().register_batch([row])
+           entry = app.RosterEntry(row_id, *row[1:4])
+           total += 1
+           start = time.perf_counter()
+           feed.add(entry, generation)
+           feed.snapshot()
+           written += time.perf_counter() - start
+       print(f"{size:>8} {full:>16.3f} {elapsed * 1000 / args.repeat:>18.3f} {written * 1000 / args.repeat:>20.3f}")
+
+def bench_registrations(args):
+   """Registrations per second: one transaction per student vs the batching writer."""
+   app.init_database()
+   app.get_storage().start_class(app.DEFAULT_CLASS_ID, 'bench')
+   storage = app.get_storage()
+   writer = app.get_registration_writer()
+
+   def direct(row):
+       # The pre-batching path: duplicate check and INSERT in their own transaction
+       with storage.write() as conn:
+           if storage.execute(conn, "SELECT COUNT(*) FROM attendance WHERE email = ?", (row[1],)).fetchone()[0]:
+               return False
+           storage.execute(conn, "INSERT INTO attendance (nome, email, registered_at, session_id) VALUES (?, ?, ?, ?)", row)
+           return True
+
+   def batched(row):
+       return writer.submit(app.DEFAULT_CLASS_ID, *row).result(timeout=30)
+
+   print(f"{'path':>8} {'students':>9} {'sessions':>9} {'regs/s':>10}")
+   for name, register in (('direct', direct), ('batched', batched)):
+       rows = [(f"Aluno {i:06d}", f"{name}{i}@example.com", int(time.time()), 'bench')
+               for i in range(args.students)]
+       start = time.perf_counter()
+       with ThreadPoolExecutor(max_workers=args.sessions) as executor:
+           results = list(executor.map(register, rows))
+       elapsed = time.perf_counter() - start
+       assert all(results)
+       print(f"{name:>8} {args.students:>9} {args.sessions:>9} {args.students / elapsed:>10.0f}")
+
+def bench_rotate(args):
+   """Finalizar Lista cost: the old single DELETE vs a generation rotation, plus the background move to the archive."""
+   app.init_database()
+   storage = app.get_storage()
+   class_id = app.DEFAULT_CLASS_ID
+   print(f"{'rows':>8} {'DELETE (ms)':>12} {'rotate (ms)':>12} {'archive (ms)':>13} {'longest batch (ms)':>19}")
+   for size in args.sizes:
+       # The pre-rotation reset: one statement deletes the whole list under the write lock
+       storage.start_class(class_id, 'bench')
+       populate(size)
+       start = time.perf_counter()
+       with storage.write() as conn:
+           storage.execute(conn, "DELETE FROM attendance WHERE class_id = ?", (class_id,))
+       delete = (time.perf_counter() - start) * 1000
+
+       storage.start_class(class_id, 'bench')
+       populate(size)
+       start = time.perf_counter()
+       generation = storage.rotate_class(class_id)
+       rotate = (time.perf_counter() - start) * 1000
+
+       # What the class scheduler does afterwards, off the professor's request
+       list_id = storage.archive_list(class_id, generation, int(time.time()))
+       batches = []
+       while True:
+           start = time.perf_counter()
+           moved = storage.archive_generation(class_id, generation, list_id, args.batch)
+           batches.append((time.perf_counter() - start) * 1000)
+           if not moved:
+               break
+       print(f"{size:>8} {delete:>12.3f} {rotate:>12.3f} {sum(batches):>13.3f} {max(batches):>19.3f}")
+
+def bench_archive(args):
+   """History queries over a semester-sized archive: attendance % per student of a class, and of one student."""
+   app.init_database()
+   storage = app.get_storage()
+   rng = random.Random(args.seed)
+   semester_start = int(time.time()) - args.lists * 7 * 86400
+   start = time.perf_counter()
+   for c in range(args.classes):
+       class_id = storage.create_class(f"bench_{c}")
+       for n in range(args.lists):
+           closed_at = semester_start + n * 7 * 86400
+           # Each student of the class shows up to roughly 80% of its lists
+           rows = [(f"Aluno {i:06d}", f"aluno{c}_{i}@example.com", closed_at - rng.randrange(3600))
+                   for i in range(args.students) if rng.random() < 0.8]
+           storage.import_list(class_id, closed_at, f"bench_{c}_{n}", rows)
+   print(f"archived {args.classes * args.lists} lists, ~{int(args.classes * args.lists * args.students * 0.8)} rows "
+         f"in {time.perf_counter() - start:.1f}s")
+
+   class_id = storage.find_class("bench_0")
+   half = semester_start + args.lists * 7 * 86400 // 2
+   queries = (
+       ('class rates (semester)', lambda: storage.attendance_rates(class_id)),
+       ('class rates (2nd half)', lambda: storage.attendance_rates(class_id, half)),
+       ('student (semester)', lambda: storage.student_attendance(f"aluno0_{rng.randrange(args.students)}@example.com")),
+   )
+   print(f"{'query':>24} {'ms':>10}")
+   for name, query in queries:
+       print(f"{name:>24} {timed(query, args.repeat):>10.3f}")
+
+def bench_api(args):
+   """Check-ins per second through the JSON API: N kiosks, each posting over one keep-alive connection."""
+   import http.client
+   app.init_database()
+   app.get_storage().start_class(app.DEFAULT_CLASS_ID, 'bench')
+   server = app.CheckinAPI().serve('127.0.0.1', 0)
+   port = server.server_address[1]
+   latencies = []
+   statuses = {}
+   lock = threading.Lock()
+
+   def kiosk(k):
+       connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+       # Each kiosk is its own address for the per-IP rate limit
+       headers = {'Content-Type': 'application/json', 'X-Forwarded-For': f'10.0.{k // 256}.{k % 256}'}
+       for i in range(args.per_kiosk):
+           # Kiosks read the rotating code off the professor's screen, like the students
+           codigo = app.current_checkin_code(app.DEFAULT_CLASS_ID)
+           body = json.dumps({'nome': f"Aluno {k}-{i}", 'email': f"api{k}_{i}@example.com", 'codigo': codigo})
+           start = time.perf_counter()
+           connection.request('POST', '/api/checkin', body=body, headers=headers)
+           response = connection.getresponse()
+           response.read()
+           elapsed = (time.perf_counter() - start) * 1000
+           with lock:
+               latencies.append(elapsed)
+               statuses[response.status] = statuses.get(response.status, 0) + 1
+       connection.close()
+
+   start = time.perf_counter()
+   with ThreadPoolExecutor(max_workers=args.kiosks) as executor:
+       list(executor.map(kiosk, range(args.kiosks)))
+   elapsed = time.perf_counter() - start
+   server.shutdown()
+   stats = percentiles(latencies)
+   print(f"kiosks: {args.kiosks}, check-ins: {len(latencies)}, statuses: {statuses}")
+   print(f"check-ins/s: {statuses.get(201, 0) / elapsed:.0f} ({statuses.get(201, 0) / elapsed * 60:.0f}/min)")
+   print(f"latency (ms): p50 {stats['p50']:.2f}, p95 {stats['p95']:.2f}, p99 {stats['p99']:.2f}")
+
+def percentiles(samples):
+   """p50/p95/p99 and mean of a list of millisecond samples."""
+   if len(samples) < 2:
+       return {'count': len(samples), 'mean': samples[0] if samples else None}
+   cuts = statistics.quantiles(samples, n=100, method='inclusive')
+   return {
+       'count': len(samples),
+       'mean': statistics.fmean(samples),
+       'p50': cuts[49],
+       'p95': cuts[94],
+       'p99': cuts[98],
+   }
+
+def app_resource(name):
+   """Return a st.cache_resource singleton created by the AppTest-run script.
+
+   AppTest executes app.py as __main__, so calling app.<name>() here would build a
+   second instance; this reads Streamlit's resource cache instead (internal API).
+   """
+   from streamlit.runtime.caching import cache_resource_api
+   for cache in list(cache_resource_api._resource_caches._function_caches.values()):
+       if cache.display_name == f"__main__.{name}":
+           with cache._mem_cache_lock:
+               results = list(cache._mem_cache.values())
+           if results:
+               return results[0].value
+   return None
+
+def new_session(args):
+   at = AppTest.from_file(APP_PATH, default_timeout=args.timeout)
+   at.secrets['senha_professor'] = PROFESSOR_PASSWORD
+   return at
+
+def timed_run(at, latencies):
+   """Rerun a session and record its latency in milliseconds."""
+   start = time.perf_counter()
+   at.run()
+   latencies.append((time.perf_counter() - start) * 1000)
+   if at.exception:
+       raise RuntimeError(at.exception[0].value)
+
+def start_class_as_professor(args):
+   """Open the list through the UI: password plus CAPTCHA."""
+   at = new_session(args).run()
+   at.button(key="btn_start").click().run()
+   question = at.session_state.captcha_pergunta
+   answer = sum(int(n) for n in question.rstrip('?').split('é')[1].split('+'))
+   at.text_input(key="captcha_input").input(str(answer))
+   at.text_input(key="senha_input").input(PROFESSOR_PASSWORD)
+   next(b for b in at.button if b.label == "Confirmar").click().run()
+   if not at.session_state.aula_iniciada:
+       raise RuntimeError("professor could not start the class")
+
+def bench_load_apptest(args):
+   """Student sessions arriving over the window: idle reruns, one submit, one rerun after it.
+
+   AppTest tears down a global test runtime after every run, so runs cannot overlap
+   in one process; the sessions' reruns are interleaved in arrival order instead.
+   """
+   start_class_as_professor(args)
+   storage = app_resource('get_storage')
+   statements = itertools.count()
+   storage.set_trace_callback(lambda sql: next(statements))
+   stats_before = storage.stats()
+   
+   # (time, session index, step) for every rerun, replayed in time order
+   events = []
+   for index in range(args.sessions):
+       arrival = random.uniform(0, args.window)
+       for step in range(args.idle_reruns + 3):
+           events.append((arrival + step * random.uniform(0.5, 2.0), index, step))
+   events.sort()
+   
+   sessions = {}
+   latencies, submit_latencies, registered = [], [], 0
+   start = time.perf_counter()
+   for _, index, step in events:
+       if step == 0:
+           sessions[index] = new_session(args)
+       at = sessions[index]
+       if step == args.idle_reruns + 1:
+           at.text_input(key="registro_form_nome_input").input(f"Aluno {index:05d}")
+           at.text_input(key="registro_form_email_input").input(f"aluno{index}@example.com")
+           # Same database, so this process derives the code the professor's screen shows
+           at.text_input(key="registro_form_codigo_input").input(app.current_checkin_code(app.DEFAULT_CLASS_ID))
+           next(b for b in at.button if b.label == "Registrar Presença").click()
+           timed_run(at, submit_latencies)
+           registered += not at.error
+       else:
+           timed_run(at, latencies)
+   elapsed = time.perf_counter() - start
+   
+   stats_after = storage.stats()
+   reruns = len(latencies) + len(submit_latencies)
+   return {
+       'sessions': args.sessions,
+       'reruns': reruns,
+       'elapsed_s': elapsed,
+       'rerun_ms': percentiles(latencies),
+       'submit_rerun_ms': percentiles(submit_latencies),
+       'registrations': registered,
+       'registrations_per_s': registered / elapsed,
+       'writer_lock_waits': stats_after['waits'] - stats_before['waits'],
+       'queries_per_rerun': next(statements) / reruns,
+       'rejections': sum(sum(limiter.rejections.values()) for limiter in (app_resource('get_rate_limiters') or {}).values()),
+       'pool': stats_after,
+   }
+
+def bench_load_direct(args):
+   """Concurrent direct calls into the hot-path helpers, without the Streamlit script around them."""
+   app.init_database()
+   app.st.session_state.session_id = 'benchmark'
+   storage = app.get_storage()
+   stats_before = storage.stats()
+   emails = itertools.count()
+   samples = {'load_class_state': [], 'load_roster': [], 'add_attendance_record': []}
+   lock = threading.Lock()
+   
+   def call(name):
+       func = {
+           'load_class_state': app.load_class_state,
+           'load_roster': app.load_roster,
+           'add_attendance_record': lambda: app.add_attendance_record("Aluno direto", f"direto{next(emails)}@example.com"),
+       }[name]
+       start = time.perf_counter()
+       func()
+       elapsed = (time.perf_counter() - start) * 1000
+       with lock:
+           samples[name].append(elapsed)
+   
+   # The mix of a live class: mostly rereads, with one registration per few reruns
+   calls = ['load_class_state', 'load_roster'] * 2 * args.repeat + ['add_attendance_record'] * args.repeat
+   random.shuffle(calls)
+   start = time.perf_counter()
+   with ThreadPoolExecutor(max_workers=args.sessions) as executor:
+       list(executor.map(call, calls))
+   elapsed = time.perf_counter() - start
+   
+   results = {f'{name}_ms': percentiles(values) for name, values in samples.items()}
+   results['threads'] = args.sessions
+   results['registrations_per_s'] = args.repeat / elapsed
+   results['writer_lock_waits'] = storage.stats()['waits'] - stats_before['waits']
+   return results
+
+STARTUP_SCRIPT = """
+import importlib.util, json, logging, resource, sys, time
+logging.disable(logging.WARNING)
+start = time.perf_counter()
+spec = importlib.util.spec_from_file_location('app', sys.argv[1])
+# declare_component looks the calling module up in sys.modules
+module = sys.modules['app'] = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+print(json.dumps({
+   'import_s': time.perf_counter() - start,
+   'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+   'heavy_modules': [name for name in sys.argv[2:] if name in sys.modules],
+}))
+"""
+HEAVY_MODULES = ['pandas', 'numpy', 'pyarrow', 'openpyxl', 'smtplib', 'email.mime.multipart', 'psycopg']
+
+def bench_startup(args):
+   """Cold start of a worker: time to import app.py and the process RSS, in fresh interpreters."""
+   env = dict(os.environ, ATTENDANCE_DB=os.path.join(tempfile.mkdtemp(), 'attendance.db'))
+   runs = []
+   for _ in range(args.repeat):
+       output = subprocess.run(
+           [sys.executable, '-c', STARTUP_SCRIPT, args.app] + HEAVY_MODULES,
+           capture_output=True, text=True, check=True, env=env
+       ).stdout
+       runs.append(json.loads(output.splitlines()[-1]))
+   import_ms = [run['import_s'] * 1000 for run in runs]
+   print(f"app:            {args.app}")
+   print(f"import (ms):    median {statistics.median(import_ms):.0f}, min {min(import_ms):.0f}")
+   print(f"max RSS (MB):   {statistics.median(run['max_rss_mb'] for run in runs):.1f}")
+   print(f"heavy modules:  {', '.join(runs[0]['heavy_modules']) or 'none'}")
+
+SESSIONS_SCRIPT = """
+import gc, json, logging, resource, sys
+logging.disable(logging.WARNING)
+from streamlit.testing.v1 import AppTest
+path, sessions, step = sys.argv[1], int(sys.argv[2]), int(sys.argv[3])
+apps, samples = [], []
+for i in range(1, sessions + 1):
+   # Every AppTest is its own browser session; keeping them alive keeps their session_state
+   at = AppTest.from_file(path, default_timeout=60)
+   at.run()
+   apps.append(at)
+   if i == 1 or i % step == 0:
+       gc.collect()
+       samples.append((i, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+print(json.dumps(samples))
+"""
+
+def bench_sessions(args):
+   """Memory per open session: RSS while N sessions with a large roster stay open, in a fresh interpreter."""
+   app.init_database()
+   app.get_storage().start_class(app.DEFAULT_CLASS_ID, 'bench')
+   populate(args.rows)
+   output = subprocess.run(
+       [sys.executable, '-c', SESSIONS_SCRIPT, args.app, str(args.sessions), str(args.step)],
+       capture_output=True, text=True, check=True, env=dict(os.environ, ATTENDANCE_DB=app.DB_PATH)
+   ).stdout
+   samples = json.loads(output.splitlines()[-1])
+   print(f"app: {args.app}, roster: {args.rows} students")
+   print(f"{'sessions':>9} {'max RSS (MB)':>13}")
+   for sessions, rss in samples:
+       print(f"{sessions:>9} {rss:>13.1f}")
+   # The first step also pays for warming up the process-wide caches
+   (first, first_rss), (last, last_rss) = samples[1 if len(samples) > 2 else 0], samples[-1]
+   print(f"RSS per 100 sessions: {(last_rss - first_rss) / (last - first) * 100:.1f} MB")
+
+def git_commit():
+   try:
+       return subprocess.run(
+           ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+           cwd=os.path.dirname(APP_PATH), check=True
+       ).stdout.strip()
+   except (OSError, subprocess.CalledProcessError):
+       return None
+
+def compare(previous, current, path=()):
+   """Print numeric metrics that changed between two result files."""
+   for key, value in current.items():
+       if key == 'params':
+           continue
+       old = previous.get(key) if isinstance(previous, dict) else None
+       if isinstance(value, dict):
+           compare(old or {}, value, path + (key,))
+       elif isinstance(value, (int, float)) and isinstance(old, (int, float)) and old:
+           print(f"{'.'.join(path + (key,)):<45} {old:>12.3f} -> {value:>12.3f} ({(value - old) / old:+.1%})")
+
+def bench_load(args):
+   """Simulate a class checking in: AppTest sessions plus direct helper calls, saved as JSON."""
+   random.seed(args.seed)
+   results = {
+       'commit': git_commit(),
+       'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+       'params': {k: v for k, v in vars(args).items() if k not in ('func', 'command', 'compare', 'output', 'database_url')},
+       'apptest': bench_load_apptest(args),
+       'direct': bench_load_direct(args),
+   }
+   print(json.dumps(results, indent=2))
+   with open(args.output, 'w') as f:
+       json.dump(results, f, indent=2)
+   if args.compare:
+       with open(args.compare) as f:
+           previous = json.load(f)
+       print(f"\nChanges since {previous.get('commit')}:")
+       compare(previous, results)
+
+def main():
+   parser = argparse.ArgumentParser(description=__doc__)
+   parser.add_argument('--database-url', help="PostgreSQL URL to benchmark instead of SQLite")
+   sub = parser.add_subparsers(dest='command', required=True)
+   feed = sub.add_parser('feed', help=bench_feed.__doc__)
+   feed.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 5000, 20000])
+   feed.add_argument('--repeat', type=int, default=20)
+   feed.set_defaults(func=bench_feed)
+   registrations = sub.add_parser('registrations', help=bench_registrations.__doc__)
+   registrations.add_argument('--students', type=int, default=3000)
+   registrations.add_argument('--sessions', type=int, default=300)
+   registrations.set_defaults(func=bench_registrations)
+   rotate = sub.add_parser('rotate', help=bench_rotate.__doc__)
+   rotate.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+   rotate.add_argument('--batch', type=int, default=500, help="rows per archive transaction")
+   rotate.set_defaults(func=bench_rotate)
+   archive = sub.add_parser('archive', help=bench_archive.__doc__)
+   archive.add_argument('--classes', type=int, default=20)
+   archive.add_argument('--lists', type=int, default=30, help="closed lists per class")
+   archive.add_argument('--students', type=int, default=500, help="students per class")
+   archive.add_argument('--repeat', type=int, default=20)
+   archive.add_argument('--seed', type=int, default=0)
+   archive.set_defaults(func=bench_archive)
+   startup = sub.add_parser('startup', help=bench_startup.__doc__)
+   startup.add_argument('--app', default=APP_PATH, help="app.py to import, e.g. a checkout of an older commit")
+   startup.add_argument('--repeat', type=int, default=5)
+   startup.set_defaults(func=bench_startup)
+   sessions = sub.add_parser('sessions', help=bench_sessions.__doc__)
+   sessions.add_argument('--app', default=APP_PATH, help="app.py to run, e.g. a checkout of an older commit")
+   sessions.add_argument('--sessions', type=int, default=300)
+   sessions.add_argument('--step', type=int, default=100, help="report RSS every STEP sessions")
+   sessions.add_argument('--rows', type=int, default=5000, help="students in the roster")
+   sessions.set_defaults(func=bench_sessions)
+   api = sub.add_parser('api', help=bench_api.__doc__)
+   api.add_argument('--kiosks', type=int, default=20)
+   api.add_argument('--per-kiosk', type=int, default=200, help="check-ins posted by each kiosk")
+   api.set_defaults(func=bench_api)
+   load = sub.add_parser('load', help=bench_load.__doc__)
+   load.add_argument('--sessions', type=int, default=50, help="student sessions (and threads for direct calls)")
+   load.add_argument('--window', type=float, default=10.0, help="simulated seconds over which students arrive")
+   load.add_argument('--idle-reruns', type=int, default=3, help="reruns per student before submitting")
+   load.add_argument('--repeat', type=int, default=200, help="samples per direct call")
+   load.add_argument('--timeout', type=float, default=60.0, help="AppTest per-run timeout")
+   load.add_argument('--seed', type=int, default=0)
+   load.add_argument('--output', default='bench_results.json')
+   load.add_argument('--compare', help="previous results JSON to diff against")
+   load.set_defaults(func=bench_load)
+   args = parser.parse_args()
+   if args.database_url:
+       # Read by app.get_storage(), also in the AppTest-run copy of the app
+       os.environ['DATABASE_URL'] = args.database_url
+   args.func(args)
+
+if __name__ == "__main__":
+   sys.exit(main())
@@ -0,0 +1,88 @@
+"""Fixtures shared by the suite: every test that takes `database` runs once per backend.
+
+SQLite uses a fresh file per test. PostgreSQL uses a fresh database per test, created
+on LISTAPP_TEST_DATABASE_URL (a role allowed to CREATE DATABASE) or, when that is not
+set, on a throwaway server started with pgserver; without either the Postgres runs
+are skipped.
+"""
+import logging
+import os
+import tempfile
+import uuid
+
+import pytest
+
+# Silence the bare-mode warnings Streamlit prints when app.py is imported outside `streamlit run`
+logging.disable(logging.WARNING)
+
+import streamlit as st  # noqa: E402
+
+import app  # noqa: E402
+
+@pytest.fixture(scope="session")
+def postgres_url():
+   """URL of a PostgreSQL server the suite may create databases on."""
+   url = os.environ.get('LISTAPP_TEST_DATABASE_URL')
+   if url:
+       return url
+   pgserver = pytest.importorskip("pgserver", reason="set LISTAPP_TEST_DATABASE_URL or install pgserver")
+   pytest.importorskip("psycopg_pool")
+   server = pgserver.get_server(tempfile.mkdtemp(prefix="listapp-pg-"), cleanup_mode='stop')
+   return server.get_uri()
+
+@pytest.fixture(params=["sqlite", "postgres"])
+def database(request, tmp_path):
+   """(backend, location) of an empty database: a file path for SQLite, a URL for PostgreSQL."""
+   if request.param == "sqlite":
+       yield "sqlite", str(tmp_path / "attendance.db")
+       return
+   import psycopg
+   from psycopg.conninfo import make_conninfo
+   server_url = request.getfixturevalue("postgres_url")
+   name = f"listapp_test_{uuid.uuid4().hex[:12]}"
+   with psycopg.connect(server_url, autocommit=True) as conn:
+       conn.execute(f"CREATE DATABASE {name}")
+   yield "postgres", make_conninfo(server_url, dbname=name)
+   with psycopg.connect(server_url, autocommit=True) as conn:
+       # FORCE, because pools of the app's background workers may still hold connections
+       conn.execute(f"DROP DATABASE IF EXISTS {name} WITH (FORCE)")
+
+def open_storage(backend, location):
+   """A storage backend on the given database, without running migrations."""
+   if backend == "sqlite":
+       return app.SQLiteStorage(location)
+   return app.PostgresStorage(location, max_size=4)
+
+def close_storage(storage):
+   if isinstance(storage, app.PostgresStorage):
+       storage.pool.close()
+
+@pytest.fixture
+def storage(database):
+   """A migrated storage backend on a fresh database."""
+   storage = open_storage(*database)
+   storage.migrate()
+   yield storage
+   close_storage(storage)
+
+@pytest.fixture
+def app_storage(database, monkeypatch, tmp_path):
+   """Point the app's process-wide singletons at a fresh, migrated database; returns get_storage().
+
+   Backup CSVs land in tmp_path. The caches are cleared on both sides, so no test
+   sees another's storage, roster indexes or class state.
+   """
+   backend, location = database
+   monkeypatch.chdir(tmp_path)
+   if backend == "sqlite":
+       monkeypatch.setattr(app, 'DB_PATH', location)
+       monkeypatch.delenv('DATABASE_URL', raising=False)
+   else:
+       monkeypatch.setenv('DATABASE_URL', location)
+   st.cache_resource.clear()
+   app.checkin_code_seconds.cache_clear()
+   app.ensure_schema()
+   storage = app.get_storage()
+   yield storage
+   st.cache_resource.clear()
+   close_storage(storage)
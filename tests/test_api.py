@@ -0,0 +1,142 @@
+"""The check-in API over HTTP, with the app's singletons on each backend."""
+import http.client
+import json
+
+import pytest
+
+import app
+
+CLASS_ID = app.DEFAULT_CLASS_ID
+
+@pytest.fixture
+def api_port(app_storage):
+   """Port of a CheckinAPI started on a free port."""
+   server = app.CheckinAPI().serve('127.0.0.1', 0)
+   yield server.server_address[1]
+   server.shutdown()
+   server.server_close()
+
+@pytest.fixture
+def api(api_port):
+   """A request(method, path, body=None, headers=None) helper for the API on api_port."""
+   port = api_port
+
+   def request(method, path, body=None, headers=None):
+       conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+       if body is not None and not isinstance(body, (str, bytes)):
+           body = json.dumps(body)
+       conn.request(method, path, body=body, headers=headers or {})
+       response = conn.getresponse()
+       payload = response.read()
+       conn.close()
+       return response.status, response, json.loads(payload) if payload else None
+
+   return request
+
+def open_class(class_id=CLASS_ID):
+   app.get_storage().start_class(class_id, 'prof')
+   app.invalidate_class_state(class_id)
+
+def checkin(nome, email, class_id=CLASS_ID, **fields):
+   return {'nome': nome, 'email': email, 'codigo': app.current_checkin_code(class_id), **fields}
+
+def test_checkin_needs_an_open_class(api):
+   status, _, body = api('POST', '/api/checkin', {'nome': 'Ana', 'email': 'ana@x.com', 'codigo': '123456'})
+   assert status == 409 and body['error'] == 'class_closed'
+
+def test_checkin_and_duplicates(api):
+   open_class()
+   status, _, body = api('POST', '/api/checkin', checkin('Ana', 'ana@x.com', fingerprint='f1'))
+   assert status == 201
+   assert body == {'turma': app.DEFAULT_CLASS_NAME, 'nome': 'Ana', 'email': 'ana@x.com'}
+   assert api('POST', '/api/checkin', checkin('Ana', 'ana@x.com'))[2]['error'] == 'duplicate'
+   # Same device, another email
+   assert api('POST', '/api/checkin', checkin('Bia', 'bia@x.com', fingerprint='f1'))[2]['error'] == 'duplicate'
+   assert [email for _, email, _ in app.get_storage().attendance_rows(CLASS_ID)] == ['ana@x.com']
+
+def test_checkin_code_is_required(api):
+   open_class()
+   assert api('POST', '/api/checkin', {'nome': 'Ana', 'email': 'ana@x.com'})[0] == 403
+   status, _, body = api('POST', '/api/checkin', {'nome': 'Ana', 'email': 'ana@x.com', 'codigo': '000000x'})
+   assert status == 403 and body['error'] == 'invalid_code'
+
+@pytest.mark.parametrize('body, error', [
+   ('{quebrado', 'invalid_json'),
+   ('[1, 2]', 'invalid_json'),
+   ({'nome': '', 'email': 'ana@x.com'}, 'missing_fields'),
+   ({'nome': 'A' * 500, 'email': 'ana@x.com'}, 'field_too_long'),
+])
+def test_checkin_rejects_bad_bodies(api, body, error):
+   open_class()
+   status, _, payload = api('POST', '/api/checkin', body)
+   assert status == 400 and payload['error'] == error
+
+def test_body_too_large(api):
+   status, _, body = api('POST', '/api/checkin', 'x' * (app.CheckinAPI.MAX_BODY + 1))
+   assert status == 413 and body['error'] == 'body_too_large'
+
+@pytest.mark.parametrize('length', ['abc', '-5', '1.5'])
+def test_malformed_content_length(api_port, length):
+   conn = http.client.HTTPConnection('127.0.0.1', api_port, timeout=10)
+   conn.putrequest('POST', '/api/checkin')
+   conn.putheader('Content-Length', length)
+   conn.endheaders()
+   response = conn.getresponse()
+   status, body = response.status, json.loads(response.read())
+   conn.close()
+   assert status == 400 and body['error'] == 'invalid_length'
+
+def test_internal_errors_stay_in_the_log(api, monkeypatch, caplog):
+   def broken(*args):
+       raise RuntimeError("connection to /var/lib/listapp/attendance.db failed")
+   monkeypatch.setattr(app, 'load_class_state_snapshot', broken)
+   status, _, body = api('GET', '/api/state')
+   assert status == 500 and body['error'] == 'internal_error'
+   assert 'attendance.db' not in body['message']
+   assert 'attendance.db' in caplog.text
+
+def test_unknown_routes_and_classes(api):
+   assert api('GET', '/api/nada')[0] == 404
+   status, _, body = api('GET', '/api/state?turma=inexistente')
+   assert status == 404 and body['error'] == 'class_not_found'
+
+def test_classes_are_selected_by_turma(api):
+   fisica = app.get_storage().create_class('fisica')
+   open_class(fisica)
+   assert api('GET', '/api/state')[2]['aula_iniciada'] is False
+   assert api('GET', '/api/state?turma=fisica')[2] == {'turma': 'fisica', 'aula_iniciada': True, 'timer_end_time': None}
+   assert api('POST', '/api/checkin?turma=fisica', checkin('Ana', 'ana@x.com', fisica))[0] == 201
+   assert app.get_storage().attendance_rows(CLASS_ID) == []
+
+def test_roster_etag(api):
+   open_class()
+   api('POST', '/api/checkin', checkin('Ana', 'ana@x.com'))
+   status, response, body = api('GET', '/api/roster')
+   assert status == 200 and body['total'] == 1 and body['alunos'][0]['nome'] == 'Ana'
+   # Emails are not part of the public roster
+   assert 'email' not in body['alunos'][0]
+   etag = response.getheader('ETag')
+   assert api('GET', '/api/roster', headers={'If-None-Match': etag})[0] == 304
+   api('POST', '/api/checkin', checkin('Bia', 'bia@x.com'))
+   status, response, body = api('GET', '/api/roster', headers={'If-None-Match': etag})
+   assert status == 200 and body['total'] == 2 and response.getheader('ETag') != etag
+
+def test_token_replaces_the_code(app_storage):
+   server = app.CheckinAPI(token='segredo').serve('127.0.0.1', 0)
+   try:
+       open_class()
+       conn = http.client.HTTPConnection('127.0.0.1', server.server_address[1], timeout=10)
+       body = json.dumps({'nome': 'Ana', 'email': 'ana@x.com'})
+       conn.request('POST', '/api/checkin', body=body)
+       response = conn.getresponse()
+       assert response.status == 401
+       response.read()
+       # Same keep-alive connection
+       conn.request('POST', '/api/checkin', body=body, headers={'Authorization': 'Bearer segredo'})
+       response = conn.getresponse()
+       assert response.status == 201
+       response.read()
+       conn.close()
+   finally:
+       server.shutdown()
+       server.server_close()
@@ -0,0 +1,87 @@
+"""The attendance history archive, run against every backend."""
+import time
+
+import app
+
+CLASS_ID = app.DEFAULT_CLASS_ID
+
+def row(email, class_id=CLASS_ID, registered_at=None):
+   return (class_id, email.split('@')[0].title(), email, registered_at or int(time.time()), 'sessao', None)
+
+def wait_for(condition, timeout=10.0):
+   deadline = time.monotonic() + timeout
+   while not condition():
+      assert time.monotonic() < deadline, "timed out"
+      time.sleep(0.02)
+
+def close_list(storage, class_id, emails, registered_at, closed_at):
+   """Open a list, register emails, close it and move it to the archive; returns the archived list id."""
+   storage.start_class(class_id, 'prof')
+   storage.register_batch([row(email, class_id, registered_at) for email in emails])
+   generation = storage.rotate_class(class_id)
+   list_id = storage.archive_list(class_id, generation, closed_at)
+   while storage.archive_generation(class_id, generation, list_id, batch_size=2):
+       pass
+   return list_id
+
+def test_archive_queries(storage):
+   day = 86400
+   fisica = storage.create_class('fisica')
+   close_list(storage, CLASS_ID, ['ana@x.com', 'bia@x.com', 'caio@x.com'], 1 * day, 1 * day + 3600)
+   close_list(storage, CLASS_ID, ['ana@x.com', 'bia@x.com'], 2 * day, 2 * day + 3600)
+   close_list(storage, CLASS_ID, ['ana@x.com'], 3 * day, 3 * day + 3600)
+   close_list(storage, fisica, ['ana@x.com'], 2 * day, 2 * day + 3600)
+
+   # The closed generations were moved out of the live table
+   assert storage.closed_generations() == []
+   assert storage.attendance_rows(CLASS_ID, generation=1) == []
+
+   rates = storage.attendance_rates(CLASS_ID)
+   assert [(email, attended, held) for email, _, attended, held in rates] == [
+       ('ana@x.com', 3, 3), ('bia@x.com', 2, 3), ('caio@x.com', 1, 3),
+   ]
+   assert rates[0][1] == 'Ana'
+   # Only the lists closed in the period count as held
+   assert [(email, attended, held) for email, _, attended, held in storage.attendance_rates(CLASS_ID, 2 * day, 3 * day)] == [
+       ('ana@x.com', 1, 1), ('bia@x.com', 1, 1),
+   ]
+
+   # Emails are matched regardless of case and spaces
+   assert storage.student_attendance(' ANA@x.com ') == [(CLASS_ID, 3, 3), (fisica, 1, 1)]
+   assert storage.student_attendance('bia@x.com', since=2 * day) == [(CLASS_ID, 1, 2)]
+   assert storage.student_attendance('ninguem@x.com') == []
+
+def test_archive_list_is_keyed_by_generation(storage):
+   first = storage.archive_list(CLASS_ID, 1, 1000, 'lista_presenca_20240517_103000_lista1.csv')
+   # Finalizing the same generation again reuses its list
+   assert storage.archive_list(CLASS_ID, 1, 1000, 'lista_presenca_20240517_103000_lista1.csv') == first
+   # Lists closed in the same second stay apart
+   assert storage.archive_list(CLASS_ID, 2, 1000, 'lista_presenca_20240517_103000_lista2.csv') != first
+
+def test_import_list_once_per_source(storage):
+   rows = [('Ana', 'Ana@X.com', 1000), ('Bia', 'bia@x.com', 1001)]
+   assert storage.import_list(CLASS_ID, 2000, 'lista_presenca_19700101_000000.csv', rows) is True
+   assert storage.import_list(CLASS_ID, 2000, 'lista_presenca_19700101_000000.csv', rows) is False
+   assert storage.student_attendance('ana@x.com') == [(CLASS_ID, 1, 1)]
+
+def test_rates_count_the_same_lists_as_held(storage):
+   """A list whose registrations fall in the period but which closed after it counts for neither."""
+   day = 86400
+   close_list(storage, CLASS_ID, ['ana@x.com'], 1 * day, 1 * day + 3600)
+   close_list(storage, CLASS_ID, ['ana@x.com', 'bia@x.com'], 2 * day - 60, 2 * day + 60)
+   assert storage.attendance_rates(CLASS_ID, 0, 2 * day) == [('ana@x.com', 'Ana', 1, 1)]
+   assert storage.student_attendance('bia@x.com', 0, 2 * day) == []
+   assert storage.student_attendance('ana@x.com', 0, 2 * day) == [(CLASS_ID, 1, 1)]
+
+def test_finalized_lists_are_dated_by_their_last_registration(app_storage):
+   registered_at = int(time.time()) - 7 * 86400
+   app_storage.start_class(CLASS_ID, 'prof')
+   app_storage.register_batch([row('ana@x.com', registered_at=registered_at), row('bia@x.com', registered_at=registered_at + 90)])
+   app_storage.rotate_class(CLASS_ID)
+   # Finalized a week late: the list still belongs to the week it was held in
+   app.get_class_scheduler().wake()
+   wait_for(lambda: not app_storage.closed_generations())
+   with app_storage.read() as conn:
+      closed_at, = app_storage.execute(conn, "SELECT closed_at FROM archived_lists WHERE class_id = ?", (CLASS_ID,)).fetchone()
+   assert closed_at == registered_at + 90
+   assert app_storage.attendance_rates(CLASS_ID, registered_at, registered_at + 3600)[0][2:] == (1, 1)
@@ -0,0 +1,35 @@
+"""Registration times: epoch seconds in the database, São Paulo wall-clock text on screen."""
+import datetime
+
+import pytest
+
+import app
+
+def epoch(*moment):
+   return int(app.BRAZIL_TZ.localize(datetime.datetime(*moment)).timestamp())
+
+def test_format_brazil_datetime():
+   # 13:30 UTC, shown in São Paulo time whatever the server's zone
+   assert app.format_brazil_datetime(1715952600) == 'Sexta-feira, 17/05/2024 10:30:00'
+   assert app.format_brazil_datetime(epoch(2024, 12, 29, 23, 59, 59)) == 'Domingo, 29/12/2024 23:59:59'
+
+@pytest.mark.parametrize('moment', [
+   (2024, 5, 17, 10, 30, 0),
+   (2024, 2, 29, 0, 0, 0),
+   (2023, 12, 31, 23, 59, 59),
+   # Daylight saving time, in force until 2019
+   (2018, 11, 4, 1, 0, 0),
+   (2019, 1, 15, 12, 0, 0),
+   (2019, 2, 17, 0, 30, 0),
+])
+def test_round_trip(moment):
+   seconds = epoch(*moment)
+   assert app.parse_brazil_datetime(app.format_brazil_datetime(seconds)) == seconds
+
+@pytest.mark.parametrize('text', [None, '', 'não é uma data', '17/05/2024 10:30:00', 'Sexta-feira, 31/02/2024 10:30:00'])
+def test_parse_rejects_other_text(text):
+   assert app.parse_brazil_datetime(text) is None
+
+def test_parse_ignores_the_weekday():
+   # Only the date and time count, as in CSV backups edited by hand
+   assert app.parse_brazil_datetime('Segunda-feira, 17/05/2024 10:30:00') == 1715952600
@@ -0,0 +1,66 @@
+"""The export writers, fed chunk by chunk as export_attendance streams the list."""
+import csv
+import gzip
+import io
+import tempfile
+import time
+
+import pytest
+
+import app
+
+CHUNKS = [
+   [('Ana', 'ana@x.com', 'Sexta-feira, 17/05/2024 10:30:00'), ('Bia', 'bia@x.com', 'Sexta-feira, 17/05/2024 10:31:00')],
+   [('Caio Ávila', 'caio@x.com', 'Sexta-feira, 17/05/2024 10:32:00')],
+]
+ROWS = [list(row) for rows in CHUNKS for row in rows]
+
+def read_csv(data):
+   return list(csv.reader(io.StringIO(data.decode('utf-8'))))
+
+def test_write_csv():
+   buffer = io.BytesIO()
+   app.write_csv(iter(CHUNKS), buffer)
+   assert read_csv(buffer.getvalue()) == [app.EXPORT_COLUMNS] + ROWS
+   # The wrapper is detached, so the caller's file stays open
+   assert not buffer.closed
+
+def test_write_csv_gz():
+   buffer = io.BytesIO()
+   app.write_csv_gz(iter(CHUNKS), buffer)
+   assert read_csv(gzip.decompress(buffer.getvalue())) == [app.EXPORT_COLUMNS] + ROWS
+
+def test_write_parquet():
+   pq = pytest.importorskip("pyarrow.parquet")
+   buffer = io.BytesIO()
+   app.write_parquet(iter(CHUNKS), buffer)
+   buffer.seek(0)
+   parquet = pq.ParquetFile(buffer)
+   # One row group per chunk
+   assert parquet.num_row_groups == len(CHUNKS)
+   assert parquet.read().to_pylist() == [dict(zip(app.EXPORT_COLUMNS, row)) for row in ROWS]
+
+def test_write_xlsx():
+   openpyxl = pytest.importorskip("openpyxl")
+   buffer = io.BytesIO()
+   app.write_xlsx(iter(CHUNKS), buffer)
+   buffer.seek(0)
+   sheet = openpyxl.load_workbook(buffer, read_only=True)["Lista de Presença"]
+   assert [list(row) for row in sheet.iter_rows(values_only=True)] == [app.EXPORT_COLUMNS] + ROWS
+
+@pytest.mark.parametrize('export_format', app.available_export_formats())
+def test_export_attendance_into_a_spooled_file(app_storage, monkeypatch, export_format):
+   """What the download button prepares: the current list, spilled to disk past the spool size."""
+   monkeypatch.setattr(app, 'EXPORT_CHUNK_SIZE', 2)
+   app_storage.start_class(app.DEFAULT_CLASS_ID, 'prof')
+   app_storage.register_batch([
+      (app.DEFAULT_CLASS_ID, f'Aluno {i}', f'aluno{i}@x.com', int(time.time()), 'sessao', None) for i in range(5)
+   ])
+   with tempfile.SpooledTemporaryFile(max_size=64) as export:
+      assert app.export_attendance(export_format, export, app.DEFAULT_CLASS_ID) == 5
+      assert export._rolled
+      export.seek(0)
+      data = export.read()
+   if export_format == 'CSV':
+      assert [row[1] for row in read_csv(data)[1:]] == [f'aluno{i}@x.com' for i in range(5)]
+   assert data
@@ -0,0 +1,91 @@
+"""Upgrading databases created by earlier versions of the app."""
+import sqlite3
+
+import app
+from conftest import close_storage, open_storage
+
+LEGACY_EPOCH = 1715952600  # Friday, 17/05/2024 10:30:00 in São Paulo
+
+def create_sqlite_baseline(path):
+   """The original single-class SQLite file, from before schema versioning (user_version 0)."""
+   conn = sqlite3.connect(path)
+   conn.execute('''
+       CREATE TABLE attendance (
+           id INTEGER PRIMARY KEY AUTOINCREMENT, nome TEXT NOT NULL, email TEXT NOT NULL UNIQUE,
+           data_hora TEXT NOT NULL, session_id TEXT, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+       )
+   ''')
+   conn.execute('''
+       CREATE TABLE class_state (
+           id INTEGER PRIMARY KEY, aula_iniciada INTEGER DEFAULT 0, timer_end_time TEXT,
+           ip_professor TEXT, session_id TEXT UNIQUE
+       )
+   ''')
+   conn.execute("CREATE INDEX idx_email ON attendance(email)")
+   conn.execute("INSERT INTO attendance (nome, email, data_hora, session_id) VALUES (?, ?, ?, ?)",
+                ('Ana', 'ana@x.com', app.format_brazil_datetime(LEGACY_EPOCH), 's1'))
+   conn.execute("INSERT INTO attendance (nome, email, data_hora, session_id) VALUES (?, ?, ?, ?)",
+                ('Bia', 'bia@x.com', 'não é uma data', 's2'))
+   conn.execute("INSERT INTO class_state (id, aula_iniciada, session_id) VALUES (1, 1, 'prof')")
+   conn.commit()
+   conn.close()
+
+def create_postgres_baseline(url):
+   """A PostgreSQL database at schema version 1, the first multi-class layout."""
+   import psycopg
+   with psycopg.connect(url) as conn:
+       app.postgres_migration_schema(conn)
+       conn.execute("CREATE TABLE schema_version (version INTEGER NOT NULL)")
+       conn.execute("INSERT INTO schema_version (version) VALUES (1)")
+       conn.execute("INSERT INTO attendance (class_id, nome, email, data_hora, session_id) VALUES (1, %s, %s, %s, %s)",
+                    ('Ana', 'ana@x.com', app.format_brazil_datetime(LEGACY_EPOCH), 's1'))
+       conn.execute("INSERT INTO attendance (class_id, nome, email, data_hora, session_id) VALUES (1, %s, %s, %s, %s)",
+                    ('Bia', 'bia@x.com', 'não é uma data', 's2'))
+       conn.execute("INSERT INTO class_state (id, aula_iniciada, session_id) VALUES (1, 1, 'prof')")
+
+def schema_version(storage):
+   with storage.read() as conn:
+       if isinstance(storage, app.SQLiteStorage):
+           return conn.execute('PRAGMA user_version').fetchone()[0]
+       return conn.execute('SELECT version FROM schema_version').fetchone()[0]
+
+def test_fresh_database_reaches_latest_version(database):
+   storage = open_storage(*database)
+   try:
+       latest = storage.migrate()
+       assert latest == schema_version(storage)
+       assert storage.find_class(app.DEFAULT_CLASS_NAME) == app.DEFAULT_CLASS_ID
+       # Running again is a no-op
+       assert storage.migrate() == latest
+   finally:
+       close_storage(storage)
+
+def test_baseline_database_keeps_its_data(database):
+   backend, location = database
+   if backend == "sqlite":
+       create_sqlite_baseline(location)
+   else:
+       create_postgres_baseline(location)
+   storage = open_storage(backend, location)
+   try:
+       latest = storage.migrate()
+       assert latest == len(app.MIGRATIONS if backend == "sqlite" else app.POSTGRES_MIGRATIONS)
+       assert schema_version(storage) == latest
+
+       rows = storage.attendance_rows(app.DEFAULT_CLASS_ID)
+       assert [(nome, email) for nome, email, _ in rows] == [('Ana', 'ana@x.com'), ('Bia', 'bia@x.com')]
+       # data_hora became epoch seconds; one that does not parse falls back to created_at
+       assert rows[0][2] == LEGACY_EPOCH
+       assert rows[1][2] > LEGACY_EPOCH
+
+       # The open list stays open, in generation 1, with a check-in key for its codes
+       state = storage.get_class_state(app.DEFAULT_CLASS_ID)
+       assert state[0] == 1 and state[4]
+       assert storage.current_generation(app.DEFAULT_CLASS_ID) == 1
+       # Uniqueness is now per class and generation
+       assert storage.register_batch([(app.DEFAULT_CLASS_ID, 'Ana', 'ana@x.com', LEGACY_EPOCH, 's3', None)]) == [None]
+       other = storage.create_class('fisica')
+       storage.start_class(other, 'prof')
+       assert storage.register_batch([(other, 'Ana', 'ana@x.com', LEGACY_EPOCH, 's3', None)])[0] is not None
+   finally:
+       close_storage(storage)
@@ -0,0 +1,147 @@
+"""Email delivery through the outbox, against a local SMTP server."""
+import email
+import email.policy
+import socketserver
+import threading
+import time
+
+import pytest
+
+import app
+
+CLASS_ID = app.DEFAULT_CLASS_ID
+
+class SMTPServer(socketserver.ThreadingTCPServer):
+   """Just enough SMTP for smtplib: accepts every message, or refuses the next fail_next ones."""
+
+   daemon_threads = True
+   allow_reuse_address = True
+
+   def __init__(self):
+       super().__init__(('127.0.0.1', 0), SMTPHandler)
+       self.messages = []
+       self.fail_next = 0
+       self.lock = threading.Lock()
+
+   def refuse(self):
+       with self.lock:
+           if self.fail_next:
+               self.fail_next -= 1
+               return True
+       return False
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+   def reply(self, line):
+       self.wfile.write(line.encode() + b'\r\n')
+
+   def handle(self):
+       self.reply('220 localhost ESMTP')
+       while line := self.rfile.readline():
+           command = line.decode().strip().upper()
+           if command.startswith('EHLO'):
+               self.reply('250-localhost')
+               self.reply('250 8BITMIME')
+           elif command.startswith('MAIL'):
+               self.reply('451 Tente mais tarde' if self.server.refuse() else '250 OK')
+           elif command.startswith('DATA'):
+               self.reply('354 End data with <CR><LF>.<CR><LF>')
+               data = []
+               while (line := self.rfile.readline()) not in (b'.\r\n', b''):
+                   data.append(line[1:] if line.startswith(b'..') else line)
+               with self.server.lock:
+                   self.server.messages.append(email.message_from_bytes(b''.join(data), policy=email.policy.default))
+               self.reply('250 OK')
+           elif command.startswith('QUIT'):
+               self.reply('221 Bye')
+               return
+           else:
+               # HELO, RCPT, RSET, NOOP
+               self.reply('250 OK')
+
+@pytest.fixture
+def smtp_server():
+   server = SMTPServer()
+   threading.Thread(target=server.serve_forever, daemon=True).start()
+   yield server
+   server.shutdown()
+   server.server_close()
+
+def smtp_settings(server):
+   return {'configured': True, 'host': '127.0.0.1', 'port': server.server_address[1], 'starttls': False, 'login': None}
+
+def wait_for(condition, timeout=10.0):
+   deadline = time.monotonic() + timeout
+   while not condition():
+       assert time.monotonic() < deadline, "timed out"
+       time.sleep(0.02)
+
+def test_delivers_queued_message(storage, smtp_server):
+   outbox = app.EmailOutbox(storage, smtp_settings(smtp_server))
+   assert outbox.enqueue('professor@x.com', 'Lista de Presença', '<p>3 alunos</p>', class_id=CLASS_ID) is not None
+   wait_for(lambda: storage.last_email_status(CLASS_ID)[0] == 'sent')
+   message, = smtp_server.messages
+   assert message['To'] == 'professor@x.com'
+   assert message['Subject'] == 'Lista de Presença'
+   assert storage.last_email_status(CLASS_ID) == ('sent', 1, None)
+
+def test_dedupe_key_queues_once(storage):
+   assert storage.enqueue_email('professor@x.com', 'Lista', 'corpo', time.time(), 'lista:1:1') is not None
+   assert storage.enqueue_email('professor@x.com', 'Lista', 'corpo', time.time(), 'lista:1:1') is None
+
+def test_retries_after_a_refusal(storage, smtp_server):
+   smtp_server.fail_next = 1
+   outbox = app.EmailOutbox(storage, smtp_settings(smtp_server), base_delay=0.05)
+   outbox.enqueue('professor@x.com', 'Lista', 'corpo', class_id=CLASS_ID)
+   wait_for(lambda: storage.last_email_status(CLASS_ID)[0] == 'sent')
+   assert len(smtp_server.messages) == 1
+   assert storage.last_email_status(CLASS_ID) == ('sent', 2, None)
+
+def test_gives_up_after_max_attempts(storage, smtp_server):
+   smtp_server.fail_next = 100
+   outbox = app.EmailOutbox(storage, smtp_settings(smtp_server), max_attempts=3, base_delay=0.01)
+   outbox.enqueue('professor@x.com', 'Lista', 'corpo', class_id=CLASS_ID)
+   wait_for(lambda: storage.last_email_status(CLASS_ID)[0] == 'failed')
+   status, attempts, last_error = storage.last_email_status(CLASS_ID)
+   assert attempts == 3 and '451' in last_error
+   assert smtp_server.messages == []
+
+def test_workers_send_each_message_once(storage, smtp_server):
+   """Several workers on one database, as with several app processes: no message goes out twice."""
+   count = 40
+   for i in range(count):
+       storage.enqueue_email('professor@x.com', f'Lista {i}', 'corpo', time.time())
+   workers = [app.EmailOutbox(storage, smtp_settings(smtp_server)) for _ in range(4)]
+   for worker in workers:
+       worker._wake.set()
+   wait_for(lambda: len(smtp_server.messages) >= count)
+   time.sleep(0.2)
+   subjects = sorted(message['Subject'] for message in smtp_server.messages)
+   assert subjects == sorted(f'Lista {i}' for i in range(count))
+   assert storage.next_email_due() is None
+
+def test_email_status_is_per_class(storage):
+   other = storage.create_class('fisica')
+   storage.enqueue_email('professor@x.com', 'Lista', 'corpo', time.time(), f'list:{CLASS_ID}:1', CLASS_ID)
+   storage.email_retry(1, 'failed', 5, time.time(), '535 Authentication failed')
+   storage.enqueue_email('professor@x.com', 'Lista', 'corpo', time.time(), f'list:{other}:1', other)
+   assert storage.last_email_status(CLASS_ID) == ('failed', 5, '535 Authentication failed')
+   assert storage.last_email_status(other) == ('pending', 0, None)
+   assert storage.last_email_status(other + 1) is None
+
+def test_migration_assigns_list_emails_to_their_class(storage):
+   storage.enqueue_email('professor@x.com', 'Lista', 'corpo', time.time(), 'list:12:3')
+   storage.enqueue_email('professor@x.com', 'Outro', 'corpo', time.time())
+   migration = app.migration_outbox_class if isinstance(storage, app.SQLiteStorage) else app.postgres_migration_outbox_class
+   with storage.write() as conn:
+      migration(conn)
+   assert storage.last_email_status(12) == ('pending', 0, None)
+   with storage.read() as conn:
+      assert storage.execute(conn, "SELECT dedupe_key, class_id FROM email_outbox ORDER BY id").fetchall() == [('list:12:3', 12), (None, None)]
+
+@pytest.mark.parametrize('value, expected', [
+   (None, True), (True, True), (False, False), ('false', False), ('0', False), ('no', False), ('true', True), ('1', True),
+])
+def test_starttls_setting_is_parsed(monkeypatch, value, expected):
+   settings = {} if value is None else {'smtp_starttls': value}
+   monkeypatch.setattr(app, 'get_setting', lambda name, default=None: settings.get(name, default))
+   assert app.get_smtp_settings()['starttls'] is expected
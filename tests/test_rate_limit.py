@@ -0,0 +1,82 @@
+"""Token buckets and the client address they are keyed by."""
+import pytest
+
+import app
+
+class Clock:
+   def __init__(self):
+      self.now = 1000.0
+
+   def __call__(self):
+      return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+   clock = Clock()
+   monkeypatch.setattr(app.time, 'monotonic', clock)
+   return clock
+
+def test_bucket_refills_at_its_rate(clock):
+   limiter = app.RateLimiter({'session': (0.5, 2)})
+   assert [limiter.allow({'session': 's1'}) for _ in range(3)] == [None, None, 'session']
+   # Other keys have their own bucket
+   assert limiter.allow({'session': 's2'}) is None
+   clock.now += 1.0
+   assert limiter.allow({'session': 's1'}) == 'session'
+   clock.now += 1.0
+   assert limiter.allow({'session': 's1'}) is None
+   # Never more than the burst, however long the bucket was idle
+   clock.now += 100.0
+   assert [limiter.allow({'session': 's1'}) for _ in range(3)] == [None, None, 'session']
+   assert limiter.rejections == {'session': 3}
+
+def test_a_refusal_takes_no_tokens(clock):
+   limiter = app.RateLimiter({'session': (1.0, 1), 'ip': (1.0, 5)})
+   assert limiter.allow({'session': 's1', 'ip': '10.0.0.1'}) is None
+   assert limiter.allow({'session': 's1', 'ip': '10.0.0.1'}) == 'session'
+   # The IP bucket was not charged for the refused request
+   assert [limiter.allow({'session': f's{i}', 'ip': '10.0.0.1'}) for i in range(2, 6)] == [None] * 4
+   assert limiter.allow({'session': 's9', 'ip': '10.0.0.1'}) == 'ip'
+
+def test_missing_keys_and_unknown_kinds_are_skipped(clock):
+   limiter = app.RateLimiter({'session': (1.0, 1)})
+   assert limiter.allow({'session': None, 'global': 'password'}) is None
+   assert limiter._buckets == {}
+
+def test_idle_buckets_are_evicted(clock):
+   limiter = app.RateLimiter({'session': (0.01, 1)}, ttl=60)
+   limiter.allow({'session': 's1'})
+   clock.now += 30
+   limiter.allow({'session': 's2'})
+   clock.now += 40
+   # s1 idle for 70 s is dropped on the next sweep; s2 (40 s) stays
+   limiter.allow({'session': 's3'})
+   assert set(limiter._buckets) == {('session', 's2'), ('session', 's3')}
+
+def test_password_attempts_share_a_global_bucket(clock):
+   limiter = app.RateLimiter(app.RATE_LIMITS['password'])
+   rate, burst = app.RATE_LIMITS['password']['global']
+   # A new address and session for every guess still runs out
+   results = [limiter.allow({'session': f's{i}', 'ip': f'10.0.{i // 250}.{i % 250}', 'global': 'password'}) for i in range(burst + 1)]
+   assert results == [None] * burst + ['global']
+
+@pytest.fixture
+def proxies(monkeypatch):
+   monkeypatch.setattr(app, 'get_setting', lambda name, default=None: ["127.0.0.1", "10.0.0.0/8"] if name == 'trusted_proxies' else default)
+   app.trusted_proxies.cache_clear()
+   yield
+   app.trusted_proxies.cache_clear()
+
+def test_forwarded_for_is_ignored_from_untrusted_peers(proxies):
+   assert app.client_address('203.0.113.7', '1.2.3.4') == '203.0.113.7'
+   assert app.client_address('203.0.113.7', None) == '203.0.113.7'
+
+def test_forwarded_for_is_read_from_the_right_behind_trusted_proxies(proxies):
+   # The client prepended a fake address; the proxies appended the real one
+   assert app.client_address('127.0.0.1', '1.2.3.4, 198.51.100.9') == '198.51.100.9'
+   assert app.client_address('10.1.2.3', '1.2.3.4, 198.51.100.9, 10.0.0.5') == '198.51.100.9'
+   assert app.client_address('127.0.0.1', '10.0.0.5') == '127.0.0.1'
+
+def test_no_trusted_proxies_by_default():
+   app.trusted_proxies.cache_clear()
+   assert app.client_address('127.0.0.1', '1.2.3.4') == '127.0.0.1'
@@ -0,0 +1,89 @@
+"""The in-memory roster index, with writers in this process and in other replicas."""
+import time
+
+import pytest
+
+import app
+
+CLASS_ID = app.DEFAULT_CLASS_ID
+
+def register(storage, email, fingerprint=None):
+   """Commit one row the way any replica's writer does; returns (id, generation)."""
+   result, = storage.register_batch([(CLASS_ID, email.split('@')[0].title(), email, int(time.time()), 'sessao', fingerprint)])
+   return result
+
+def write_through(index, email, fingerprint=None):
+   """Commit one row from this process and add it to the index, like RegistrationWriter."""
+   row_id, generation = register(app.get_storage(), email, fingerprint)
+   index.add(app.RosterEntry(row_id, email.split('@')[0].title(), email, 0, fingerprint), generation)
+
+def test_refresh_keeps_rows_of_other_writers_below_a_write_through(app_storage):
+   app_storage.start_class(CLASS_ID, 'prof')
+   register(app_storage, 'z@x.com')
+   index = app.RosterIndex(CLASS_ID)
+   index.refresh()
+   # Another replica commits b (id 2), then this process commits a (id 3) and writes it through
+   register(app_storage, 'b@x.com')
+   write_through(index, 'a@x.com')
+   index.refresh()
+   assert index.emails == {'a@x.com', 'b@x.com', 'z@x.com'}
+   assert [entry.nome for entry in index.snapshot().entries] == ['A', 'B', 'Z']
+
+def test_refresh_loads_fingerprints(app_storage):
+   app_storage.start_class(CLASS_ID, 'prof')
+   register(app_storage, 'ana@x.com', 'f1')
+   index = app.RosterIndex(CLASS_ID)
+   index.refresh()
+   # The same device is refused from memory, even for a row this process never wrote
+   assert index.contains('outro@x.com', 'f1')
+
+def test_refresh_catches_rows_committed_out_of_order(app_storage):
+   """On a shared database ids are drawn before commit, so a lower id can become visible late."""
+   if not app_storage.shared:
+      pytest.skip("a single SQLite writer commits ids in order")
+   app_storage.start_class(CLASS_ID, 'prof')
+   register(app_storage, 'a@x.com')
+   late_id, _ = register(app_storage, 'b@x.com')
+   register(app_storage, 'c@x.com')
+   # Hide b as if its transaction had not committed yet
+   with app_storage.write() as conn:
+      late = app_storage.execute(
+         conn, "DELETE FROM attendance WHERE id = ? RETURNING class_id, nome, email, registered_at, session_id, fingerprint, generation",
+         (late_id,)
+      ).fetchone()
+   index = app.RosterIndex(CLASS_ID)
+   index.refresh()
+   assert index.emails == {'a@x.com', 'c@x.com'}
+   with app_storage.write() as conn:
+      app_storage.execute(
+         conn, "INSERT INTO attendance (id, class_id, nome, email, registered_at, session_id, fingerprint, generation) "
+         "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (late_id,) + tuple(late)
+      )
+   index.refresh()
+   assert index.emails == {'a@x.com', 'b@x.com', 'c@x.com'}
+
+def test_write_throughs_follow_rotations(app_storage):
+   app_storage.start_class(CLASS_ID, 'prof')
+   index = app.RosterIndex(CLASS_ID)
+   index.refresh()
+   ana_id, _ = register(app_storage, 'ana@x.com', 'f1')
+   assert app_storage.rotate_class(CLASS_ID) == 1
+   app_storage.start_class(CLASS_ID, 'prof')
+   bia_id, generation = register(app_storage, 'bia@x.com', 'f2')
+   # The new list's row reaches the index before the rotation does, then ana's write-through loses the race
+   index.add(app.RosterEntry(bia_id, 'Bia', 'bia@x.com', 0, 'f2'), generation)
+   index.add(app.RosterEntry(ana_id, 'Ana', 'ana@x.com', 0, 'f1'), 1)
+   index.reset(generation)
+   assert index.generation == 2
+   assert index.emails == {'bia@x.com'} and not index.contains('ana@x.com', 'f1')
+   index.refresh()
+   assert index.emails == {'bia@x.com'}
+
+def test_registrations_refresh_the_roster_but_not_the_page(app_storage):
+   app_storage.start_class(CLASS_ID, 'prof')
+   index = app.get_roster_indexes().get(CLASS_ID).sync()
+   page_version, roster_version = app.class_version(CLASS_ID), index.version
+   assert app.get_registration_writer().submit(CLASS_ID, 'Ana', 'ana@x.com', int(time.time()), 'sessao').result(timeout=10)
+   assert index.sync().emails == {'ana@x.com'} and index.version > roster_version
+   app.invalidate_class_state(CLASS_ID)
+   assert app.class_version(CLASS_ID) == page_version
@@ -0,0 +1,93 @@
+"""The class scheduler's passes, called one at a time rather than from its thread."""
+import datetime
+import time
+
+import pytest
+
+import app
+
+CLASS_ID = app.DEFAULT_CLASS_ID
+
+@pytest.fixture
+def scheduler(app_storage, monkeypatch):
+   """A ClassScheduler whose thread exits at once, so each test drives the passes itself."""
+   monkeypatch.setattr(app.ClassScheduler, '_run', lambda self: None)
+   return app.ClassScheduler(app_storage, app.ChangeNotifier(), max_sleep=120.0, archive_batch=1)
+
+def open_with_timer(storage, class_id, seconds):
+   storage.start_class(class_id, 'prof')
+   storage.set_timer(class_id, (datetime.datetime.now() + datetime.timedelta(seconds=seconds)).isoformat())
+
+def register(storage, class_id, *emails):
+   storage.register_batch([(class_id, email.split('@')[0].title(), email, int(time.time()), 'sessao', None) for email in emails])
+
+def outbox(storage):
+   with storage.read() as conn:
+      return storage.execute(conn, "SELECT dedupe_key, class_id FROM email_outbox ORDER BY id").fetchall()
+
+def test_close_expired_closes_only_lists_past_their_timer(app_storage, scheduler):
+   fisica, quimica = app_storage.create_class('fisica'), app_storage.create_class('quimica')
+   open_with_timer(app_storage, CLASS_ID, -1)
+   register(app_storage, CLASS_ID, 'ana@x.com')
+   open_with_timer(app_storage, fisica, 60)
+   # Open without a timer: only the professor closes it
+   app_storage.start_class(quimica, 'prof')
+   index = app.get_roster_indexes().get(CLASS_ID).sync()
+
+   delay = scheduler._close_expired()
+   # Sleeps until the next deadline, not for max_sleep
+   assert 55 < delay <= 60
+   assert app_storage.get_class_state(CLASS_ID)[0] == 0 and app_storage.current_generation(CLASS_ID) == 2
+   assert app_storage.get_class_state(fisica)[0] == 1 and app_storage.get_class_state(quimica)[0] == 1
+   # Pages of the closed class rerun once, and its roster starts over at the next list
+   assert scheduler.notifier.version(CLASS_ID) == 1 and scheduler.notifier.version(fisica) == 0
+   assert index.generation == 2 and not index.contains('ana@x.com')
+   assert app_storage.closed_generations() == [(CLASS_ID, 1)]
+   # A second pass has nothing left to close
+   scheduler._close_expired()
+   assert scheduler.notifier.version(CLASS_ID) == 1
+
+def test_close_expired_without_timers_sleeps_max_sleep(scheduler):
+   assert scheduler._close_expired() == scheduler.max_sleep
+
+def test_finalize_emails_and_archives_once(app_storage, scheduler):
+   app_storage.start_class(CLASS_ID, 'prof')
+   register(app_storage, CLASS_ID, 'ana@x.com', 'bia@x.com', 'caio@x.com')
+   app_storage.rotate_class(CLASS_ID)
+
+   scheduler._finalize(CLASS_ID, 1)
+   assert outbox(app_storage) == [(f'list:{CLASS_ID}:1', CLASS_ID)]
+   # Moved to the archive one row per batch, then gone from the live table
+   assert app_storage.attendance_rows(CLASS_ID, generation=1) == []
+   assert app_storage.closed_generations() == []
+   assert [email for email, *_ in app_storage.attendance_rates(CLASS_ID, 0, int(time.time()) + 1)] == [
+      'ana@x.com', 'bia@x.com', 'caio@x.com'
+   ]
+   # A late pass (or another process) finds nothing left to do
+   scheduler._finalize(CLASS_ID, 1)
+   assert len(outbox(app_storage)) == 1
+
+def test_finalize_closed_skips_empty_lists(app_storage, scheduler):
+   app_storage.start_class(CLASS_ID, 'prof')
+   app_storage.rotate_class(CLASS_ID)
+   assert scheduler._finalize_closed() == set()
+   assert outbox(app_storage) == []
+
+def test_finalize_closed_goes_on_past_a_failing_list(app_storage, scheduler, monkeypatch):
+   fisica = app_storage.create_class('fisica')
+   for class_id in (CLASS_ID, fisica):
+      app_storage.start_class(class_id, 'prof')
+      register(app_storage, class_id, 'ana@x.com')
+      app_storage.rotate_class(class_id)
+   finalize = scheduler._finalize
+
+   def flaky(class_id, generation):
+      if class_id == CLASS_ID:
+         raise RuntimeError("disco cheio")
+      finalize(class_id, generation)
+
+   monkeypatch.setattr(scheduler, '_finalize', flaky)
+   assert scheduler._finalize_closed() == {(CLASS_ID, 1)}
+   assert outbox(app_storage) == [(f'list:{fisica}:1', fisica)]
+   # The failed list stays closed, for the next pass
+   assert app_storage.closed_generations() == [(CLASS_ID, 1)]
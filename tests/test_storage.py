@@ -0,0 +1,104 @@
+"""Storage queries, run against every backend."""
+import threading
+import time
+
+import app
+
+CLASS_ID = app.DEFAULT_CLASS_ID
+
+def row(email, fingerprint=None, class_id=CLASS_ID, registered_at=None):
+   return (class_id, email.split('@')[0].title(), email, registered_at or int(time.time()), 'sessao', fingerprint)
+
+def run_together(count, target):
+   """Run target(i) on count threads released at once; returns the results in thread order."""
+   barrier = threading.Barrier(count)
+   results = [None] * count
+   errors = []
+
+   def worker(i):
+       barrier.wait()
+       try:
+           results[i] = target(i)
+       except Exception as e:
+           errors.append(e)
+
+   threads = [threading.Thread(target=worker, args=(i,)) for i in range(count)]
+   for thread in threads:
+       thread.start()
+   for thread in threads:
+       thread.join()
+   assert not errors
+   return results
+
+def test_register_batch_rejects_duplicates(storage):
+   storage.start_class(CLASS_ID, 'prof')
+   results = storage.register_batch([
+       row('ana@x.com', 'f1'),
+       row('bia@x.com', 'f2'),
+       row('ana@x.com', 'f3'),   # same email
+       row('caio@x.com', 'f1'),  # same device
+       row('davi@x.com'),
+       row('eva@x.com'),         # no fingerprint is never a duplicate
+   ])
+   assert [result is not None for result in results] == [True, True, False, False, True, True]
+   assert all(generation == 1 for _, generation in filter(None, results))
+   # Duplicates of rows committed earlier are rejected too
+   assert storage.register_batch([row('bia@x.com'), row('fabio@x.com', 'f2')]) == [None, None]
+   assert [email for _, email, _ in storage.attendance_rows(CLASS_ID)] == ['ana@x.com', 'bia@x.com', 'davi@x.com', 'eva@x.com']
+
+def test_register_batch_bumps_roster_version(storage):
+   storage.start_class(CLASS_ID, 'prof')
+   version, roster_version = storage.get_class_state(CLASS_ID)[5:]
+   storage.register_batch([row('ana@x.com')])
+   # Only the roster moved: pages watching the class do not rerun
+   assert storage.get_class_state(CLASS_ID)[5:] == (version, roster_version + 1)
+   # Nothing registered, nothing to announce
+   storage.register_batch([row('ana@x.com')])
+   assert storage.get_class_state(CLASS_ID)[5:] == (version, roster_version + 1)
+
+def test_register_batch_refuses_closed_lists(storage):
+   other = storage.create_class('fisica')
+   # Never started
+   assert storage.register_batch([row('ana@x.com'), row('bia@x.com', class_id=other)]) == [None, None]
+   storage.start_class(CLASS_ID, 'prof')
+   assert storage.register_batch([row('ana@x.com')])[0] is not None
+   assert storage.rotate_class(CLASS_ID) == 1
+   # Closed by the rotation
+   assert storage.register_batch([row('bia@x.com')]) == [None]
+   # The next list starts empty, so the same student may register again
+   storage.start_class(CLASS_ID, 'prof')
+   (_, generation), = storage.register_batch([row('ana@x.com')])
+   assert generation == 2
+   assert [email for _, email, _ in storage.attendance_rows(CLASS_ID, generation=1)] == ['ana@x.com']
+   assert [email for _, email, _ in storage.attendance_rows(CLASS_ID)] == ['ana@x.com']
+
+def test_rotate_class_race_has_one_winner(storage):
+   storage.start_class(CLASS_ID, 'prof')
+   results = run_together(8, lambda i: storage.rotate_class(CLASS_ID))
+   assert sorted(results, key=str) == [1] + [None] * 7
+   assert storage.current_generation(CLASS_ID) == 2
+   assert storage.get_class_state(CLASS_ID)[0] == 0
+
+def test_rotate_class_checks_the_timer(storage):
+   storage.start_class(CLASS_ID, 'prof')
+   storage.set_timer(CLASS_ID, '2024-05-17T10:30:00')
+   # A scheduler that read an older timer does not close the list
+   assert storage.rotate_class(CLASS_ID, '2024-05-17T10:00:00') is None
+   assert storage.rotate_class(CLASS_ID, '2024-05-17T10:30:00') == 1
+   assert storage.open_timers() == []
+
+def test_rotate_class_race_with_registrations(storage):
+   """Every registration lands in the generation it reports, and none after the close."""
+   storage.start_class(CLASS_ID, 'prof')
+
+   def act(i):
+       if i == 0:
+           return storage.rotate_class(CLASS_ID)
+       return storage.register_batch([row(f'aluno{i}@x.com', f'f{i}')])[0]
+
+   results = run_together(16, act)
+   assert results[0] == 1
+   registered = {f'aluno{i}@x.com' for i, result in enumerate(results) if i and result is not None}
+   assert all(result[1] == 1 for result in results[1:] if result is not None)
+   assert {email for _, email, _ in storage.attendance_rows(CLASS_ID, generation=1)} == registered
+   assert storage.attendance_rows(CLASS_ID) == []